@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+
+"""
+bench.py: Reproducible benchmarks for building and querying SuffixArray,
+          FmIndex and CompactSuffixTree indexes of synthetic DNA texts.
+          Every index is built and queried in its own forked process so
+          peak memory is measured in isolation.  Results are JSON.
+"""
+
+import json
+import os
+import random
+import sys
+import time
+
+from sa import SuffixArray
+from fm import FmIndex
+from suf_tree import CompactSuffixTree, MemFinder
+
+def syntheticText(kind, n, seed=0):
+    """ Return a synthetic DNA text of length n.  A 'dna' text is uniformly
+        random; a 'repetitive' text is copies of one random 1,000-base unit,
+        each copy mutated at 1% of positions. """
+    rnd = random.Random(seed)
+    if kind == 'dna':
+        return ''.join([rnd.choice('ACGT') for _ in xrange(0, n)])
+    elif kind == 'repetitive':
+        unit = ''.join([rnd.choice('ACGT') for _ in xrange(0, min(n, 1000))])
+        t = []
+        while len(t) < n:
+            t.extend([c if rnd.random() >= 0.01 else rnd.choice('ACGT') for c in unit])
+        return ''.join(t[:n])
+    raise RuntimeError("Unknown text kind '%s'" % kind)
+
+def samplePatterns(t, num, m, err=0.0, seed=0):
+    """ Return num substrings of t of length m, each character replaced by
+        a random base with probability err """
+    rnd = random.Random(seed)
+    pats = []
+    for _ in xrange(0, num):
+        i = rnd.randint(0, max(len(t) - m, 0))
+        pats.append(''.join([c if rnd.random() >= err else rnd.choice('ACGT') for c in t[i:i+m]]))
+    return pats
+
+def sectionBytes(sections):
+    """ Given (name, data) sections as passed to writeIndexFile, return dict
+        mapping each name's prefix (up to the first '.') to total bytes """
+    tot = {}
+    for name, data in sections:
+        nbytes = len(data) * data.itemsize if hasattr(data, 'itemsize') else len(data)
+        key = name.split('.')[0]
+        tot[key] = tot.get(key, 0) + nbytes
+    return tot
+
+def runIsolated(job):
+    """ Call job() in a forked child process and return the dict it
+        returns, which must be JSON-serializable """
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        try:
+            out = json.dumps(job())
+        except Exception as e:
+            out = json.dumps({ 'error': repr(e) })
+        while len(out) > 0:
+            out = out[os.write(wfd, out):]
+        os._exit(0)
+    os.close(wfd)
+    chunks = []
+    while True:
+        chunk = os.read(rfd, 1 << 16)
+        if len(chunk) == 0:
+            break
+        chunks.append(chunk)
+    os.close(rfd)
+    os.waitpid(pid, 0)
+    if len(chunks) == 0:
+        raise RuntimeError("Benchmark process died")
+    return json.loads(''.join(chunks))
+
+def measureIndex(build, sections, queries):
+    """ Build an index with build(), measuring time and growth in peak
+        RSS, then its size with sections(index) (a list of sections as
+        passed to writeIndexFile, or None) and then query throughput.
+        queries(index) is a list of (name, setup, patterns) where setup()
+        returns the query function; setup time isn't counted.  Meant to be
+        called via runIsolated. """
+    import resource
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    st = time.time()
+    index = build()
+    res = { 'build_secs': time.time() - st,
+            'peak_rss_bytes': (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base) * 1024 }
+    secs = sections(index)
+    if secs is not None:
+        res['section_bytes'] = sectionBytes(secs)
+        res['index_bytes'] = sum(res['section_bytes'].itervalues())
+    res['queries'] = {}
+    for name, setup, pats in queries(index):
+        fn = setup()
+        hits = 0
+        st = time.time()
+        for p in pats:
+            r = fn(p)
+            hits += len(r) if hasattr(r, '__len__') else int(r)
+        elapsed = time.time() - st
+        res['queries'][name] = { 'count': len(pats), 'secs': elapsed, 'hits': hits,
+                                 'per_sec': len(pats) / elapsed if elapsed > 0 else None }
+    return res
+
+def _width(iv):
+    return max(iv[1] - iv[0], 0)
+
+def _fmQueries(t, cpIval, ssaIval, pats, minMem):
+    """ FmIndex query set.  mems needs LCP intervals, which would distort
+        the index's build numbers, so it runs on a separately built
+        index with the same cpIval and ssaIval. """
+    def queries(fm):
+        def memsSetup():
+            lfm = FmIndex.fromString(t, cpIval=cpIval, ssaIval=ssaIval, lcp=True)
+            return lambda p: lfm.mems(p, minMem)[0]
+        return [ ('range', lambda: lambda p: _width(fm.range(p)), pats['exact']),
+                 ('occurrences', lambda: fm.occurrences, pats['exact']),
+                 ('hasSubstring', lambda: fm.hasSubstring, pats['mixed']),
+                 ('mems', memsSetup, pats['reads']) ]
+    return queries
+
+def _saQueries(pats):
+    def queries(sa):
+        def occurrences(p):
+            l, r = sa.range(p)
+            return sorted(sa.sa[l:r])
+        return [ ('range', lambda: lambda p: _width(sa.range(p)), pats['exact']),
+                 ('occurrences', lambda: occurrences, pats['exact']),
+                 ('hasSubstring', lambda: sa.hasSubstring, pats['mixed']) ]
+    return queries
+
+def _treeQueries(pats, minMem):
+    def queries(st):
+        def memsSetup():
+            mf = MemFinder(st)
+            return lambda p: list(mf.mems(p, minMem))
+        return [ ('hasSubstring', lambda: st.hasSubstring, pats['mixed']),
+                 ('mems', memsSetup, pats['reads']) ]
+    return queries
+
+def benchmark(sizes=(10000, 100000), kinds=('dna', 'repetitive'), seed=0,
+              cpIvals=(4, 32, 128), ssaIvals=(4, 32, 128), numQueries=1000,
+              patternLen=20, readLen=100, minMem=20, maxTreeLen=100000,
+              log=None):
+    """ Benchmark SuffixArray, CompactSuffixTree (for texts of length up to
+        maxTreeLen) and FmIndex for every combination of cpIval and
+        ssaIval, on texts of every kind and size.  Patterns are exact
+        substrings of length patternLen for range and occurrences,
+        substrings with 5% of bases mutated for hasSubstring, and
+        readLen-long substrings with 2% mutated for mems (reporting MEMs at
+        least minMem long).  Returns a JSON-serializable dict.  If log is a
+        file object, a line is written to it as each index finishes. """
+    results = []
+    for kind in kinds:
+        for n in sizes:
+            t = syntheticText(kind, n, seed)
+            pats = { 'exact': samplePatterns(t, numQueries, patternLen, 0.0, seed),
+                     'mixed': samplePatterns(t, numQueries, patternLen, 0.05, seed + 1),
+                     'reads': samplePatterns(t, max(numQueries // 10, 1), readLen, 0.02, seed + 2) }
+            jobs = [ ('SuffixArray', {},
+                      lambda: SuffixArray.fromString(t),
+                      lambda sa: [ ('s', sa.s), ('sa', sa.sa) ],
+                      _saQueries(pats)) ]
+            if n <= maxTreeLen:
+                jobs.append(('CompactSuffixTree', {},
+                             lambda: CompactSuffixTree(t), lambda st: None,
+                             _treeQueries(pats, minMem)))
+            for cpIval in cpIvals:
+                for ssaIval in ssaIvals:
+                    jobs.append(('FmIndex', { 'cpIval': cpIval, 'ssaIval': ssaIval },
+                                 lambda cpIval=cpIval, ssaIval=ssaIval: FmIndex.fromString(t, cpIval=cpIval, ssaIval=ssaIval),
+                                 lambda fm: fm._metaAndSections()[1],
+                                 _fmQueries(t, cpIval, ssaIval, pats, minMem)))
+            for name, params, build, sections, queries in jobs:
+                res = runIsolated(lambda: measureIndex(build, sections, queries))
+                res.update({ 'index': name, 'params': params, 'text': kind, 'length': n })
+                # Serialized size and build-time RSS growth measure
+                # different things, so they're reported separately
+                if 'index_bytes' in res:
+                    res['index_bytes_per_base'] = res['index_bytes'] / float(n)
+                if 'peak_rss_bytes' in res:
+                    res['rss_bytes_per_base'] = res['peak_rss_bytes'] / float(n)
+                results.append(res)
+                if log is not None:
+                    print >>log, '%s %d %s %s: built in %0.2fs' % (kind, n, name, params, res.get('build_secs', -1))
+                    log.flush()
+    return { 'seed': seed,
+             'settings': { 'sizes': list(sizes), 'kinds': list(kinds), 'cpIvals': list(cpIvals),
+                           'ssaIvals': list(ssaIvals), 'numQueries': numQueries, 'patternLen': patternLen,
+                           'readLen': readLen, 'minMem': minMem, 'maxTreeLen': maxTreeLen },
+             'results': results }
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark index builds and queries')
+
+    def intList(s):
+        return map(int, s.split(','))
+
+    parser.add_argument(\
+        '--sizes', metavar='int,int,...', type=intList, default=[10000, 100000], help='Text lengths')
+    parser.add_argument(\
+        '--kinds', metavar='kind,kind,...', type=str, default='dna,repetitive', help='Text kinds: dna, repetitive')
+    parser.add_argument(\
+        '--seed', metavar='int', type=int, default=0, help='Random seed for texts and patterns')
+    parser.add_argument(\
+        '--cp-ivals', metavar='int,int,...', type=intList, default=[4, 32, 128], help='FmIndex checkpoint intervals')
+    parser.add_argument(\
+        '--ssa-ivals', metavar='int,int,...', type=intList, default=[4, 32, 128], help='FmIndex SA sample intervals')
+    parser.add_argument(\
+        '--queries', metavar='int', type=int, default=1000, help='Number of queries of each type')
+    parser.add_argument(\
+        '--pattern-len', metavar='int', type=int, default=20, help='Length of range/occurrences/hasSubstring patterns')
+    parser.add_argument(\
+        '--read-len', metavar='int', type=int, default=100, help='Length of mems patterns')
+    parser.add_argument(\
+        '--min-mem', metavar='int', type=int, default=20, help='Minimum MEM length')
+    parser.add_argument(\
+        '--max-tree-len', metavar='int', type=int, default=100000, help='Skip suffix trees for longer texts')
+    parser.add_argument(\
+        '--out', metavar='path', type=str, help='Write JSON here instead of stdout')
+    parser.add_argument(\
+        '--test', action='store_const', const=True, default=False, help='Do unit tests')
+
+    args = parser.parse_args()
+
+    if args.test:
+        import unittest
+
+        class Test(unittest.TestCase):
+
+            def test_texts_1(self):
+                for kind in ('dna', 'repetitive'):
+                    t = syntheticText(kind, 2500, 7)
+                    self.assertEqual(2500, len(t))
+                    self.assertEqual(t, syntheticText(kind, 2500, 7))
+                    self.assertTrue(set(t) <= set('ACGT'))
+                    for p in samplePatterns(t, 10, 12, seed=3):
+                        self.assertTrue(p in t)
+                self.assertRaises(RuntimeError, syntheticText, 'protein', 10)
+
+            def test_benchmark_1(self):
+                res = json.loads(json.dumps(benchmark(sizes=(500,), kinds=('repetitive',), cpIvals=(4,),
+                                                      ssaIvals=(2, 8), numQueries=20, minMem=10)))
+                self.assertEqual(['SuffixArray', 'CompactSuffixTree', 'FmIndex', 'FmIndex'],
+                                 [ r['index'] for r in res['results'] ])
+                hits = {}
+                for r in res['results']:
+                    self.assertFalse('error' in r)
+                    self.assertTrue(r['build_secs'] >= 0 and r['rss_bytes_per_base'] >= 0)
+                    if r['index'] != 'CompactSuffixTree':
+                        self.assertEqual(r['index_bytes'] / 500.0, r['index_bytes_per_base'])
+                    for name, q in r['queries'].iteritems():
+                        self.assertEqual(20 if name != 'mems' else 2, q['count'])
+                        hits.setdefault(name, set()).add(q['hits'])
+                # Every index finds the same number of hits
+                for name, h in hits.iteritems():
+                    self.assertEqual(1, len(h), name)
+                fms = res['results'][2:]
+                self.assertTrue(fms[0]['section_bytes']['ssa'] > fms[1]['section_bytes']['ssa'])
+
+        unittest.main(argv=[sys.argv[0]])
+
+    else:
+        ost = open(args.out, 'w') if args.out is not None else sys.stdout
+        res = benchmark(sizes=args.sizes, kinds=args.kinds.split(','), seed=args.seed,
+                        cpIvals=args.cp_ivals, ssaIvals=args.ssa_ivals, numQueries=args.queries,
+                        patternLen=args.pattern_len, readLen=args.read_len, minMem=args.min_mem,
+                        maxTreeLen=args.max_tree_len, log=sys.stderr)
+        json.dump(res, ost, indent=1, sort_keys=True)
+        print >>ost
+        if ost is not sys.stdout:
+            ost.close()
@@ -9,7 +9,17 @@ Date: 2/23/2013
 Contact: langmea@cs.jhu.edu
 """
 
-from sa import SuffixArray
+from array import array
+from binascii import hexlify
+from bisect import bisect_left, bisect_right
+from collections import deque
+from itertools import islice, izip
+from multiprocessing import Pool
+import numpy
+import sys
+from sa import SuffixArray, KmerTable, LcpIntervals, QueryStats, naiveSuffixArray, suffixArray, intArray, kasaiLcp, \
+    bwtRuns, blockwiseSuffixArray
+from indexfile import writeIndexFile, readIndexFile, npView
 from suf_tree import SuffixTree
 
 def rotations(t):
@@ -36,24 +46,102 @@ def naive(p, t, start=0, end=None):
             matches.append(i) # match
     return matches
 
-def suffixArray(s):
-    """ Given T return suffix array SA(T).  We use Python's sorted
-        function here for simplicity, but we can do better. """
-    satups = sorted([(s[i:], i) for i in xrange(0, len(s))])
-    # Extract and return just the offsets
-    return map(lambda x: x[1], satups)
+def popcount(x):
+    """ Return number of 1 bits in non-negative integer x """
+    return bin(x).count('1')
+
+_u64 = numpy.uint64
+_littleEndian = sys.byteorder == 'little'
+
+# Characters are coded as their byte values; _chars[b] is the character for b
+_chars = [ chr(b) for b in xrange(0, 256) ]
+
+def _wordsToInt(words):
+    """ Return the 64-bit words in array (or numpy array) words as one
+        integer, with words[0] as its lowest 64 bits """
+    if _littleEndian:
+        return int(hexlify(words.tostring()[::-1]), 16)
+    return int(hexlify(words[::-1].tostring()), 16)
+
+def popcountMany(x, fieldBits=1):
+    """ Return number of 1 bits in each element of uint64 array x.  With
+        fieldBits=2, instead return the sum of x's 2-bit fields. """
+    if fieldBits == 1:
+        x = x - ((x >> _u64(1)) & _u64(0x5555555555555555))
+    x = (x & _u64(0x3333333333333333)) + ((x >> _u64(2)) & _u64(0x3333333333333333))
+    x = (x + (x >> _u64(4))) & _u64(0x0f0f0f0f0f0f0f0f)
+    return ((x * _u64(0x0101010101010101)) >> _u64(56)).astype(numpy.int64)
+
+class SuffixArraySample(object):
+    """ Suffix array samples stored in a dense typed array.  Rows that have
+        a sample are marked in a bitvector, with a cumulative count of
+        marked rows before each 32-bit word.  A row's sample sits at the
+        index given by its rank among marked rows, so lookups are O(1)
+        without a hash table. """
+    
+    def __init__(self, nrows, samples):
+        """ Build from number of BWM rows and (row, offset) pairs given in
+            increasing row order """
+        nwords = (nrows + 31) >> 5
+        self.nrows = nrows
+        self.bits = array('I', [0]) * nwords
+        self.vals = intArray(nrows)
+        for row, off in samples:
+            self.bits[row >> 5] |= 1 << (row & 31)
+            self.vals.append(off)
+        self.cum = intArray(len(self.vals), [0]) * nwords
+        tot = 0
+        for i in xrange(0, nwords):
+            self.cum[i] = tot
+            tot += popcount(self.bits[i])
+    
+    def sections(self, prefix):
+        """ Return (name, array) pairs for saving to an index file """
+        return [ (prefix + 'bits', self.bits), (prefix + 'cum', self.cum), (prefix + 'vals', self.vals) ]
+    
+    @classmethod
+    def fromSections(cls, nrows, secs, prefix):
+        """ Rebuild from sections loaded from an index file """
+        ssa = cls.__new__(cls)
+        ssa.nrows = nrows
+        ssa.bits, ssa.cum, ssa.vals = secs[prefix + 'bits'], secs[prefix + 'cum'], secs[prefix + 'vals']
+        return ssa
+    
+    def __len__(self):
+        return len(self.vals)
+    
+    def __contains__(self, row):
+        return (self.bits[row >> 5] >> (row & 31)) & 1 == 1
+    
+    def __getitem__(self, row):
+        """ Return suffix array value for sampled row """
+        w, b = row >> 5, row & 31
+        word = self.bits[w]
+        if not (word >> b) & 1:
+            raise KeyError(row)
+        return self.vals[self.cum[w] + popcount(word & ((1 << b) - 1))]
+    
+    def lookupMany(self, rows):
+        """ Given an array of rows, return a boolean array saying which are
+            sampled and an array with the samples for those rows (0 for
+            rows not sampled) """
+        rows = numpy.asarray(rows, dtype=numpy.int64)
+        w, b = rows >> 5, (rows & 31).astype(_u64)
+        words = npView(self.bits)[w].astype(_u64)
+        hit = ((words >> b) & _u64(1)) == _u64(1)
+        vals = numpy.zeros(len(rows), dtype=numpy.int64)
+        idx = npView(self.cum)[w[hit]].astype(numpy.int64)
+        idx += popcountMany(words[hit] & ((_u64(1) << b[hit]) - _u64(1)))
+        vals[hit] = npView(self.vals)[idx]
+        return hit, vals
 
 def downsampleSuffixArray(sa, n=4):
     """ Take only the suffix-array entries for every nth suffix.  Keep
-        suffixes at offsets 0, n, 2n, etc.  Return map from the rows we
-        kept to their suffix-array values. """
-    ssa = {}
-    for i in xrange(0, len(sa)):
-        # We could use i % n instead of sa[i] % n, but we lose the
-        # constant-time guarantee for resolutions
-        if sa[i] % n == 0:
-            ssa[i] = sa[i]
-    return ssa
+        suffixes at offsets 0, n, 2n, etc.  Return a SuffixArraySample
+        mapping the rows we kept to their suffix-array values. """
+    # We could use i % n instead of sa[i] % n, but we lose the
+    # constant-time guarantee for resolutions
+    return SuffixArraySample(len(sa), ((i, sa[i]) for i in xrange(0, len(sa)) if sa[i] % n == 0))
 
 def bwtFromSa(t, sa=None):
     """ Given T, returns BWT(T) by way of the suffix array. """
@@ -77,113 +165,915 @@ class FmCheckpoints(object):
         """ Scan BWT, creating checkpoints as we go """
         self.cps = {}        # checkpoints
         self.cpIval = cpIval # spacing between checkpoints
+        self.stats = None    # QueryStats, if counting scan steps
         tally = {}           # tally so far
         for c in bw:
             if c not in tally:
                 tally[c] = 0
-                self.cps[c] = []
+                self.cps[c] = intArray(len(bw))
         for i in xrange(0, len(bw)):
             tally[bw[i]] += 1
             if (i % cpIval) == 0:
                 for c in tally.iterkeys():
                     self.cps[c].append(tally[c])
+        self._indexCodes()
+    
+    def _indexCodes(self):
+        """ Index checkpoint arrays by character code """
+        self.byCode = [None] * 256
+        for c, cp in self.cps.iteritems():
+            self.byCode[ord(c)] = cp
     
     def rank(self, bw, c, row):
         """ Return c's rank w/r/t 'row'.  I.e., how many c's are there in rows
             up to and including 'row'. """
-        if row < 0 or c not in self.cps:
+        return self.rankCode(bw, ord(c), row)
+    
+    def rankCode(self, bw, b, row):
+        """ rank for the character with code b """
+        if row < 0:
+            return 0
+        cp = self.byCode[b]
+        if cp is None:
             return 0
+        c, ival = _chars[b], self.cpIval
         i = row
         nocc = 0
-        while (i % self.cpIval) != 0:
+        while (i % ival) != 0:
             if bw[i] == c:
                 nocc += 1
             i -= 1
-        rank = self.cps[c][i / self.cpIval] + nocc
+        rank = cp[i // ival] + nocc
+        if self.stats is not None:
+            self.stats.record('rankScan', row - i)
         return rank
+    
+    def rankMany(self, bw, cs, rows):
+        """ Vectorized rank: given arrays of characters (as byte values) and
+            rows, return array of the characters' ranks w/r/t the rows """
+        cs, rows = numpy.asarray(cs, dtype=numpy.uint8), numpy.asarray(rows, dtype=numpy.int64)
+        ok = rows >= 0
+        row = numpy.where(ok, rows, 0)
+        cp = row - row % self.cpIval
+        ranks = numpy.zeros(len(rows), dtype=numpy.int64)
+        # look checkpoints up in each character's own (possibly mmapped)
+        # array rather than a stacked copy of them all
+        for b in numpy.unique(cs[ok]):
+            cps = self.byCode[b]
+            if cps is not None:
+                sel = ok & (cs == b)
+                ranks[sel] = npView(cps)[cp[sel] // self.cpIval]
+        bwa = numpy.frombuffer(bw, dtype=numpy.uint8)
+        for d in xrange(1, self.cpIval):
+            i = numpy.minimum(cp + d, len(bwa) - 1)
+            ranks += (cp + d <= row) & (bwa[i] == cs)
+        return numpy.where(ok, ranks, 0)
+    
+    def sections(self, prefix):
+        """ Return (name, array) pairs for saving to an index file """
+        return [ (prefix + str(ord(c)), cp) for c, cp in sorted(self.cps.iteritems()) ]
+    
+    @classmethod
+    def fromSections(cls, cpIval, secs, prefix):
+        """ Rebuild from sections loaded from an index file """
+        cps = cls.__new__(cls)
+        cps.cpIval = cpIval
+        cps.stats = None
+        cps.cps = {}
+        for name, cp in secs.iteritems():
+            if name.startswith(prefix):
+                cps.cps[chr(int(name[len(prefix):]))] = cp
+        cps._indexCodes()
+        return cps
+
+def bwtAndSamples(t, sa, ssaIval=4):
+    """ Given T and its suffix array as any iterable, e.g. one generated by
+        blockwiseSuffixArray, return BWT(T), the row where $ occurs and a
+        SuffixArraySample of the suffixes at offsets that are multiples of
+        ssaIval, all in one pass over the suffix array. """
+    bw = array('c')
+    dollarRow = None
+    rows, offs = intArray(len(t)), intArray(len(t))
+    for row, off in enumerate(sa):
+        if off == 0:
+            dollarRow = row
+            bw.append('$')
+        else:
+            bw.append(t[off-1])
+        if off % ssaIval == 0:
+            rows.append(row)
+            offs.append(off)
+    return bw.tostring(), dollarRow, SuffixArraySample(len(bw), izip(rows, offs))
+
+class DnaBwt(object):
+    """ BWT over A/C/G/T packed 2 bits per base into 64-bit words, 32 bases
+        per word.  Words are grouped in blocks of 512 bases, each preceded
+        by one word holding the 16-bit counts of A, C, G and T from the
+        start of the enclosing 64K-base superblock to the start of the
+        block; absolute counts are kept per superblock.  That's about 0.27
+        bytes per base, ~3.75x smaller than a string BWT.  A rank query is
+        one block lookup plus a single popcount over the block's prefix,
+        independent of any checkpoint interval.  Other characters ($, N,
+        ...) are stored out of band as sorted lists of rows and packed as
+        A.  Serves as both the BWT (supports len and indexing) and its rank
+        structure (has FmCheckpoints' rank). """
+    
+    codes = { 'A': 0, 'C': 1, 'G': 2, 'T': 3 }
+    dnaCode = [ codes.get(c) for c in _chars ] # 2-bit code for each character code
+    
+    BLOCK_BASES = 512
+    BLOCK_WORDS = 17                 # 1 count word + 16 data words
+    SUPER_BASES = 1 << 16            # relative counts fit in 16 bits
+    MASK64 = (1 << 64) - 1
+    LO_BITS = 0x5555555555555555     # low bit of each 2-bit field
+    # For each code, the word having that code in every 2-bit field
+    REPEATS = [ 0, LO_BITS, LO_BITS << 1, MASK64 ]
+    # Same, repeated across all data words of a block, as one integer
+    BLOCK_REPEATS = [ rep * sum(1 << (64 * j) for j in xrange(0, 16)) for rep in REPEATS ]
+    BLOCK_LO_BITS = BLOCK_REPEATS[1]
+    
+    def __init__(self, bw):
+        """ Pack BWT string bw """
+        self.n = len(bw)
+        nblocks = (self.n + self.BLOCK_BASES - 1) // self.BLOCK_BASES
+        self.data = array('L', [0]) * (nblocks * self.BLOCK_WORDS)
+        nsupers = (self.n + self.SUPER_BASES - 1) // self.SUPER_BASES
+        self.supers = intArray(self.n, [0] * (4 * nsupers))
+        tally = [0, 0, 0, 0]
+        self.exc = {}                # out-of-band char -> sorted rows
+        excRows, excChars = [], []
+        for i in xrange(0, self.n):
+            if i % self.SUPER_BASES == 0:
+                si = (i // self.SUPER_BASES) * 4
+                self.supers[si:si+4] = intArray(self.n, tally)
+                superTally = tally[:]
+            if i % self.BLOCK_BASES == 0:
+                base = (i // self.BLOCK_BASES) * self.BLOCK_WORDS
+                self.data[base] = sum((tally[k] - superTally[k]) << (k << 4) for k in xrange(0, 4))
+            c = bw[i]
+            code = self.codes.get(c)
+            if code is None:
+                if c not in self.exc:
+                    self.exc[c] = intArray(self.n)
+                self.exc[c].append(i)
+                excRows.append(i)
+                excChars.append(c)
+                continue
+            tally[code] += 1
+            if code != 0:
+                wi = base + 1 + ((i >> 5) & 15)
+                self.data[wi] |= code << ((i & 31) << 1)
+        self.excRows = intArray(self.n, excRows)
+        self.excChars = ''.join(excChars)
+    
+    def __len__(self):
+        return self.n
+    
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.n
+        if i < 0 or i >= self.n:
+            raise IndexError(i)
+        j = bisect_left(self.excRows, i)
+        if j < len(self.excRows) and self.excRows[j] == i:
+            return self.excChars[j]
+        w = int(self.data[(i >> 9) * self.BLOCK_WORDS + 1 + ((i >> 5) & 15)]) & self.MASK64
+        return 'ACGT'[(w >> ((i & 31) << 1)) & 3]
+    
+    def __iter__(self):
+        for i in xrange(0, self.n):
+            yield self[i]
+    
+    def rank(self, bw, c, row):
+        """ Return c's rank w/r/t 'row'.  bw is ignored; present so this is
+            a drop-in replacement for FmCheckpoints.rank. """
+        return self.rankCode(bw, ord(c), row)
+    
+    def rankCode(self, bw, b, row):
+        """ rank for the character with code b """
+        if row < 0:
+            return 0
+        code = self.dnaCode[b]
+        if code is None:
+            c = _chars[b]
+            if c not in self.exc:
+                return 0
+            return bisect_right(self.exc[c], row)
+        base = (row >> 9) * self.BLOCK_WORDS
+        nocc = int(self.supers[((row >> 16) << 2) + code]) + ((int(self.data[base]) >> (code << 4)) & 0xffff)
+        # data words up to row's, as one integer with the first word lowest
+        x = _wordsToInt(self.data[base + 1:base + 2 + ((row >> 5) & 15)]) ^ self.BLOCK_REPEATS[code]
+        # a field matches c iff both of its bits are now 0
+        match = ~(x | (x >> 1)) & self.BLOCK_LO_BITS & ((1 << (((row & 511) + 1) << 1)) - 1)
+        nocc += popcount(match)
+        if code == 0:
+            # out-of-band characters were packed as A; don't count them
+            blockStart = row & ~(self.BLOCK_BASES - 1)
+            nocc -= bisect_right(self.excRows, row) - bisect_left(self.excRows, blockStart)
+        return nocc
+    
+    def _npTables(self):
+        """ Return numpy views and lookup tables used by vectorized calls """
+        if getattr(self, '_tables', None) is None:
+            codes = numpy.full(256, -1, dtype=numpy.int64)
+            for c, code in self.codes.iteritems():
+                codes[ord(c)] = code
+            self._tables = (codes, npView(self.data).view(_u64), npView(self.supers),
+                            npView(self.excRows).astype(numpy.int64),
+                            numpy.frombuffer(self.excChars, dtype=numpy.uint8),
+                            dict((ord(c), npView(rows)) for c, rows in self.exc.iteritems()))
+        return self._tables
+    
+    def charsMany(self, rows):
+        """ Vectorized indexing: return BWT characters (as byte values) at
+            the given rows """
+        codes, data, _, excRows, excChars, _ = self._npTables()
+        rows = numpy.asarray(rows, dtype=numpy.int64)
+        w = data[(rows >> 9) * self.BLOCK_WORDS + 1 + ((rows >> 5) & 15)]
+        chars = numpy.frombuffer('ACGT', dtype=numpy.uint8)[((w >> ((rows & 31) << 1).astype(_u64)) & _u64(3)).astype(numpy.int64)]
+        if len(excRows) > 0:
+            j = numpy.searchsorted(excRows, rows)
+            jj = numpy.minimum(j, len(excRows) - 1)
+            hit = excRows[jj] == rows
+            chars[hit] = excChars[jj[hit]]
+        return chars
+    
+    def rankMany(self, bw, cs, rows):
+        """ Vectorized rank: given arrays of characters (as byte values) and
+            rows, return array of the characters' ranks w/r/t the rows """
+        codes, data, supers, excRows, _, exc = self._npTables()
+        cs, rows = numpy.asarray(cs, dtype=numpy.uint8), numpy.asarray(rows, dtype=numpy.int64)
+        ranks = numpy.zeros(len(rows), dtype=numpy.int64)
+        code = codes[cs]
+        inband = (rows >= 0) & (code >= 0)
+        row, code = rows[inband], code[inband]
+        base = (row >> 9) * self.BLOCK_WORDS
+        nocc = supers[((row >> 16) << 2) + code].astype(numpy.int64)
+        nocc += ((data[base] >> (code << 4).astype(_u64)) & _u64(0xffff)).astype(numpy.int64)
+        last = (row >> 5) & 15
+        shift = (((row & 31) + 1) << 1).astype(_u64)
+        partial = numpy.where(shift >= _u64(64), _u64(self.MASK64),
+                              (_u64(1) << numpy.minimum(shift, _u64(63))) - _u64(1))
+        rep = numpy.array(self.REPEATS, dtype=_u64)[code]
+        # order queries by decreasing last word so that those still needing
+        # word j are a prefix
+        order = numpy.argsort(-last, kind='mergesort')
+        base, last, partial, rep = base[order], last[order], partial[order], rep[order]
+        nwords = numpy.searchsorted(-last, -numpy.arange(0, 16), 'right')
+        scanned = numpy.zeros(len(order), dtype=numpy.int64)
+        for j0 in xrange(0, 16, 3):
+            # match words have only low bits of fields set, so up to 3 can
+            # be summed field-wise before counting
+            k = nwords[j0]
+            if k == 0:
+                break
+            fields = numpy.zeros(k, dtype=_u64)
+            for j in xrange(j0, min(j0 + 3, 16)):
+                kj = nwords[j]
+                x = data[base[:kj] + 1 + j] ^ rep[:kj]
+                match = ~(x | (x >> _u64(1))) & _u64(self.LO_BITS)
+                fields[:kj] += numpy.where(last[:kj] == j, match & partial[:kj], match)
+            scanned[:k] += popcountMany(fields, 2)
+        nocc[order] += scanned
+        # out-of-band characters were packed as A; don't count them
+        isA = code == 0
+        blockStart = row[isA] & ~(self.BLOCK_BASES - 1)
+        nocc[isA] -= numpy.searchsorted(excRows, row[isA], 'right') - numpy.searchsorted(excRows, blockStart, 'left')
+        ranks[inband] = nocc
+        for c, excc in exc.iteritems():
+            sel = (rows >= 0) & (cs == c)
+            ranks[sel] = numpy.searchsorted(excc, rows[sel], 'right')
+        return ranks
+    
+    def sections(self, prefix):
+        """ Return (name, array) pairs for saving to an index file """
+        secs = [ (prefix + 'data', self.data), (prefix + 'supers', self.supers),
+                 (prefix + 'excRows', self.excRows),
+                 (prefix + 'excChars', self.excChars) ]
+        return secs + [ (prefix + 'exc.' + str(ord(c)), rows) for c, rows in sorted(self.exc.iteritems()) ]
+    
+    @classmethod
+    def fromSections(cls, n, secs, prefix):
+        """ Rebuild from sections loaded from an index file """
+        bw = cls.__new__(cls)
+        bw.n = n
+        bw.data, bw.supers = secs[prefix + 'data'], secs[prefix + 'supers']
+        bw.excRows = secs[prefix + 'excRows']
+        bw.excChars = secs[prefix + 'excChars']
+        bw.exc = {}
+        for name, rows in secs.iteritems():
+            if name.startswith(prefix + 'exc.'):
+                bw.exc[chr(int(name[len(prefix) + 4:]))] = rows
+        return bw
+
+class RunLengthBwt(object):
+    """ BWT stored as its r runs, r-index style: run i holds character
+        chars[i] in rows [starts[i], starts[i+1]).  For each character c,
+        runs[c] lists the indexes of c's runs and cum[c][j] is the number of
+        c's in the first j of them, so a rank query is two binary searches.
+        SA values at the first and last row of each run are kept too, which
+        lets FmIndex locate occurrences with the toehold method and the phi
+        function.  Everything takes O(r) space.  Serves as both the BWT
+        and its rank structure, like DnaBwt. """
+    
+    def __init__(self, n, runs):
+        """ Build from BWT length n and runs as generated by bwtRuns """
+        self.n = n
+        starts, chars, startSa, endSa = [], [], [], []
+        for c, start, sas, sae in runs:
+            starts.append(start)
+            chars.append(c)
+            startSa.append(sas)
+            endSa.append(sae)
+        starts.append(n)
+        self.starts = intArray(n, starts)
+        self.chars = ''.join(chars)
+        self.startSa, self.endSa = intArray(n, startSa), intArray(n, endSa)
+        self.runs, self.cum = {}, {}
+        for i, c in enumerate(chars):
+            if c not in self.runs:
+                self.runs[c], self.cum[c] = intArray(n), intArray(n, [0])
+            self.runs[c].append(i)
+            self.cum[c].append(self.cum[c][-1] + starts[i+1] - starts[i])
+        # phi maps SA[row] to SA[row-1].  Sample it at run starts, sorted
+        # by SA value: phi(x) = phiVals[j] + x - phiKeys[j] for the
+        # largest phiKeys[j] <= x
+        phi = sorted((startSa[i], endSa[i-1]) for i in xrange(1, len(chars)))
+        self.phiKeys = intArray(n, [ k for k, _ in phi ])
+        self.phiVals = intArray(n, [ v for _, v in phi ])
+    
+    def __len__(self):
+        return self.n
+    
+    def numRuns(self):
+        return len(self.chars)
+    
+    def runOf(self, row):
+        """ Return index of run containing row """
+        return bisect_right(self.starts, row) - 1
+    
+    def __getitem__(self, row):
+        return self.chars[self.runOf(row)]
+    
+    def __iter__(self):
+        for i in xrange(0, len(self.chars)):
+            for _ in xrange(self.starts[i], self.starts[i+1]):
+                yield self.chars[i]
+    
+    def counts(self):
+        """ Return dict mapping each character to its number of occurrences """
+        return dict((c, int(cum[-1])) for c, cum in self.cum.iteritems())
+    
+    def rank(self, bw, c, row):
+        """ Return c's rank w/r/t 'row'.  bw is ignored; present so this is
+            a drop-in replacement for FmCheckpoints.rank. """
+        if row < 0 or c not in self.runs:
+            return 0
+        i = self.runOf(row)
+        nocc = int(self.cum[c][bisect_left(self.runs[c], i)])
+        if self.chars[i] == c:
+            nocc += row - int(self.starts[i]) + 1
+        return nocc
+    
+    def rankCode(self, bw, b, row):
+        """ rank for the character with code b """
+        return self.rank(bw, _chars[b], row)
+    
+    def lastRunBefore(self, c, i):
+        """ Return index of the last run of c before run i, or -1 """
+        j = bisect_left(self.runs.get(c, ()), i)
+        return int(self.runs[c][j-1]) if j > 0 else -1
+    
+    def phi(self, off):
+        """ Given SA[row] (row > 0), return SA[row-1] """
+        j = bisect_right(self.phiKeys, off) - 1
+        return int(self.phiVals[j]) + off - int(self.phiKeys[j])
+    
+    def _npTables(self):
+        if getattr(self, '_np', None) is None:
+            self._np = (npView(self.starts).astype(numpy.int64),
+                        numpy.frombuffer(self.chars, dtype=numpy.uint8),
+                        dict((ord(c), (npView(self.runs[c]).astype(numpy.int64), npView(self.cum[c]).astype(numpy.int64)))
+                             for c in self.runs))
+        return self._np
+    
+    def charsMany(self, rows):
+        """ Vectorized indexing: return BWT characters (as byte values) at
+            the given rows """
+        starts, chars, _ = self._npTables()
+        return chars[numpy.searchsorted(starts, numpy.asarray(rows, dtype=numpy.int64), 'right') - 1]
+    
+    def rankMany(self, bw, cs, rows):
+        """ Vectorized rank: given arrays of characters (as byte values) and
+            rows, return array of the characters' ranks w/r/t the rows """
+        starts, chars, runs = self._npTables()
+        cs, rows = numpy.asarray(cs, dtype=numpy.uint8), numpy.asarray(rows, dtype=numpy.int64)
+        ranks = numpy.zeros(len(rows), dtype=numpy.int64)
+        run = numpy.searchsorted(starts, numpy.maximum(rows, 0), 'right') - 1
+        for c, (cruns, cum) in runs.iteritems():
+            sel = (rows >= 0) & (cs == c)
+            nocc = cum[numpy.searchsorted(cruns, run[sel], 'left')]
+            inRun = chars[run[sel]] == c
+            nocc[inRun] += rows[sel][inRun] - starts[run[sel][inRun]] + 1
+            ranks[sel] = nocc
+        return ranks
+    
+    def sections(self, prefix):
+        """ Return (name, array) pairs for saving to an index file """
+        secs = [ (prefix + name, getattr(self, name))
+                 for name in ('starts', 'chars', 'startSa', 'endSa', 'phiKeys', 'phiVals') ]
+        for c in sorted(self.runs.iterkeys()):
+            secs += [ (prefix + 'runs.' + str(ord(c)), self.runs[c]),
+                      (prefix + 'cum.' + str(ord(c)), self.cum[c]) ]
+        return secs
+    
+    @classmethod
+    def fromSections(cls, n, secs, prefix):
+        """ Rebuild from sections loaded from an index file """
+        bw = cls.__new__(cls)
+        bw.n = n
+        for name in ('starts', 'chars', 'startSa', 'endSa', 'phiKeys', 'phiVals'):
+            setattr(bw, name, secs[prefix + name])
+        bw.runs, bw.cum = {}, {}
+        for name, a in secs.iteritems():
+            if name.startswith(prefix + 'runs.'):
+                bw.runs[chr(int(name[len(prefix) + 5:]))] = a
+            elif name.startswith(prefix + 'cum.'):
+                bw.cum[chr(int(name[len(prefix) + 4:]))] = a
+        return bw
 
-class FmIndex():
+class RunBoundarySample(object):
+    """ Suffix array sample holding the rows at either end of each run of a
+        RunLengthBwt, with the same interface as SuffixArraySample.  LF
+        walks from any row eventually reach a run boundary, if only the
+        row holding $, so FmIndex.resolve still works. """
     
-    def __init__(self, t=None, cpIval=4, ssaIval=4, sa=None):
+    def __init__(self, bw):
+        self.bw = bw
+    
+    def __contains__(self, row):
+        if row < 0 or row >= len(self.bw):
+            return False
+        starts, i = self.bw.starts, self.bw.runOf(row)
+        return row == starts[i] or row == starts[i+1] - 1
+    
+    def __getitem__(self, row):
+        starts, i = self.bw.starts, self.bw.runOf(row)
+        if row == starts[i]:
+            return int(self.bw.startSa[i])
+        if row == starts[i+1] - 1:
+            return int(self.bw.endSa[i])
+        raise KeyError(row)
+    
+    def lookupMany(self, rows):
+        """ Return boolean array saying which rows are sampled and array of
+            SA values (meaningful only where sampled) """
+        starts, _, _ = self.bw._npTables()
+        rows = numpy.asarray(rows, dtype=numpy.int64)
+        run = numpy.searchsorted(starts, rows, 'right') - 1
+        atStart, atEnd = rows == starts[run], rows == starts[run + 1] - 1
+        vals = numpy.where(atStart, npView(self.bw.startSa)[run], npView(self.bw.endSa)[run])
+        return atStart | atEnd, vals.astype(numpy.int64)
+
+class LocateCache(object):
+    """ Bounded map from BWM rows to fully resolved text offsets.  A row is
+        admitted once it has been resolved minHits times, so the cache
+        fills with rows that are hit often, e.g. occurrences of repeats. """
+    
+    def __init__(self, maxRows=100000, minHits=2):
+        self.maxRows, self.minHits = maxRows, minHits
+        self.offs = {} # cached row -> offset
+        self.hits = {} # row -> # times resolved, for rows not yet cached
+    
+    def get(self, row):
+        return self.offs.get(row)
+    
+    def record(self, row, off):
+        """ Note that row was resolved to off, caching it if hit enough """
+        if len(self.offs) >= self.maxRows:
+            return
+        nhits = self.hits.get(row, 0) + 1
+        if nhits >= self.minHits:
+            self.offs[row] = off
+            self.hits.pop(row, None)
+        else:
+            if len(self.hits) >= 4 * self.maxRows:
+                self.hits.clear() # forget stale counts
+            self.hits[row] = nhits
+
+class FmIndex(object):
+    
+    def __init__(self, t=None, cpIval=4, ssaIval=4, sa=None, dna=False, kmerLen=None, lcp=False, rle=False, budget=None):
+        """ Build FM index of t or of the text indexed by SuffixArray sa.
+            If dna is True, the BWT is stored 2-bit packed as a DnaBwt,
+            which also answers rank queries; cpIval is then unused.  If
+            kmerLen is set, a KmerTable maps every k-mer of that length to
+            its BWM range so searches can skip their first kmerLen steps.
+            If lcp is True, the LCP array is kept as LcpIntervals, which
+            matching_statistics and mems need.  If rle is True, the BWT is
+            stored run-length encoded as a RunLengthBwt, which also replaces
+            the checkpoints and SA sample, so the index takes space
+            proportional to the number of BWT runs; cpIval and ssaIval are
+            then unused.  If budget is set, t's suffix array is never held
+            in memory: suffixes are sorted in blocks of at most budget with
+            blockwiseSuffixArray and streamed straight into the BWT and SA
+            sample (not possible with kmerLen or lcp). """
         if t is not None and t[-1] != '$':
             t += '$'
         if t is None and sa is None:
             raise RuntimeError("Either t or sa must be specified")
-        if sa is None:
+        if dna and rle:
+            raise RuntimeError("dna and rle are mutually exclusive")
+        if budget is not None and (t is None or kmerLen is not None or lcp):
+            raise RuntimeError("budget requires t and can't be combined with kmerLen or lcp")
+        self.kmers = self.lcp = None
+        if rle:
+            if budget is not None:
+                runs = bwtRuns(t, blockwiseSuffixArray(t, budget))
+            else:
+                if sa is None:
+                    sa = SuffixArray(t)
+                runs = sa.toBwtRuns()
+                if kmerLen is not None:
+                    self.kmers = KmerTable(sa.s, sa.sa, kmerLen)
+                if lcp:
+                    self.lcp = LcpIntervals(sa.lcp if sa.lcp is not None else kasaiLcp(sa.s, sa.sa, sa.toIsa()))
+            self.bwt = self.cps = RunLengthBwt(len(t) if sa is None else sa.slen, runs)
+            self.ssa = RunBoundarySample(self.bwt)
+            self.dollarRow = int(self.bwt.starts[self.bwt.chars.index('$')])
+        elif budget is not None:
+            self.bwt, self.dollarRow, self.ssa = bwtAndSamples(t, blockwiseSuffixArray(t, budget), ssaIval)
+        elif sa is None:
             sa = suffixArray(t)
             self.bwt, self.dollarRow = bwtFromSa(t, sa)
             self.ssa = downsampleSuffixArray(sa, ssaIval)
+            if kmerLen is not None:
+                self.kmers = KmerTable(t, sa, kmerLen)
+            if lcp:
+                self.lcp = LcpIntervals(kasaiLcp(t, sa, SuffixArray(t, sa=sa).toIsa()))
         else:
             self.bwt, self.dollarRow = sa.toBwt()
-            self.ssa = {}
-            for off, sa in sa.sampleByRank(ssaIval):
-                self.ssa[off] = sa
+            self.ssa = SuffixArraySample(sa.slen, sa.sampleByRank(ssaIval))
+            if kmerLen is not None:
+                self.kmers = KmerTable(sa.s, sa.sa, kmerLen)
+            if lcp:
+                self.lcp = LcpIntervals(sa.lcp if sa.lcp is not None else kasaiLcp(sa.s, sa.sa, sa.toIsa()))
+        self.cpIval, self.ssaIval = cpIval, ssaIval
         self.slen = len(self.bwt)
-        self.cps = FmCheckpoints(self.bwt, cpIval)
+        self.fn = None # file the index was loaded from, if any
+        self.locateCache = self.stats = None
         # Calculate total # of each character
-        tots = dict()
-        for c in self.bwt:
-            tots[c] = tots.get(c, 0) + 1
+        if rle:
+            tots = self.bwt.counts()
+        else:
+            tots = dict()
+            for c in self.bwt:
+                tots[c] = tots.get(c, 0) + 1
+        if dna:
+            self.bwt = self.cps = DnaBwt(self.bwt)
+        elif not rle:
+            self.cps = FmCheckpoints(self.bwt, cpIval)
         # Calculate concise representation of first column
         self.first = {}
         totc = 0
         for c, count in sorted(tots.iteritems()):
             self.first[c] = totc
             totc += count
+        self.C = self._firstColumn()
     
     @classmethod
-    def fromString(cls, s, cpIval=4, ssaIval=4):
-        return cls(t=s + '$', cpIval=cpIval, ssaIval=ssaIval)
+    def fromString(cls, s, cpIval=4, ssaIval=4, dna=False, kmerLen=None, lcp=False, rle=False, budget=None):
+        return cls(t=s + '$', cpIval=cpIval, ssaIval=ssaIval, dna=dna, kmerLen=kmerLen, lcp=lcp, rle=rle, budget=budget)
     
     @classmethod
-    def fromSuffixArray(cls, sa, cpIval=4, ssaIval=4):
-        return cls(sa=sa, cpIval=cpIval, ssaIval=ssaIval)
+    def tuned(cls, s, memBudget, workload=None, locate=True):
+        """ Build index of s with the layout tuneLayout predicts is fastest
+            for workload within memBudget bytes.  The tuning report is kept
+            in the index's layout field. """
+        sa = SuffixArray(s + '$')
+        report = tuneLayout(s + '$', memBudget, workload, locate, sa=sa)
+        fm = cls(sa=sa, **report['layout'])
+        fm.layout = report
+        return fm
     
     @classmethod
-    def fromSuffixTree(cls, stree, cpIval=4, ssaIval=4):
-        return FmIndex.fromSuffixArray(SuffixArray.fromSuffixTree(stree), cpIval=cpIval, ssaIval=ssaIval)
+    def fromSuffixArray(cls, sa, cpIval=4, ssaIval=4, dna=False, kmerLen=None, lcp=False, rle=False):
+        return cls(sa=sa, cpIval=cpIval, ssaIval=ssaIval, dna=dna, kmerLen=kmerLen, lcp=lcp, rle=rle)
+    
+    @classmethod
+    def fromSuffixTree(cls, stree, cpIval=4, ssaIval=4, dna=False, kmerLen=None, lcp=False, rle=False):
+        return FmIndex.fromSuffixArray(SuffixArray.fromSuffixTree(stree), cpIval=cpIval, ssaIval=ssaIval, dna=dna, kmerLen=kmerLen, lcp=lcp, rle=rle)
+    
+    def save(self, fn):
+        """ Write index to file fn; see FmIndex.load """
+        meta, sections = self._metaAndSections()
+        writeIndexFile(fn, 'FmIndex', meta, sections)
+    
+    def _metaAndSections(self):
+        """ Return metadata dict and list of (name, data) sections to save """
+        meta = { 'slen': self.slen, 'dollarRow': self.dollarRow,
+                 'cpIval': self.cpIval, 'ssaIval': self.ssaIval,
+                 'dna': isinstance(self.bwt, DnaBwt),
+                 'rle': isinstance(self.bwt, RunLengthBwt),
+                 'first': [ (ord(c), n) for c, n in sorted(self.first.iteritems()) ] }
+        if meta['dna']:
+            sections = self.bwt.sections('dna.')
+        elif meta['rle']:
+            sections = self.bwt.sections('rle.')
+        else:
+            sections = [ ('bwt', self.bwt) ] + self.cps.sections('cp.')
+        if not meta['rle']:
+            sections += self.ssa.sections('ssa.')
+        if self.kmers is not None:
+            meta['kmers'] = self.kmers.meta()
+            sections += self.kmers.sections('kmer.')
+        if self.lcp is not None:
+            meta['lcp'] = self.lcp.meta()
+            sections += self.lcp.sections('lcp.')
+        return meta, sections
+    
+    @classmethod
+    def load(cls, fn, mmap=True):
+        """ Load index saved with FmIndex.save.  With mmap=True the BWT,
+            checkpoints and SA samples are memory-mapped rather than read,
+            so loading takes roughly constant time and processes loading
+            the same file share one copy in the page cache. """
+        meta, secs = readIndexFile(fn, 'FmIndex', useMmap=mmap)
+        fm = cls._fromMetaAndSections(meta, secs)
+        fm.fn = fn
+        return fm
+    
+    @classmethod
+    def _fromMetaAndSections(cls, meta, secs):
+        """ Rebuild index from what _metaAndSections returned """
+        fm = cls.__new__(cls)
+        fm.fn = None
+        fm.locateCache = fm.stats = None
+        fm.slen, fm.dollarRow = meta['slen'], meta['dollarRow']
+        fm.cpIval, fm.ssaIval = meta['cpIval'], meta['ssaIval']
+        fm.first = dict((chr(c), n) for c, n in meta['first'])
+        fm.C = fm._firstColumn()
+        if meta.get('rle'):
+            fm.bwt = fm.cps = RunLengthBwt.fromSections(fm.slen, secs, 'rle.')
+            fm.ssa = RunBoundarySample(fm.bwt)
+        else:
+            if meta['dna']:
+                fm.bwt = fm.cps = DnaBwt.fromSections(fm.slen, secs, 'dna.')
+            else:
+                fm.bwt = secs['bwt']
+                fm.cps = FmCheckpoints.fromSections(fm.cpIval, secs, 'cp.')
+            fm.ssa = SuffixArraySample.fromSections(fm.slen, secs, 'ssa.')
+        fm.kmers = None
+        if 'kmers' in meta:
+            fm.kmers = KmerTable.fromSections(meta['kmers'], secs, 'kmer.')
+        fm.lcp = None
+        if 'lcp' in meta:
+            fm.lcp = LcpIntervals.fromSections(meta['lcp'], secs, 'lcp.')
+        return fm
+    
+    def _firstColumn(self):
+        """ Return dense C-array over character codes: C[b] is the number
+            of text characters with codes less than b, C[256] the total """
+        C = [self.slen] * 257
+        for b in xrange(255, -1, -1):
+            C[b] = self.first.get(_chars[b], C[b+1])
+        return C
     
     def count(self, c):
         """ Count number of occurrences of characters < c """
-        if c not in self.first:
-            for cc in sorted(self.first.iterkeys()):
-                if c < cc:
-                    return self.first[cc]
-            return self.first[cc]
-        else: return self.first[c]
+        return self.C[ord(c)]
     
     def range(self, p):
         """ Return the range of BWM rows having p as a prefix """
-        l, r = 0, self.slen - 1
-        for i in xrange(len(p)-1, -1, -1):
-            c = p[i]
-            l, r = self.nextRange(l, r+1, c)
-            r -= 1
-            if r < l:
+        l, r = 0, self.slen
+        start = len(p) - 1
+        if self.kmers is not None and len(p) >= self.kmers.k:
+            # Look up range of p's last k characters
+            bounds = self.kmers.interval(p[len(p)-self.kmers.k:])
+            if bounds is not None:
+                l, r = bounds
+                start -= self.kmers.k
+                if r <= l:
+                    return l, r
+        # Backward search on character codes
+        codes, cps, bw, C = bytearray(p), self.cps, self.bwt, self.C
+        i = start + 1
+        for i in xrange(start, -1, -1):
+            b = codes[i]
+            l = cps.rankCode(bw, b, l-1) + C[b]
+            r = cps.rankCode(bw, b, r-1) + C[b]
+            if r <= l:
                 break
-        return l, r+1
+        if self.stats is not None:
+            self.stats.add('rank', 2 * (start + 1 - i))
+            self.stats.record('rangeRank', 2 * (start + 1 - i))
+        return l, r
     
     def nextRange(self, l, r, c):
         ''' If l, r is a right-open range of BWM rows having p as a
             prefix, this returns newl, newr, a right-open range of BWM
             rows with c + p as a prefix.  '''
-        l = self.cps.rank(self.bwt, c, l-1) + self.count(c)
-        r = self.cps.rank(self.bwt, c, r-1) + self.count(c)
+        return self._nextRangeCode(l, r, ord(c))
+    
+    def _nextRangeCode(self, l, r, b):
+        """ nextRange for the character with code b """
+        l = self.cps.rankCode(self.bwt, b, l-1) + self.C[b]
+        r = self.cps.rankCode(self.bwt, b, r-1) + self.C[b]
+        if self.stats is not None:
+            self.stats.add('rank', 2)
         return l, r
     
     def stepLeft(self, row, c=None):
         """ Step left according to character in given BWT row """
         assert row < len(self.bwt)
         if c is None: c = self.bwt[row]
-        return self.cps.rank(self.bwt, c, row-1) + self.count(c)
+        b = ord(c)
+        if self.stats is not None:
+            self.stats.add('rank')
+        return self.cps.rankCode(self.bwt, b, row-1) + self.C[b]
+    
+    def enableLocateCache(self, maxRows=100000, minHits=2):
+        """ Cache full resolutions of up to maxRows rows that are resolved
+            at least minHits times; see LocateCache """
+        self.locateCache = LocateCache(maxRows, minHits)
+    
+    def enableStats(self, stats=None):
+        """ Start counting rank calls, LF steps and (with FmCheckpoints)
+            rank scan steps in stats (a new QueryStats if None), which is
+            returned.  Set self.stats and self.cps.stats to None to stop. """
+        self.stats = stats if stats is not None else QueryStats()
+        if isinstance(self.cps, FmCheckpoints):
+            self.cps.stats = self.stats
+        return self.stats
     
     def resolve(self, row):
         """ Given BWM row, return its offset w/r/t T """
-        nsteps = 0
+        cache = self.locateCache
+        if cache is not None:
+            off = cache.get(row)
+            if off is not None:
+                return off
+        origRow, nsteps = row, 0
         while row not in self.ssa:
             row = self.stepLeft(row)
             nsteps += 1
-        return self.ssa[row] + nsteps
+        off = self.ssa[row] + nsteps
+        if cache is not None:
+            cache.record(origRow, off)
+        if self.stats is not None:
+            self.stats.record('resolveLf', nsteps)
+        return off
+    
+    def resolveRange(self, l, r):
+        """ Resolve all BWM rows in [l, r) together and return their
+            offsets as a sorted numpy array.  Rows are walked left in
+            lockstep; a walk that reaches a row some other walk has already
+            visited stops there and takes its offset from that walk, so
+            rows that converge (as in repeats) share the remaining work. """
+        n = max(r - l, 0)
+        cache = self.locateCache
+        offs = [None] * n
+        link = [None] * n # walk i stopped on walk j's path: (j, offset diff)
+        cur = range(l, l + n)
+        visited = dict((row, (i, 0)) for i, row in enumerate(cur))
+        nsteps = [0] * n
+        active = range(0, n)
+        while len(active) > 0:
+            stillActive = []
+            for i in active:
+                row = cur[i]
+                if cache is not None:
+                    off = cache.get(row)
+                    if off is not None:
+                        offs[i] = off + nsteps[i]
+                        continue
+                if row in self.ssa:
+                    offs[i] = self.ssa[row] + nsteps[i]
+                    continue
+                row = self.stepLeft(row)
+                nsteps[i] += 1
+                if row in visited:
+                    j, jsteps = visited[row]
+                    link[i] = (j, nsteps[i] - jsteps)
+                    continue
+                visited[row] = (i, nsteps[i])
+                cur[i] = row
+                stillActive.append(i)
+            active = stillActive
+        # Follow links; each ends at a walk that reached a sample
+        for i in xrange(0, n):
+            chain = []
+            while offs[i] is None:
+                chain.append(i)
+                i, _ = link[i]
+            off = offs[i]
+            for k in reversed(chain):
+                off += link[k][1]
+                offs[k] = off
+        if cache is not None:
+            for i in xrange(0, n):
+                cache.record(l + i, offs[i])
+        if self.stats is not None:
+            self.stats.record('resolveRangeLf', sum(nsteps))
+        return numpy.sort(numpy.array(offs, dtype=numpy.int64))
+    
+    def _countTable(self):
+        """ Return array giving count(c) for every byte value c """
+        return numpy.array(self.C[:256], dtype=numpy.int64)
+    
+    def bwtMany(self, rows):
+        """ Return BWT characters (as byte values) at the given rows """
+        if isinstance(self.bwt, (DnaBwt, RunLengthBwt)):
+            return self.bwt.charsMany(rows)
+        return numpy.frombuffer(self.bwt, dtype=numpy.uint8)[rows]
+    
+    def range_many(self, patterns):
+        """ Like range, but for a list of patterns at once.  Every active
+            pattern's interval is advanced together, one character column
+            per step, using vectorized rank queries.  Returns numpy arrays
+            ls, rs where ls[i], rs[i] is the range for patterns[i]. """
+        n = len(patterns)
+        lens = numpy.array([ len(p) for p in patterns ], dtype=numpy.int64)
+        maxlen = int(lens.max()) if n > 0 else 0
+        if maxlen > 0 and (lens == maxlen).all():
+            mat = numpy.frombuffer(''.join(patterns), dtype=numpy.uint8).reshape((n, maxlen))
+        else:
+            mat = numpy.zeros((n, maxlen), dtype=numpy.uint8)
+            for i, p in enumerate(patterns):
+                mat[i, :len(p)] = numpy.frombuffer(p, dtype=numpy.uint8)
+        counts = self._countTable()
+        ls = numpy.zeros(n, dtype=numpy.int64)
+        rs = numpy.full(n, self.slen, dtype=numpy.int64)
+        skip = numpy.zeros(n, dtype=numpy.int64) # chars handled by k-mer table
+        if self.kmers is not None and maxlen >= self.kmers.k:
+            k, sigma = self.kmers.k, len(self.kmers.alph)
+            digit = numpy.full(256, -1, dtype=numpy.int64)
+            for c, d in self.kmers.digit.iteritems():
+                digit[ord(c)] = d
+            cols = numpy.maximum(lens[:, None] - k + numpy.arange(k)[None, :], 0)
+            digits = digit[mat[numpy.arange(n)[:, None], cols]]
+            use = numpy.nonzero((lens >= k) & (digits >= 0).all(axis=1))[0]
+            codes = (digits[use] * (sigma ** numpy.arange(k-1, -1, -1))).sum(axis=1)
+            ls[use] = npView(self.kmers.l)[codes]
+            rs[use] = npView(self.kmers.r)[codes]
+            skip[use] = k
+        for k in xrange(0, maxlen):
+            col = lens - 1 - skip - k # column holding each pattern's next char
+            act = numpy.nonzero((col >= 0) & (rs > ls))[0]
+            if len(act) == 0:
+                break
+            cs = mat[act, col[act]]
+            ls[act] = self.cps.rankMany(self.bwt, cs, ls[act] - 1) + counts[cs]
+            rs[act] = self.cps.rankMany(self.bwt, cs, rs[act] - 1) + counts[cs]
+        return ls, rs
+    
+    def resolve_many(self, rows):
+        """ Like resolve, but for an array of rows at once.  Returns numpy
+            array of offsets.  A walk that reaches another of the given
+            rows stops and takes its offset from that row's walk. """
+        rows = numpy.array(rows, dtype=numpy.int64)
+        n = len(rows)
+        offs = numpy.zeros(n, dtype=numpy.int64)
+        nsteps = numpy.zeros(n, dtype=numpy.int64)
+        link = numpy.full(n, -1, dtype=numpy.int64)
+        order = numpy.argsort(rows, kind='mergesort')
+        sortedRows = rows[order]
+        pending = numpy.arange(n)
+        counts = self._countTable()
+        while len(pending) > 0:
+            hit, vals = self.ssa.lookupMany(rows[pending])
+            done = pending[hit]
+            offs[done] = vals[hit] + nsteps[done]
+            pending = pending[~hit]
+            cur = rows[pending]
+            cs = self.bwtMany(cur)
+            rows[pending] = self.cps.rankMany(self.bwt, cs, cur - 1) + counts[cs]
+            nsteps[pending] += 1
+            # Stop walks that reached one of the original rows
+            j = numpy.minimum(numpy.searchsorted(sortedRows, rows[pending]), n - 1)
+            conv = sortedRows[j] == rows[pending]
+            link[pending[conv]] = order[j[conv]]
+            pending = pending[~conv]
+        # Resolve linked walks; chains are shorter than ssaIval
+        linked = numpy.nonzero(link >= 0)[0]
+        while len(linked) > 0:
+            ready = link[link[linked]] < 0
+            done = linked[ready]
+            offs[done] = offs[link[done]] + nsteps[done]
+            link[done] = -1
+            linked = linked[~ready]
+        return offs
+    
+    def occurrences_many(self, patterns):
+        """ Like occurrences, but for a list of patterns at once.  Returns
+            numpy arrays offs, ptr; offsets of patterns[i]'s occurrences are
+            offs[ptr[i]:ptr[i+1]], in no particular order. """
+        ls, rs = self.range_many(patterns)
+        nocc = numpy.maximum(rs - ls, 0)
+        ptr = numpy.zeros(len(patterns) + 1, dtype=numpy.int64)
+        numpy.cumsum(nocc, out=ptr[1:])
+        rows = numpy.repeat(ls - ptr[:-1], nocc) + numpy.arange(ptr[-1])
+        return self.resolve_many(rows), ptr
     
     def hasSubstring(self, p):
         """ Return true if and only if p is substring of indexed text """
@@ -191,15 +1081,626 @@ class FmIndex():
         return r > l
     
     def hasSuffix(self, p):
-        """ Return true if and only if p is suffix of indexed text """
+        """ Return true if and only if p is suffix of indexed text, i.e.
+            p + '$' occurs; that's one more backward step, on $, and no
+            offsets are resolved """
+        l, r = self.range(p + '$')
+        return r > l
+    
+    def count_occurrences(self, p):
+        """ Return number of occurrences of p, without resolving any
+            offsets """
         l, r = self.range(p)
-        off = self.resolve(l)
-        return r > l and off + len(p) == self.slen-1
+        return max(r - l, 0)
+    
+    def count_occurrences_many(self, patterns):
+        """ Like count_occurrences, but for a list of patterns at once;
+            returns numpy array of counts """
+        ls, rs = self.range_many(patterns)
+        counts = numpy.maximum(rs - ls, 0)
+        # "" occurs at every offset, $ included, as in count_occurrences
+        counts[numpy.array([ len(p) == 0 for p in patterns ], dtype=bool)] = self.slen
+        return counts
     
     def occurrences(self, p):
-        """ Return offsets for all occurrences of p, in no particular order """
+        """ Return sorted numpy array of offsets of all occurrences of p """
+        if isinstance(self.bwt, RunLengthBwt):
+            return self._occurrencesRle(p)
         l, r = self.range(p)
-        return [ self.resolve(x) for x in xrange(l, r) ]
+        return self.resolveRange(l, r)
+    
+    def _occurrencesRle(self, p):
+        """ r-index locate.  Backward search keeps the SA value of the last
+            row in range (the toehold): if that row's BWT char is the next
+            char c, LF maps it to the new last row; otherwise the last c in
+            range ends a run, whose SA value is stored.  The other rows'
+            offsets follow from the toehold by repeated phi. """
+        bw = self.bwt
+        l, r = 0, self.slen
+        off = int(bw.endSa[bw.numRuns() - 1])
+        for i in xrange(len(p) - 1, -1, -1):
+            c = p[i]
+            run = bw.runOf(r - 1)
+            # stepping left from offset 0 wraps around to $ at slen-1
+            if bw.chars[run] == c:
+                off = (off - 1) % self.slen
+            else:
+                j = bw.lastRunBefore(c, run)
+                if j < 0:
+                    return numpy.zeros(0, dtype=numpy.int64)
+                off = (int(bw.endSa[j]) - 1) % self.slen
+            l, r = self.nextRange(l, r, c)
+            if r <= l:
+                return numpy.zeros(0, dtype=numpy.int64)
+        offs = numpy.zeros(r - l, dtype=numpy.int64)
+        for i in xrange(r - l - 1, -1, -1):
+            offs[i] = off
+            if i > 0:
+                off = bw.phi(off)
+        return numpy.sort(offs)
+    
+    def _matchIntervals(self, p):
+        """ Generate (j, ln, l, r) for j from len(p)-1 down to 0, where ln
+            is the length of the longest prefix of p[j:] occurring in the
+            text and [l, r) is its range of BWM rows.  Backward search
+            extends the previous match to the left; when that fails, the
+            match is cut back to its parent lcp-interval and retried. """
+        if self.lcp is None:
+            raise RuntimeError("Index has no LCP intervals; build it with lcp=True")
+        l, r, ln = 0, self.slen, 0
+        codes, C = bytearray(p), self.C
+        for j in xrange(len(p) - 1, -1, -1):
+            b = codes[j]
+            if C[b] == C[b+1]:
+                l, r, ln = 0, self.slen, 0 # no match can span p[j]
+            else:
+                while True:
+                    nl, nr = self._nextRangeCode(l, r, b)
+                    if nl < nr:
+                        l, r, ln = nl, nr, ln + 1
+                        break
+                    if ln == 0:
+                        break
+                    ln, l, r = self.lcp.parent(l, r)
+            yield j, ln, l, r
+    
+    def matching_statistics(self, p):
+        """ For each i, return length of the longest suffix of p[:i+1] that
+            occurs in the text, as SuffixTree.mems does """
+        lens = [0] * len(p)
+        for j, ln, _, _ in self._matchIntervals(p):
+            lens[j] = ln
+        return self._endDepths(lens)
+    
+    @staticmethod
+    def _endDepths(lens):
+        """ Convert lengths of longest matches starting at each offset to
+            lengths of longest matches ending at each offset """
+        depths = []
+        j = 0 # leftmost start of a match reaching i
+        for i in xrange(0, len(lens)):
+            while j <= i and j + lens[j] <= i:
+                j += 1
+            depths.append(i + 1 - j)
+        return depths
+    
+    def mems(self, p, l=4):
+        """ Find maximal exact matches (MEMs) of length at least l between
+            the text and p.  Returns sorted list of (text offset, pattern
+            offset, length) tuples and the matching statistics of p, as
+            SuffixTree.mems does.  Rows of the longest match starting at
+            each pattern offset match exactly that far; going up through
+            parent lcp-intervals, rows gained at each level match exactly
+            as far as that level's depth.  A row is left-maximal iff its
+            BWT character differs from the preceding pattern character. """
+        rows, poffs, lens = [], [], []
+        msLens = [0] * len(p)
+        for j, ln, lo, hi in self._matchIntervals(p):
+            msLens[j] = ln
+            cp = p[j-1] if j > 0 else None
+            a, b, d = hi, hi, ln
+            while d >= l:
+                for row in xrange(lo, a):
+                    if self.bwt[row] != cp:
+                        rows.append(row); poffs.append(j); lens.append(d)
+                for row in xrange(b, hi):
+                    if self.bwt[row] != cp:
+                        rows.append(row); poffs.append(j); lens.append(d)
+                a, b = lo, hi
+                d, lo, hi = self.lcp.parent(lo, hi)
+        offs = self.resolve_many(rows) if len(rows) > 0 else []
+        mems = sorted(zip(map(int, offs), poffs, lens))
+        return mems, self._endDepths(msLens)
+
+def _layoutBytes(n, counts, nruns, layout):
+    """ Predict bytes taken by the BWT, rank structure, SA sample and k-mer
+        table of an FmIndex with the given layout, over a text of length n
+        (including $) having the given character counts and nruns BWT runs """
+    isz = intArray(n).itemsize
+    if layout['rle']:
+        # starts, SA at run ends, phi samples, per-character runs and cum
+        nbytes = nruns + isz * (7 * nruns - 1 + len(counts))
+    else:
+        if layout['dna']:
+            nexc = sum([ cnt for c, cnt in counts.iteritems() if c not in DnaBwt.codes ])
+            nblocks = (n + DnaBwt.BLOCK_BASES - 1) // DnaBwt.BLOCK_BASES
+            nsupers = (n + DnaBwt.SUPER_BASES - 1) // DnaBwt.SUPER_BASES
+            nbytes = nblocks * DnaBwt.BLOCK_WORDS * array('L').itemsize + 4 * nsupers * isz
+            nbytes += nexc * (2 * isz + 1)
+        else:
+            nbytes = n + len(counts) * isz * ((n + layout['cpIval'] - 1) // layout['cpIval'])
+        nwords = (n + 31) >> 5
+        nsamples = (n + layout['ssaIval'] - 1) // layout['ssaIval']
+        nbytes += 4 * nwords + nwords * intArray(nsamples).itemsize + nsamples * isz
+    if layout['kmerLen'] is not None:
+        nbytes += 2 * isz * (len(counts) - 1) ** layout['kmerLen']
+    return nbytes
+
+def _workloadSteps(sa, patterns):
+    """ Given a SuffixArray, return lists giving, for each pattern, the
+        number of backward-search steps FmIndex.range takes (it stops once
+        the range empties) and the number of occurrences """
+    steps, occs = [], []
+    for p in patterns:
+        # Find longest suffix of p that occurs; suffixes of it occur too
+        lo, hi = 0, len(p)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if sa.hasSubstring(p[mid:]):
+                hi = mid
+            else:
+                lo = mid + 1
+        steps.append(len(p) if lo == 0 else len(p) - lo + 1)
+        l, r = sa.range(p) if lo == 0 and len(p) > 0 else (0, 0)
+        occs.append(max(r - l, 0))
+    return steps, occs
+
+def _calibrate(t, m=1 << 14, ncalls=2000, seed=0):
+    """ Time query primitives on FM indexes of a length-m prefix of t, one
+        per layout family.  Returns dict mapping 'cp1', 'cp64', 'dna' and
+        'rle' to (secs per backward-search step, secs per LF step taken by
+        resolve), plus 'phi' giving secs per phi step of an rle index,
+        'toehold' giving the extra secs per backward-search step an rle
+        index spends tracking the toehold when locating, and 'occ' giving
+        secs per row resolveRange spends on bookkeeping. """
+    import random
+    import time
+    rnd = random.Random(seed)
+    u = t[:min(m, len(t) - 1)] + '$'
+    sa = SuffixArray(u)
+    pats = []
+    for _ in xrange(0, ncalls // 16):
+        i = rnd.randint(0, max(len(u) - 17, 0))
+        pats.append(u[i:i+16].rstrip('$'))
+    nsteps = sum([ len(p) for p in pats ])
+    rows = [ rnd.randint(0, len(u) - 1) for _ in xrange(0, ncalls) ]
+    def secs(fn, args):
+        best = None
+        for _ in xrange(0, 3):
+            st = time.time()
+            for a in args:
+                fn(a)
+            el = (time.time() - st) / max(len(args), 1)
+            best = el if best is None else min(best, el)
+        return best
+    cal = {}
+    for name, fm in (('cp1', FmIndex(sa=sa, cpIval=1)), ('cp64', FmIndex(sa=sa, cpIval=64)),
+                     ('dna', FmIndex(sa=sa, dna=True)), ('rle', FmIndex(sa=sa, rle=True))):
+        cal[name] = (secs(fm.range, pats) * len(pats) / nsteps, secs(fm.stepLeft, rows))
+        if name == 'rle':
+            offs = [ sa.sa[row] for row in rows if row > 0 ]
+            cal['phi'] = secs(fm.bwt.phi, offs)
+            # Locating also tracks the toehold at every step; that's what's
+            # left of its time after the search steps and phi steps
+            nphi = sum([ max(r - l - 1, 0) for l, r in map(fm.range, pats) ])
+            locSecs = secs(fm._occurrencesRle, pats) * len(pats) - nphi * cal['phi']
+            cal['toehold'] = max(locSecs / nsteps - cal['rle'][0], 0.0)
+    # With every row sampled, resolveRange takes no LF steps
+    fm, width = FmIndex(sa=sa, ssaIval=1), min(32, len(u))
+    cal['occ'] = secs(lambda l: fm.resolveRange(l, l + width), [ min(row, len(u) - width) for row in rows[:ncalls // width] ]) / width
+    return cal
+
+def tuneLayout(t, memBudget, workload=None, locate=True, sa=None,
+               cpIvals=tuple(1 << i for i in xrange(0, 11)),
+               ssaIvals=tuple(1 << i for i in xrange(0, 11)),
+               kmerLens=(None, 4, 6, 8, 10, 12), calibration=None):
+    """ Choose the FmIndex layout (BWT representation, cpIval, ssaIval and
+        k-mer table length) with the lowest predicted time per query among
+        those whose predicted size is at most memBudget bytes.  workload is
+        a sample of query patterns; by default, 200 substrings of t of
+        length 20.  Queries find occurrences if locate is True or just
+        ranges otherwise.  Step counts come from t's suffix array (sa, if
+        given); the time per step of each layout comes from calibration
+        (see _calibrate), measured on a prefix of t if None.  Returns dict
+        with the chosen 'layout' (keyword arguments for FmIndex),
+        'predictedBytes', 'predictedSecsPerQuery', workload summary and
+        the 'frontier' of layouts no other layout beats in both size and
+        time. """
+    import random
+    if t[-1] != '$':
+        t += '$'
+    n = len(t)
+    if sa is None:
+        sa = SuffixArray(t)
+    elif not isinstance(sa, SuffixArray):
+        sa = SuffixArray(t, sa=sa)
+    if workload is None:
+        rnd = random.Random(0)
+        workload = [ t[i:i+20] for i in (rnd.randint(0, max(n - 21, 0)) for _ in xrange(0, 200)) ]
+    if len(workload) == 0:
+        raise RuntimeError("Workload is empty")
+    counts = {}
+    for c in t:
+        counts[c] = counts.get(c, 0) + 1
+    nruns, last = 0, None
+    for off in sa.sa:
+        c = t[off - 1] if off > 0 else '$'
+        if c != last:
+            nruns, last = nruns + 1, c
+    steps, occs = _workloadSteps(sa, workload)
+    if calibration is None:
+        calibration = _calibrate(t)
+    cal = calibration
+    candidates = []
+    for rle in (False, True):
+        for dna in ((False,) if rle else (False, True)):
+            for cpIval in (cpIvals if not dna and not rle else (4,)):
+                for ssaIval in (ssaIvals if not rle else (4,)):
+                    # the rle locate path doesn't use a k-mer table
+                    for k in (kmerLens if not rle or not locate else (None,)):
+                        if k is not None and (len(counts) - 1) ** k >= (1 << 31):
+                            continue
+                        layout = { 'cpIval': cpIval, 'ssaIval': ssaIval, 'dna': dna, 'rle': rle, 'kmerLen': k }
+                        if rle:
+                            stepSecs, lfSecs = cal['rle']
+                            if locate:
+                                stepSecs += cal['toehold']
+                        elif dna:
+                            stepSecs, lfSecs = cal['dna']
+                        else:
+                            # time grows with the characters rank scans, (cpIval-1)/2 on average
+                            frac = (cpIval - 1) / 63.0
+                            stepSecs = cal['cp1'][0] + max(cal['cp64'][0] - cal['cp1'][0], 0) * frac
+                            lfSecs = cal['cp1'][1] + max(cal['cp64'][1] - cal['cp1'][1], 0) * frac
+                        tot = 0.0
+                        for nstep, nocc in izip(steps, occs):
+                            if k is not None:
+                                nstep = max(nstep - k, 0)
+                            tot += nstep * stepSecs
+                            if locate and nocc > 0:
+                                tot += (nocc - 1) * cal['phi'] if rle else nocc * (cal['occ'] + (ssaIval - 1) / 2.0 * lfSecs)
+                        candidates.append((tot / len(workload), _layoutBytes(n, counts, nruns, layout), layout))
+    fits = [ cand for cand in candidates if cand[1] <= memBudget ]
+    if len(fits) == 0:
+        raise RuntimeError("No layout fits in %d bytes; smallest takes %d" % (memBudget, min([ b for _, b, _ in candidates ])))
+    secs, nbytes, layout = min(fits, key=lambda cand: (cand[0], cand[1]))
+    frontier, best = [], None
+    for cost, size, lay in sorted(candidates, key=lambda cand: (cand[1], cand[0])):
+        if best is None or cost < best:
+            frontier.append({ 'layout': lay, 'predictedBytes': size, 'predictedSecsPerQuery': cost })
+            best = cost
+    return { 'layout': layout, 'predictedBytes': nbytes, 'predictedSecsPerQuery': secs,
+             'bytesPerBase': nbytes / float(n), 'memBudget': memBudget,
+             'workload': { 'queries': len(workload), 'locate': locate,
+                           'meanSteps': sum(steps) / float(len(steps)),
+                           'meanOccurrences': sum(occs) / float(len(occs)) },
+             'runs': nruns, 'calibration': cal, 'frontier': frontier }
+
+def searchSchemes(k):
+    """ Return search schemes for up to k errors with the pattern split into
+        k+1 pieces.  Search s covers the error distributions whose first
+        error-free piece is s: it matches piece s exactly, extends right
+        through pieces s+1..k with at most k-s errors, then left through
+        pieces s-1..0, each of which must hold an error.  Each scheme is
+        (order, L, U), where L[i] and U[i] bound the total errors once the
+        first i+1 pieces in order are matched. """
+    schemes = []
+    for s in xrange(0, k + 1):
+        order = [s] + range(s + 1, k + 1) + range(s - 1, -1, -1)
+        L = [0] * (k + 1 - s) + [ s - j for j in xrange(s - 1, -1, -1) ]
+        U = [0] + [k - s] * (k - s) + [ k - j for j in xrange(s - 1, -1, -1) ]
+        schemes.append((order, L, U))
+    return schemes
+
+class BidirectionalFmIndex(object):
+    """ FM indexes of a text and of its reverse, searched in step.  An
+        interval (lf, lr, n) stands for the n occurrences of a string P: BWM
+        rows [lf, lf+n) of the forward index and rows [lr, lr+n) of the
+        reverse index, which have P and reverse(P) as prefixes.  P can be
+        extended on either side in O(sigma) rank queries. """
+    
+    def __init__(self, t, cpIval=4, ssaIval=4, dna=False):
+        """ Build forward and reverse FM indexes of t (without '$') """
+        self.fwd = FmIndex.fromString(t, cpIval=cpIval, ssaIval=ssaIval, dna=dna)
+        # Only the forward index resolves offsets, so sample the reverse
+        # index's SA as sparsely as possible
+        self.rev = FmIndex.fromString(t[::-1], cpIval=cpIval, ssaIval=len(t) + 1, dna=dna)
+        self.alph = sorted(self.fwd.first.iterkeys())
+    
+    def fullInterval(self):
+        """ Interval of the empty string """
+        return (0, 0, self.fwd.slen)
+    
+    def _extendAll(self, fm, l, r):
+        """ For BWM range [l, r) of fm, return (c, newl, nsmaller, occ) for
+            each character c: c + P's range starts at newl, occ rows of [l,
+            r) hold c and nsmaller hold characters less than c """
+        res, nsmaller = [], 0
+        for c in self.alph:
+            rl = fm.cps.rank(fm.bwt, c, l - 1)
+            occ = fm.cps.rank(fm.bwt, c, r - 1) - rl
+            res.append((c, fm.count(c) + rl, nsmaller, occ))
+            nsmaller += occ
+        return res
+    
+    def extendLeftAll(self, iv):
+        """ Return (c, interval of c + P) for each c such that c + P occurs,
+            where iv is the interval of P """
+        lf, lr, n = iv
+        return [ (c, (newl, lr + nsmaller, occ))
+                 for c, newl, nsmaller, occ in self._extendAll(self.fwd, lf, lf + n)
+                 if occ > 0 and c != '$' ]
+    
+    def extendRightAll(self, iv):
+        """ Return (c, interval of P + c) for each c such that P + c occurs,
+            where iv is the interval of P """
+        lf, lr, n = iv
+        return [ (c, (lf + nsmaller, newl, occ))
+                 for c, newl, nsmaller, occ in self._extendAll(self.rev, lr, lr + n)
+                 if occ > 0 and c != '$' ]
+    
+    def extendLeft(self, iv, c):
+        """ Return interval of c + P given interval iv of P """
+        for cc, civ in self.extendLeftAll(iv):
+            if cc == c:
+                return civ
+        return (0, 0, 0)
+    
+    def extendRight(self, iv, c):
+        """ Return interval of P + c given interval iv of P """
+        for cc, civ in self.extendRightAll(iv):
+            if cc == c:
+                return civ
+        return (0, 0, 0)
+    
+    def range(self, p):
+        """ Return interval of p, found by extending right from the empty
+            string; same forward rows as FmIndex.range """
+        iv = self.fullInterval()
+        for c in p:
+            iv = self.extendRight(iv, c)
+            if iv[2] == 0:
+                break
+        return iv
+    
+    def approximate(self, p, k, edits=False, schemes=None):
+        """ Find all occurrences of p with up to k mismatches, or up to k
+            edits if edits is True.  Returns sorted list of (offset, length,
+            distance) tuples, one per distinct (offset, length) pair, with
+            the least distance found.  Alignments never start or end with a
+            text character aligned to a gap, since dropping it gives a
+            better hit.  schemes defaults to searchSchemes(k). """
+        if k >= len(p):
+            raise RuntimeError("Pattern must be longer than the number of errors")
+        if schemes is None:
+            schemes = searchSchemes(k)
+        npieces = len(schemes[0][0])
+        bounds = [ len(p) * i // npieces for i in xrange(0, npieces + 1) ]
+        found = {} # (forward row, n, text length) -> least distance
+        for order, L, U in schemes:
+            self._search(p, order, L, U, bounds, edits, found)
+        best = {}
+        for (lf, n, tlen), dist in found.iteritems():
+            for off in self.fwd.resolveRange(lf, lf + n):
+                key = (int(off), tlen)
+                best[key] = min(dist, best.get(key, dist))
+        return sorted([ (off, tlen, dist) for (off, tlen), dist in best.iteritems() ])
+    
+    def _search(self, p, order, L, U, bounds, edits, found):
+        """ Run one search of a search scheme, adding hits to found.  Pieces
+            are matched in the given order, each extending the match to the
+            right or left depending on where it lies relative to the pieces
+            already matched; branches whose error count leaves [L, U] are
+            pruned. """
+        m = len(p)
+        dirs = []
+        for i, piece in enumerate(order):
+            if i == 0:
+                dirs.append(1 if len(order) == 1 or order[1] > piece else -1)
+            else:
+                dirs.append(1 if piece > order[i-1] else -1)
+        def start(i):
+            piece = order[i]
+            return bounds[piece] if dirs[i] == 1 else bounds[piece + 1] - 1
+        def end(i):
+            piece = order[i]
+            return bounds[piece + 1] if dirs[i] == 1 else bounds[piece] - 1
+        # Explicit stack of (interval, search step, pattern offset, errors,
+        # text length, last operation).  A gap in the pattern is never next
+        # to a gap in the text: a mismatch would do better.
+        MATCH, PGAP, TGAP = 0, 1, 2
+        stack = [(self.fullInterval(), 0, start(0), 0, 0, MATCH)]
+        while len(stack) > 0:
+            iv, i, pos, e, tlen, last = stack.pop()
+            d, u = dirs[i], U[i]
+            done = pos == end(i)
+            if done and e < L[i] and not edits:
+                continue
+            exts = (self.extendRightAll if d == 1 else self.extendLeftAll)(iv)
+            # Text character aligned to a gap between p[pos-d] and p[pos];
+            # never outside the pattern's span
+            if edits and e < u and last != PGAP and 0 <= pos < m and 0 <= pos - d < m:
+                for c, civ in exts:
+                    stack.append((civ, i, pos, e + 1, tlen + 1, TGAP))
+            if done:
+                if e < L[i]:
+                    continue
+                if i + 1 == len(order):
+                    if tlen > 0:
+                        key = (iv[0], iv[2], tlen)
+                        found[key] = min(e, found.get(key, e))
+                else:
+                    nlast = last if dirs[i + 1] == d else MATCH
+                    stack.append((iv, i + 1, start(i + 1), e, tlen, nlast))
+                continue
+            for c, civ in exts:
+                ee = e if c == p[pos] else e + 1
+                if ee <= u:
+                    stack.append((civ, i, pos + d, ee, tlen + 1, MATCH))
+            if edits and e < u and last != TGAP:
+                # Pattern character aligned to a gap
+                stack.append((iv, i, pos + d, e + 1, tlen, PGAP))
+
+def parseFasta(fh):
+    """ Generate (short name, sequence) pairs for the records of FASTA file
+        object fh.  Like parse_fasta in FASTA.ipynb, but holds only one
+        record in memory at a time. """
+    name, lines = None, []
+    for ln in fh:
+        if ln[0] == '>':
+            if name is not None:
+                yield name, ''.join(lines)
+            name, lines = ln[1:].split()[0], []
+        elif name is not None:
+            lines.append(ln.rstrip())
+    if name is not None:
+        yield name, ''.join(lines)
+
+class FmCollection(object):
+    """ FM index over a collection of named records, e.g. the sequences in
+        a FASTA file.  Records are concatenated, each but the last followed
+        by separator sep, and indexed as one text.  starts holds the
+        cumulative offset where each record begins (plus the text length),
+        so an offset is mapped back to its record by binary search. """
+    
+    def __init__(self, records, sep='%', cpIval=4, ssaIval=4, dna=False, kmerLen=None, rle=False, budget=None):
+        """ Build index over records, an iterable of (name, sequence) pairs
+            such as parseFasta generates.  No sequence may contain sep or
+            '$'; sep must sort after '$'. """
+        if sep <= '$':
+            raise RuntimeError("Separator %r must sort after '$'" % sep)
+        t, names, starts = array('c'), [], [0]
+        for name, seq in records:
+            if sep in seq or '$' in seq:
+                raise RuntimeError("Record %s contains separator %r or '$'" % (name, sep))
+            t.fromstring(seq)
+            t.append(sep)
+            names.append(name)
+            starts.append(len(t))
+        if len(names) == 0:
+            raise RuntimeError("Collection has no records")
+        t[-1] = '$'
+        self.fm = FmIndex(t.tostring(), cpIval=cpIval, ssaIval=ssaIval, dna=dna, kmerLen=kmerLen, rle=rle, budget=budget)
+        self.sep, self.names, self.starts = sep, names, intArray(starts[-1], starts)
+    
+    @classmethod
+    def fromFasta(cls, fh, sep='%', cpIval=4, ssaIval=4, dna=False, kmerLen=None, rle=False, budget=None):
+        """ Build index over the records of FASTA file object fh """
+        return cls(parseFasta(fh), sep=sep, cpIval=cpIval, ssaIval=ssaIval, dna=dna, kmerLen=kmerLen, rle=rle, budget=budget)
+    
+    def save(self, fn):
+        """ Write index and boundaries table to file fn """
+        meta, sections = self.fm._metaAndSections()
+        meta = { 'fm': meta, 'sep': self.sep }
+        sections += [ ('coll.starts', self.starts), ('coll.names', '\n'.join(self.names)) ]
+        writeIndexFile(fn, 'FmCollection', meta, sections)
+    
+    @classmethod
+    def load(cls, fn, mmap=True):
+        """ Load index saved with FmCollection.save; see FmIndex.load """
+        meta, secs = readIndexFile(fn, 'FmCollection', useMmap=mmap)
+        coll = cls.__new__(cls)
+        coll.fm = FmIndex._fromMetaAndSections(meta['fm'], secs)
+        coll.sep = str(meta['sep'])
+        coll.starts = secs['coll.starts']
+        coll.names = secs['coll.names'][:].split('\n')
+        return coll
+    
+    def numRecords(self):
+        return len(self.names)
+    
+    def recordOf(self, off):
+        """ Return index of the record containing text offset off """
+        return bisect_right(self.starts, off) - 1
+    
+    def _searchable(self, p):
+        return len(p) > 0 and self.sep not in p and '$' not in p
+    
+    def hasSubstring(self, p):
+        """ Return true if and only if p occurs within some record """
+        return self._searchable(p) and self.fm.hasSubstring(p)
+    
+    def occurrences(self, p):
+        """ Return list of (record name, offset within record) for all
+            occurrences of p, ordered by record then offset.  A match can't
+            span records since p never contains the separator. """
+        if not self._searchable(p):
+            return []
+        offs = self.fm.occurrences(p)
+        recs = numpy.searchsorted(npView(self.starts), offs, 'right') - 1
+        return [ (self.names[i], int(off) - int(self.starts[i])) for i, off in izip(recs, offs) ]
+
+_workerIndex = None # FmIndex used by parallel_occurrences worker processes
+
+def _attachIndex(fn):
+    """ Worker initializer: memory-map the index saved in fn """
+    global _workerIndex
+    _workerIndex = FmIndex.load(fn, mmap=True)
+
+def _occurrencesBatch(patterns):
+    """ Worker task: find occurrences of a batch of patterns, sorting each
+        pattern's offsets """
+    offs, ptr = _workerIndex.occurrences_many(patterns)
+    pid = numpy.repeat(numpy.arange(len(patterns)), numpy.diff(ptr))
+    return offs[numpy.lexsort((offs, pid))], ptr
+
+def _countBatch(patterns):
+    """ Worker task: count occurrences of a batch of patterns """
+    return _workerIndex.count_occurrences_many(patterns)
+
+def parallel_occurrences(index, patterns, workers=4, batchSize=10000):
+    """ Find occurrences of many patterns using a pool of worker processes.
+        index is either the path of an index written with FmIndex.save or
+        an FmIndex loaded from one.  Workers memory-map the file, so all
+        share one copy in the page cache; the index is never pickled.
+        patterns can be any iterable; it is consumed in batches of
+        batchSize, with at most 2 batches per worker in flight, so memory
+        stays bounded however many patterns there are.  Generates
+        (pattern, sorted array of offsets) pairs, in input order. """
+    for batch, (offs, ptr) in _parallelBatches(index, patterns, _occurrencesBatch, workers, batchSize):
+        for i in xrange(0, len(batch)):
+            yield batch[i], offs[ptr[i]:ptr[i+1]]
+
+def parallel_count_occurrences(index, patterns, workers=4, batchSize=10000):
+    """ Like parallel_occurrences, but generates (pattern, number of
+        occurrences) pairs; no offsets are resolved """
+    for batch, counts in _parallelBatches(index, patterns, _countBatch, workers, batchSize):
+        for p, n in izip(batch, counts):
+            yield p, int(n)
+
+def _parallelBatches(index, patterns, task, workers, batchSize):
+    """ Generate (batch, result of task on batch) for successive batches of
+        patterns, in input order, computed by a pool of workers that each
+        memory-map the saved index """
+    fn = index if isinstance(index, basestring) else index.fn
+    if fn is None:
+        raise RuntimeError("Parallel queries need an index saved with FmIndex.save")
+    pool = Pool(workers, _attachIndex, (fn,))
+    it = iter(patterns)
+    pending = deque()
+    try:
+        for batch in iter(lambda: list(islice(it, batchSize)), []):
+            pending.append((batch, pool.apply_async(task, (batch,))))
+            if len(pending) >= 2 * workers:
+                batch, res = pending.popleft()
+                yield batch, res.get()
+        while len(pending) > 0:
+            batch, res = pending.popleft()
+            yield batch, res.get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
 
 if __name__ == "__main__":
     import argparse
@@ -220,15 +1721,45 @@ if __name__ == "__main__":
         '--text-uppercase', action='store_const', const=True, default=False, help='Make text all-uppercase')
     parser.add_argument(\
         '--test', action='store_const', const=True, default=False, help='Do unit tests')
+    parser.add_argument(\
+        '--save-index', metavar='path', type=str, help='Build FM index of text and save it to file')
+    parser.add_argument(\
+        '--index', metavar='path', type=str, help='Query FM index saved with --save-index')
+    parser.add_argument(\
+        '--patterns-file', metavar='path', type=str, default='-', help='File with one pattern per line to query --index with (default: stdin)')
+    parser.add_argument(\
+        '--workers', metavar='int', type=int, default=1, help='Number of worker processes for --index queries')
+    parser.add_argument(\
+        '--batch-size', metavar='int', type=int, default=10000, help='Number of patterns sent to a worker at a time')
+    parser.add_argument(\
+        '--count', action='store_const', const=True, default=False, help='Report only the number of occurrences for --index queries')
+    parser.add_argument(\
+        '--cp-ival', metavar='int', type=int, help='Checkpoint interval for --save-index (default: 4)')
+    parser.add_argument(\
+        '--ssa-ival', metavar='int', type=int, help='Suffix array sample interval for --save-index (default: 4)')
+    parser.add_argument(\
+        '--dna', action='store_const', const=True, default=False, help='Use 2-bit packed DNA BWT for --save-index')
+    parser.add_argument(\
+        '--budget', metavar='int', type=int, help='Build --save-index sorting at most this many suffixes at a time')
+    parser.add_argument(\
+        '--rle', action='store_const', const=True, default=False, help='Use run-length encoded BWT for --save-index')
+    parser.add_argument(\
+        '--mem-budget', metavar='bytes', type=int, help='Pick --save-index layout to fit in this many bytes (see tuneLayout); '
+                                                        'excludes --cp-ival, --ssa-ival, --dna, --rle and --budget')
+    parser.add_argument(\
+        '--workload-file', metavar='path', type=str, help='Patterns, one per line, to tune --mem-budget layout for')
     
     args = parser.parse_args()
     
+    import json
+    import sys
+    
     if args.test:
-        import sys
         import unittest
         
         def constructions(s):
             return [ FmIndex.fromString(s),
+                     FmIndex.fromString(s, dna=True),
                      FmIndex.fromSuffixArray(SuffixArray.fromString(s)),
                      FmIndex.fromSuffixTree(SuffixTree(s)) ]
         
@@ -263,6 +1794,436 @@ if __name__ == "__main__":
                     self.assertEquals(0, cp.rank(bw, '$', 4))
                     self.assertEquals(0, cp.rank(bw, 'X', 4))
             
+            def test_dna_rank_1(self):
+                import random
+                random.seed(91)
+                for ln in (1, 31, 32, 33, 127, 128, 129, 500):
+                    bw = ''.join([random.choice("ACGTACGTN") for _ in xrange(0, ln)])
+                    ri = random.randint(0, ln)
+                    bw = bw[:ri] + '$' + bw[ri:]
+                    cp, dbw = FmCheckpoints(bw, 1), DnaBwt(bw)
+                    self.assertEqual(len(bw), len(dbw))
+                    self.assertEqual(bw, ''.join(dbw))
+                    for row in xrange(-1, len(bw)):
+                        for c in "ACGTN$X":
+                            self.assertEqual(cp.rank(bw, c, row), dbw.rank(bw, c, row))
+            
+            def test_dna_save_load_1(self):
+                import os
+                import tempfile
+                t = "GTTATAGCTGATCGCGGCGATAGCNGCGAA" * 5
+                fd, fn = tempfile.mkstemp(suffix='.fm')
+                os.close(fd)
+                try:
+                    FmIndex.fromString(t, dna=True).save(fn)
+                    for mmap in (True, False):
+                        fm = FmIndex.load(fn, mmap=mmap)
+                        self.assertTrue(isinstance(fm.bwt, DnaBwt))
+                        for p in ("ATAGCGGCG", "GCG", "CNG", "GTT", "CC"):
+                            self.assertEqual(naive(p, t), sorted(fm.occurrences(p)))
+                finally:
+                    os.remove(fn)
+            
+            def test_many_1(self):
+                import random
+                random.seed(5)
+                t = ''.join([random.choice("ACGT") for _ in xrange(0, 3000)])
+                ps = [ t[i:i+random.randint(1, 12)] for i in xrange(0, 2900, 37) ]
+                ps += [ "ACGTACGTACGTACGT", "N", "ANA", "" ]
+                for fm in (FmIndex.fromString(t, cpIval=1), FmIndex.fromString(t, cpIval=5),
+                           FmIndex.fromString(t, ssaIval=7, dna=True)):
+                    ls, rs = fm.range_many(ps)
+                    self.assertEqual([ fm.range(p) for p in ps ], zip(ls, rs))
+                    offs, ptr = fm.occurrences_many(ps)
+                    for i, p in enumerate(ps):
+                        self.assertEqual(sorted(fm.occurrences(p)), sorted(offs[ptr[i]:ptr[i+1]]))
+                    ls, rs = fm.range_many([ p[:4] for p in ps if len(p) >= 4 ])
+                    self.assertEqual([ fm.range(p[:4]) for p in ps if len(p) >= 4 ], zip(ls, rs))
+            
+            def test_parallel_1(self):
+                import os
+                import random
+                import tempfile
+                random.seed(11)
+                t = ''.join([random.choice("ACGT") for _ in xrange(0, 2000)])
+                ps = [ t[i:i+random.randint(3, 8)] for i in xrange(0, 1990, 13) ] + [ "NNN" ]
+                for dna in (True, False):
+                    fm = FmIndex.fromString(t, dna=dna)
+                    fd, fn = tempfile.mkstemp(suffix='.fm')
+                    os.close(fd)
+                    try:
+                        fm.save(fn)
+                        for index in (fn, FmIndex.load(fn)):
+                            res = list(parallel_occurrences(index, iter(ps), workers=2, batchSize=7))
+                            self.assertEqual(ps, [ p for p, _ in res ])
+                            for p, offs in res:
+                                self.assertEqual(naive(p, t), list(offs))
+                            counts = list(parallel_count_occurrences(index, iter(ps), workers=2, batchSize=7))
+                            self.assertEqual([ (p, len(naive(p, t))) for p in ps ], counts)
+                        # an index that was never saved can't be shared
+                        self.assertRaises(RuntimeError, list, parallel_occurrences(fm, iter(ps), workers=2))
+                        if not dna:
+                            # batched rank reads the mmapped checkpoints in
+                            # place instead of keeping a private copy
+                            loaded = FmIndex.load(fn)
+                            self.assertEqual([ len(naive(p, t)) for p in ps ], list(loaded.count_occurrences_many(ps)))
+                            for cp in loaded.cps.cps.itervalues():
+                                self.assertFalse(cp.flags.owndata)
+                            for v in vars(loaded.cps).itervalues():
+                                for a in (v if isinstance(v, (tuple, list)) else [ v ]):
+                                    self.assertFalse(isinstance(a, numpy.ndarray) and a.flags.owndata)
+                    finally:
+                        os.remove(fn)
+            
+            def test_resolve_range_1(self):
+                t = "ACGACGACGACGACGTTTTTTTTTTTTACGACGTTTT" * 3
+                for ssaIval in (1, 3, 8, 32):
+                    fm = FmIndex.fromString(t, ssaIval=ssaIval)
+                    for p in ("ACG", "T", "TT", "CGAC", "GTTTTA", "Z"):
+                        l, r = fm.range(p)
+                        expect = naive(p, t)
+                        self.assertEqual(expect, list(fm.resolveRange(l, r)))
+                        self.assertEqual(expect, sorted(fm.resolve(row) for row in xrange(l, r)))
+                        self.assertEqual(expect, sorted(fm.resolve_many(numpy.arange(l, r))))
+                    fm.enableLocateCache(maxRows=20, minHits=2)
+                    for trial in xrange(0, 3):
+                        for p in ("ACG", "TTT", "CGT"):
+                            self.assertEqual(naive(p, t), list(fm.occurrences(p)))
+                    self.assertTrue(0 < len(fm.locateCache.offs) <= 20)
+                    for row, off in fm.locateCache.offs.iteritems():
+                        self.assertEqual(suffixArray(t + '$')[row], off)
+            
+            def test_kmer_table_1(self):
+                import os
+                import random
+                import tempfile
+                random.seed(17)
+                t = ''.join([random.choice("ACGT") for _ in xrange(0, 2000)])
+                ps = [ t[i:i+random.randint(1, 9)] for i in xrange(0, 1990, 11) ]
+                ps += [ "ACGTACGTACGTACGT", "NAC", "ACN", "" ]
+                plain = FmIndex.fromString(t)
+                fd, fn = tempfile.mkstemp(suffix='.fm')
+                os.close(fd)
+                try:
+                    for k in (1, 3, 5):
+                        FmIndex.fromString(t, kmerLen=k, dna=True).save(fn)
+                        for fm in (FmIndex.fromString(t, kmerLen=k),
+                                   FmIndex.fromSuffixArray(SuffixArray.fromString(t), kmerLen=k),
+                                   FmIndex.load(fn)):
+                            self.assertEqual(k, fm.kmers.k)
+                            ls, rs = fm.range_many(ps)
+                            for p, l, r in zip(ps, ls, rs):
+                                self.assertEqual(fm.range(p), (l, r))
+                                pl, pr = plain.range(p)
+                                self.assertEqual(max(pr - pl, 0), max(r - l, 0))
+                                if r > l:
+                                    self.assertEqual((pl, pr), (l, r))
+                                    self.assertEqual(naive(p, t), list(fm.occurrences(p)))
+                finally:
+                    os.remove(fn)
+            
+            def test_suffix_array_1(self):
+                for t in ("abaaba$", "AAAAAA$", "GTTATAGCTGATCGCGGCGATAGCGGCGAA$"):
+                    self.assertEqual(naiveSuffixArray(t), suffixArray(t))
+            
+            def test_ssa_1(self):
+                t = "GTTATAGCTGATCGCGGCGATAGCGGCGAA$" * 3
+                sa = suffixArray(t)
+                for n in (1, 2, 3, 5, 16):
+                    ssa = downsampleSuffixArray(sa, n)
+                    self.assertEqual(len([x for x in sa if x % n == 0]), len(ssa))
+                    for row in xrange(0, len(sa)):
+                        if sa[row] % n == 0:
+                            self.assertTrue(row in ssa)
+                            self.assertEqual(sa[row], ssa[row])
+                        else:
+                            self.assertFalse(row in ssa)
+                            self.assertRaises(KeyError, ssa.__getitem__, row)
+            
+            def test_save_load_1(self):
+                import os
+                import tempfile
+                t = "GTTATAGCTGATCGCGGCGATAGCGGCGAA"
+                fd, fn = tempfile.mkstemp(suffix='.fm')
+                os.close(fd)
+                try:
+                    FmIndex.fromString(t, cpIval=3, ssaIval=5).save(fn)
+                    for mmap in (True, False):
+                        fm = FmIndex.load(fn, mmap=mmap)
+                        self.assertEqual((3, 5), (fm.cpIval, fm.ssaIval))
+                        self.assertEqual(len(t) + 1, fm.slen)
+                        for p in ("ATAGCGGCG", "GCG", "A", "GTT", "CC"):
+                            self.assertEqual(naive(p, t), sorted(fm.occurrences(p)))
+                        self.assertTrue(fm.hasSuffix("GAA"))
+                        self.assertFalse(fm.hasSubstring("ATATAT"))
+                    with open(fn, 'r+b') as fh:
+                        fh.write('XXXX')
+                    self.assertRaises(RuntimeError, FmIndex.load, fn)
+                finally:
+                    os.remove(fn)
+            
+            def test_mems_1(self):
+                import os
+                import random
+                import tempfile
+                from suf_tree import CompactSuffixTree, naiveMEMs
+                random.seed(67)
+                unit = ''.join([random.choice("ACGT") for _ in xrange(0, 10)])
+                t = ''.join([unit[:random.randint(6, 10)] + random.choice("ACGT") for _ in xrange(0, 30)])
+                st = CompactSuffixTree(t)
+                fd, fn = tempfile.mkstemp(suffix='.fm')
+                os.close(fd)
+                try:
+                    FmIndex.fromString(t, lcp=True).save(fn)
+                    indexes = [ FmIndex.fromString(t, lcp=True, dna=True),
+                                FmIndex.fromSuffixArray(SuffixArray.fromString(t), lcp=True),
+                                FmIndex.load(fn) ]
+                    for trial in xrange(0, 10):
+                        i = random.randint(0, len(t) - 1)
+                        p = t[i:i+random.randint(1, 40)]
+                        p = ''.join([c if random.random() < 0.9 else random.choice("ACGTN") for c in p])
+                        for fm in indexes:
+                            self.assertEqual(st.matchingStatistics(p), fm.matching_statistics(p))
+                            for l in (1, 4, 8):
+                                mems, depths = fm.mems(p, l)
+                                self.assertEqual(naiveMEMs(p, t, l), mems)
+                                self.assertEqual(st.matchingStatistics(p), depths)
+                finally:
+                    os.remove(fn)
+                self.assertRaises(RuntimeError, FmIndex.fromString(t).matching_statistics, "ACGT")
+            
+            def test_approximate_1(self):
+                import random
+                random.seed(71)
+                def naiveApprox(p, t, k, edits):
+                    hits = []
+                    for off in xrange(0, len(t)):
+                        for ln in (xrange(max(1, len(p) - k), len(p) + k + 1) if edits else [len(p)]):
+                            s = t[off:off+ln]
+                            if len(s) < ln:
+                                continue
+                            if not edits:
+                                dist = sum([ a != b for a, b in zip(p, s) ])
+                            else:
+                                # Edit distance; text chars can't be gapped
+                                # at either end of the alignment
+                                D = [ range(0, len(s) + 1) ]
+                                D[0][1:] = [ len(s) + len(p) ] * len(s)
+                                for i in xrange(1, len(p) + 1):
+                                    row = [i]
+                                    for j in xrange(1, len(s) + 1):
+                                        best = min(D[i-1][j-1] + (p[i-1] != s[j-1]), D[i-1][j] + 1)
+                                        if i < len(p):
+                                            best = min(best, row[j-1] + 1)
+                                        row.append(best)
+                                    D.append(row)
+                                dist = D[-1][-1]
+                            if dist <= k:
+                                hits.append((off, ln, dist))
+                    return hits
+                for trial in xrange(0, 6):
+                    t = ''.join([random.choice("AC" if trial % 2 else "ACGT") for _ in xrange(0, 60)])
+                    bi = BidirectionalFmIndex(t, dna=(trial % 3 == 0))
+                    i = random.randint(0, len(t) - 9)
+                    p = list(t[i:i+random.randint(5, 9)])
+                    p[random.randint(0, len(p) - 1)] = random.choice("ACGT")
+                    p = ''.join(p)
+                    l, r = FmIndex.fromString(t).range(p)
+                    lf, lr, n = bi.range(p)
+                    self.assertEqual(max(0, r - l), n)
+                    if n > 0:
+                        self.assertEqual(l, lf)
+                    for k in (1, 2, 3):
+                        for edits in (False, True):
+                            self.assertEqual(naiveApprox(p, t, k, edits), bi.approximate(p, k, edits))
+            
+            def test_rle_1(self):
+                import os
+                import random
+                import tempfile
+                random.seed(79)
+                unit = ''.join([random.choice("ACGT") for _ in xrange(0, 200)])
+                t = ''.join([ ''.join([c if random.random() < 0.99 else random.choice("ACGT") for c in unit])
+                              for _ in xrange(0, 20) ])
+                fd, fn = tempfile.mkstemp(suffix='.fm')
+                os.close(fd)
+                try:
+                    fm = FmIndex.fromSuffixArray(SuffixArray.fromString(t), rle=True)
+                    self.assertTrue(fm.bwt.numRuns() < len(t) / 4)
+                    self.assertEqual(''.join(bwtFromSa(t + '$')[0]), ''.join(fm.bwt))
+                    fm.save(fn)
+                    plain = FmIndex.fromString(t)
+                    for rle in (fm, FmIndex.fromString(t, rle=True), FmIndex.load(fn), FmIndex.load(fn, mmap=False)):
+                        self.assertEqual(plain.dollarRow, rle.dollarRow)
+                        for row in xrange(0, len(t) + 1, 37):
+                            for c in "$ACGTN":
+                                self.assertEqual(plain.cps.rank(plain.bwt, c, row), rle.cps.rank(rle.bwt, c, row))
+                        for i in xrange(0, len(t) - 10, 97):
+                            p = t[i:i+random.randint(1, 10)]
+                            self.assertEqual(plain.range(p), rle.range(p))
+                            self.assertEqual(naive(p, t), list(rle.occurrences(p)))
+                            self.assertEqual(naive(p, t), sorted(rle.resolveRange(*rle.range(p))))
+                        self.assertEqual(0, len(rle.occurrences("ACGTN")))
+                        ps = [ t[i:i+6] for i in xrange(0, len(t), 53) ]
+                        offs, ptr = rle.occurrences_many(ps)
+                        for i, p in enumerate(ps):
+                            self.assertEqual(naive(p, t), sorted(offs[ptr[i]:ptr[i+1]]))
+                finally:
+                    os.remove(fn)
+                self.assertRaises(RuntimeError, FmIndex.fromString, t, dna=True, rle=True)
+            
+            def test_rle_dollar_1(self):
+                # Patterns ending in $ make the toehold step left from offset 0
+                for t in ("ACGTACGTTTACG", "AAAAAAAA", "ACGT" * 10):
+                    plain, rle = FmIndex.fromString(t), FmIndex.fromString(t, rle=True)
+                    for p in [ t[i:] + '$' for i in xrange(0, len(t)) ] + [ "$", "$A", "A$" ]:
+                        self.assertEqual(list(plain.occurrences(p)), list(rle.occurrences(p)))
+                        self.assertEqual(plain.count_occurrences(p), rle.count_occurrences(p))
+            
+            def test_collection_1(self):
+                import os
+                import random
+                import tempfile
+                from StringIO import StringIO
+                random.seed(89)
+                recs = [ ('chr%d' % i, ''.join([random.choice("ACGT") for _ in xrange(0, random.randint(0, 150))]))
+                         for i in xrange(0, 6) ]
+                fasta = ''.join([ '>%s some description\n%s\n' % (name, '\n'.join([ seq[i:i+60] for i in xrange(0, len(seq), 60) ]))
+                                  for name, seq in recs ])
+                self.assertEqual(recs, list(parseFasta(StringIO(fasta))))
+                fd, fn = tempfile.mkstemp(suffix='.fm')
+                os.close(fd)
+                try:
+                    coll = FmCollection.fromFasta(StringIO(fasta), ssaIval=3)
+                    coll.save(fn)
+                    self.assertRaises(RuntimeError, FmIndex.load, fn)
+                    for c in (coll, FmCollection(recs, dna=True), FmCollection(recs, rle=True), FmCollection.load(fn),
+                              FmCollection.load(fn, mmap=False)):
+                        self.assertEqual(len(recs), c.numRecords())
+                        ps = [ 'ACG', 'T', 'ACGTA' ]
+                        for (_, a), (_, b) in zip(recs, recs[1:]):
+                            # Straddles a record boundary; may also occur inside a record
+                            ps.append(a[-3:] + b[:3])
+                        for p in ps:
+                            expect = [ (name, off) for name, seq in recs for off in naive(p, seq) ]
+                            self.assertEqual(expect, c.occurrences(p))
+                            self.assertEqual(len(expect) > 0, c.hasSubstring(p))
+                        self.assertEqual([], c.occurrences('A%C'))
+                        self.assertFalse(c.hasSubstring('%'))
+                        self.assertEqual(0, c.recordOf(0))
+                finally:
+                    os.remove(fn)
+                self.assertRaises(RuntimeError, FmCollection, [ ('a', 'AC%GT') ])
+                self.assertRaises(RuntimeError, FmCollection, [])
+            
+            def test_stats_1(self):
+                import random
+                random.seed(101)
+                t = ''.join([random.choice("ACGT") for _ in xrange(0, 500)])
+                for fm in (FmIndex.fromString(t, cpIval=8, ssaIval=16), FmIndex.fromString(t, dna=True, ssaIval=16)):
+                    self.assertEqual(None, fm.stats)
+                    stats = fm.enableStats()
+                    ps = [ t[i:i+10] for i in xrange(0, len(t) - 10, 50) ]
+                    for p in ps:
+                        fm.range(p)
+                    d = stats.toDict(reset=True)
+                    self.assertEqual({ 20: len(ps) }, d['hists']['rangeRank']['hist'])
+                    self.assertEqual(20 * len(ps), d['counts']['rank'])
+                    if isinstance(fm.cps, FmCheckpoints):
+                        # rank of row -1 is answered without a scan
+                        self.assertTrue(19 * len(ps) <= d['hists']['rankScan']['n'] <= 20 * len(ps))
+                        self.assertTrue(d['hists']['rankScan']['max'] < 8)
+                    else:
+                        self.assertFalse('rankScan' in d['hists'])
+                    for row in xrange(0, len(t) + 1):
+                        self.assertEqual(fm.resolve(row), fm.resolve(row))
+                    d = stats.toDict(reset=True)
+                    self.assertEqual(2 * (len(t) + 1), d['hists']['resolveLf']['n'])
+                    self.assertTrue(d['hists']['resolveLf']['max'] < 16)
+                    self.assertEqual(d['counts']['rank'], d['hists']['resolveLf']['total'])
+                    self.assertEqual(naive("ACG", t), list(fm.occurrences("ACG")))
+                    self.assertEqual(1, stats.toDict()['hists']['resolveRangeLf']['n'])
+            
+            def test_tune_1(self):
+                import random
+                random.seed(103)
+                t = ''.join([random.choice("ACGT") for _ in xrange(0, 3000)]) + '$'
+                sa = SuffixArray(t)
+                counts = dict((c, t.count(c)) for c in set(t))
+                nruns = FmIndex(sa=sa, rle=True).bwt.numRuns()
+                for layout in ({ 'cpIval': 1, 'ssaIval': 1, 'dna': False, 'rle': False, 'kmerLen': None },
+                               { 'cpIval': 7, 'ssaIval': 32, 'dna': False, 'rle': False, 'kmerLen': 4 },
+                               { 'cpIval': 4, 'ssaIval': 5, 'dna': True, 'rle': False, 'kmerLen': None },
+                               { 'cpIval': 4, 'ssaIval': 4, 'dna': False, 'rle': True, 'kmerLen': 3 }):
+                    secs = FmIndex(sa=sa, **layout)._metaAndSections()[1]
+                    actual = sum([ len(d) * d.itemsize if hasattr(d, 'itemsize') else len(d) for _, d in secs ])
+                    self.assertEqual(actual, _layoutBytes(len(t), counts, nruns, layout))
+                # Fixed calibration so the choices are deterministic
+                cal = { 'cp1': (1e-6, 1e-6), 'cp64': (8e-6, 3e-6), 'dna': (4e-6, 4e-6),
+                        'rle': (6e-6, 5e-6), 'phi': 1e-6, 'toehold': 1e-6, 'occ': 2e-6 }
+                last = None
+                for budget in (2500, 4000, 10000, 40000, 100000):
+                    rep = tuneLayout(t, budget, sa=sa, calibration=cal)
+                    self.assertTrue(rep['predictedBytes'] <= budget)
+                    self.assertTrue(last is None or rep['predictedSecsPerQuery'] <= last)
+                    last = rep['predictedSecsPerQuery']
+                    sizes = [ f['predictedBytes'] for f in rep['frontier'] ]
+                    costs = [ f['predictedSecsPerQuery'] for f in rep['frontier'] ]
+                    self.assertEqual(sorted(sizes), sizes)
+                    self.assertEqual(sorted(costs, reverse=True), costs)
+                self.assertEqual(100, tuneLayout(t, 1 << 20, [ t[i:i+8] for i in xrange(0, 800, 8) ], locate=False,
+                                                 sa=sa, calibration=cal)['workload']['queries'])
+                self.assertRaises(RuntimeError, tuneLayout, t, 100, sa=sa, calibration=cal)
+                s = t[:-1]
+                fm = FmIndex.tuned(s, 20000, [ s[i:i+10] for i in xrange(0, 2000, 40) ])
+                self.assertTrue(fm.layout['predictedBytes'] <= 20000)
+                for i in xrange(0, 2000, 97):
+                    self.assertEqual(naive(s[i:i+6], s), list(fm.occurrences(s[i:i+6])))
+            
+            def test_count_1(self):
+                t = "ACGTNACGT"
+                for fm in constructions(t) + [ FmIndex.fromString(t, rle=True) ]:
+                    for b in xrange(0, 256):
+                        c = chr(b)
+                        self.assertEqual(sum([ 1 for cc in t + '$' if cc < c ]), fm.count(c))
+                    self.assertEqual(naive("GTN", t), list(fm.occurrences("GTN")))
+                    self.assertEqual(0, len(fm.occurrences("ANA")))
+                    self.assertEqual(0, len(fm.occurrences("~A")))
+                    self.assertEqual(fm.slen, fm.C[256])
+            
+            def test_count_only_1(self):
+                import random
+                random.seed(107)
+                t = ''.join([random.choice("ACGT") for _ in xrange(0, 300)])
+                ps = [ t[i:i+random.randint(1, 6)] for i in xrange(0, 300, 11) ] + [ t[-4:], t, "~", "~~A", "N", "" ]
+                for fm in constructions(t) + [ FmIndex.fromString(t, rle=True), FmIndex.fromString(t, kmerLen=3) ]:
+                    stats = fm.enableStats()
+                    for p in ps:
+                        self.assertEqual(len(naive(p, t)) if len(p) > 0 else len(t) + 1, fm.count_occurrences(p))
+                        self.assertEqual(t.endswith(p), fm.hasSuffix(p))
+                    expect = [ len(naive(p, t)) if len(p) > 0 else len(t) + 1 for p in ps ]
+                    self.assertEqual(expect, list(fm.count_occurrences_many(ps)))
+                    self.assertEqual([ len(t) + 1 ] * 3, list(fm.count_occurrences_many([ "" ] * 3)))
+                    self.assertEqual([], list(fm.count_occurrences_many([])))
+                    # Nothing was resolved
+                    self.assertFalse('resolveLf' in stats.toDict()['hists'])
+            
+            def test_budget_1(self):
+                import random
+                random.seed(83)
+                t = ''.join([random.choice("ACGT") for _ in xrange(0, 400)])
+                plain = FmIndex.fromString(t, ssaIval=3)
+                for fm in (FmIndex.fromString(t, ssaIval=3, budget=50), FmIndex.fromString(t, rle=True, budget=50)):
+                    self.assertEqual(plain.dollarRow, fm.dollarRow)
+                    self.assertEqual(plain.bwt, ''.join(fm.bwt))
+                    for i in xrange(0, len(t), 41):
+                        p = t[i:i+5]
+                        self.assertEqual(naive(p, t), list(fm.occurrences(p)))
+                fm = FmIndex.fromString(t, ssaIval=3, budget=50)
+                for row in xrange(0, len(t) + 1):
+                    self.assertEqual(row in plain.ssa, row in fm.ssa)
+                self.assertRaises(RuntimeError, FmIndex.fromString, t, budget=50, lcp=True)
+            
             def test_search_1(self):
                 for fm in constructions("abaaba"):
                     self.assertFalse(fm.hasSubstring("aabb"))
@@ -348,6 +2309,16 @@ if __name__ == "__main__":
         
         unittest.main(argv=[sys.argv[0]])
     
+    elif args.index is not None:
+        ph = sys.stdin if args.patterns_file == '-' else open(args.patterns_file, 'r')
+        ps = (line.rstrip('\r\n') for line in ph)
+        if args.count:
+            for p, n in parallel_count_occurrences(args.index, ps, workers=args.workers, batchSize=args.batch_size):
+                print '%s\t%d' % (p, n)
+        else:
+            for p, offs in parallel_occurrences(args.index, ps, workers=args.workers, batchSize=args.batch_size):
+                print '%s\t%s' % (p, ','.join(map(str, offs)))
+    
     else:
         t = args.text
         if t is None:
@@ -358,7 +2329,27 @@ if __name__ == "__main__":
             th.close()
         if args.text_ignore_ws: t = ''.join(t.split())
         if args.text_uppercase: t = t.upper()
+        if args.save_index is not None:
+            layoutFlags = [ flag for flag, val in (('--cp-ival', args.cp_ival), ('--ssa-ival', args.ssa_ival),
+                                                   ('--dna', args.dna), ('--rle', args.rle), ('--budget', args.budget))
+                            if val not in (None, False) ]
+            if args.mem_budget is not None:
+                if len(layoutFlags) > 0:
+                    raise RuntimeError("--mem-budget chooses the layout itself; can't combine it with " + ', '.join(layoutFlags))
+                workload = None
+                if args.workload_file is not None:
+                    with open(args.workload_file) as fh:
+                        workload = [ ln.rstrip() for ln in fh if len(ln.rstrip()) > 0 ]
+                fm = FmIndex.tuned(t, args.mem_budget, workload)
+                print >>sys.stderr, json.dumps(dict((k, v) for k, v in fm.layout.iteritems() if k != 'frontier'), sort_keys=True)
+            else:
+                fm = FmIndex.fromString(t, cpIval=4 if args.cp_ival is None else args.cp_ival,
+                                        ssaIval=4 if args.ssa_ival is None else args.ssa_ival,
+                                        dna=args.dna, rle=args.rle, budget=args.budget)
+            fm.save(args.save_index)
+            sys.exit()
         import datetime
+        import os
         stree = SuffixTree(t)
         for node in stree.nodes:
             assert node.repOk(t + '$')
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+"""
+indexfile.py: Versioned binary container for saving index structures (BWT,
+              checkpoints, suffix array samples, etc) to disk and loading
+              them back, optionally as zero-copy memory-mapped buffers.
+
+File layout:
+
+    magic (8 bytes) | version (uint32) | header length (uint32) |
+    JSON header | padding | section 0 | padding | section 1 | ...
+
+The JSON header holds the index kind, a free-form metadata dictionary and a
+table of contents giving each section's offset, length in bytes, typecode
+and element count.  Sections start at multiples of mmap.ALLOCATIONGRANULARITY
+so each can be mapped on its own.  Integer sections hold native-endian
+array.array data; typecode 'c' marks a raw character string.
+"""
+
+import json
+import mmap
+import struct
+import sys
+from array import array
+
+import numpy
+
+MAGIC = 'CGIDX\x00\x00\x00'
+VERSION = 1
+ALIGN = mmap.ALLOCATIONGRANULARITY
+
+# numpy dtypes used to view memory-mapped sections; 8-byte values are viewed
+# as signed so that arithmetic with Python ints stays integral
+_dtypes = { 'B': numpy.uint8, 'I': numpy.uint32, 'L': numpy.int64 }
+
+def npView(a):
+    """ Return a numpy view of typed array a (an array.array or a numpy
+        array as returned by readIndexFile) without copying """
+    if isinstance(a, numpy.ndarray):
+        return a
+    return numpy.frombuffer(a, dtype=_dtypes[a.typecode])
+
+def _roundUp(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+def _typecode(obj):
+    if isinstance(obj, array):
+        return obj.typecode
+    if isinstance(obj, numpy.ndarray):
+        for typecode, dtype in _dtypes.iteritems():
+            if obj.dtype == dtype:
+                return typecode
+        raise RuntimeError("Cannot store array of type %s" % obj.dtype)
+    return 'c'
+
+def _nbytes(obj):
+    if isinstance(obj, array):
+        return len(obj) * obj.itemsize
+    if isinstance(obj, numpy.ndarray):
+        return obj.nbytes
+    return len(obj)
+
+def writeIndexFile(fn, kind, meta, sections):
+    """ Write an index file.  kind names the index type, meta is a
+        JSON-serializable dict and sections is a list of (name, data)
+        pairs where data is an array.array, a numpy array (as returned by
+        readIndexFile) or a string. """
+    toc = {}
+    for name, data in sections:
+        toc[name] = [0, _nbytes(data), _typecode(data), len(data)]
+    fixed = len(MAGIC) + 8
+    # Header size depends on section offsets, which depend on header size;
+    # iterate until the layout is stable
+    start = 0
+    while True:
+        off = start
+        for name, data in sections:
+            toc[name][0] = off
+            off = _roundUp(off + _nbytes(data))
+        header = json.dumps({ 'kind': kind, 'byteorder': sys.byteorder,
+                              'meta': meta, 'sections': toc }, sort_keys=True)
+        if _roundUp(fixed + len(header)) == start:
+            break
+        start = _roundUp(fixed + len(header))
+    with open(fn, 'wb') as fh:
+        fh.write(MAGIC)
+        fh.write(struct.pack('<II', VERSION, len(header)))
+        fh.write(header)
+        for name, data in sections:
+            fh.write('\x00' * (toc[name][0] - fh.tell()))
+            if isinstance(data, (array, numpy.ndarray)):
+                data.tofile(fh)
+            else:
+                fh.write(data)
+
+def readIndexFile(fn, kind, useMmap=True):
+    """ Read an index file written by writeIndexFile, checking that it holds
+        an index of the given kind.  Return the metadata dict and a dict
+        mapping section names to data.  If useMmap is True, integer sections
+        are read-only numpy views onto memory-mapped pages and string
+        sections are mmap objects, so nothing is copied and the pages can
+        be shared by all processes that load the same file. """
+    with open(fn, 'rb') as fh:
+        if fh.read(len(MAGIC)) != MAGIC:
+            raise RuntimeError("%s is not an index file" % fn)
+        version, hlen = struct.unpack('<II', fh.read(8))
+        if version != VERSION:
+            raise RuntimeError("%s has index format version %d; expected %d" % (fn, version, VERSION))
+        header = json.loads(fh.read(hlen))
+        if header['kind'] != kind:
+            raise RuntimeError("%s holds a %s, not a %s" % (fn, header['kind'], kind))
+        if header['byteorder'] != sys.byteorder:
+            raise RuntimeError("%s was written on a %s-endian machine" % (fn, header['byteorder']))
+        sections = {}
+        for name, (off, nbytes, typecode, count) in header['sections'].iteritems():
+            typecode = str(typecode)
+            if useMmap and nbytes > 0:
+                mm = mmap.mmap(fh.fileno(), nbytes, access=mmap.ACCESS_READ, offset=off)
+                if typecode == 'c':
+                    sections[name] = mm
+                else:
+                    sections[name] = numpy.frombuffer(mm, dtype=_dtypes[typecode], count=count)
+            else:
+                fh.seek(off)
+                buf = fh.read(nbytes)
+                if typecode == 'c':
+                    sections[name] = buf
+                else:
+                    sections[name] = array(typecode)
+                    sections[name].fromstring(buf)
+    return header['meta'], sections
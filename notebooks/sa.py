@@ -8,19 +8,587 @@ Date: 1/9/2013
 Contact: langmea@cs.jhu.edu
 """
 
+from array import array
+from bisect import bisect_right
 from suf_tree import SuffixTree
+from indexfile import writeIndexFile, readIndexFile
+
+def intArray(maxVal, vals=(), signed=False):
+    """ Return a typed array of unsigned integers wide enough to hold values
+        up to maxVal, initialized with vals.  4 bytes per element when
+        maxVal fits in 32 bits, 8 otherwise.  With signed=True the array is
+        signed, e.g. to also hold -1 for "none", and 4 bytes per element
+        when maxVal fits in 31 bits. """
+    if signed:
+        return array('i' if maxVal < (1 << 31) else 'l', vals)
+    return array('I' if maxVal < (1 << 32) else 'L', vals)
+
+def naiveSuffixArray(s):
+    """ Given T return suffix array SA(T) by sorting all suffixes with
+        Python's sorted function.  Simple but O(n^2 log n) time and O(n^2)
+        space; kept as a reference implementation for testing. """
+    satups = sorted([(s[i:], i) for i in xrange(0, len(s))])
+    return map(lambda x: x[1], satups)
+
+def encodeText(s):
+    """ Map characters of s to small integer codes that preserve their
+        order, starting at 1, and append a 0 sentinel.  Return the list of
+        codes and the alphabet size (including the sentinel). """
+    alph = sorted(set(s))
+    code = dict((c, i+1) for i, c in enumerate(alph))
+    t = [ code[c] for c in s ]
+    t.append(0)
+    return t, len(alph) + 1
+
+def _bucketBounds(bkt, ends):
+    """ Given bucket sizes, return list of bucket starts or ends """
+    bounds, tot = [], 0
+    for sz in bkt:
+        tot += sz
+        bounds.append(tot if ends else tot - sz)
+    return bounds
+
+def _induceSort(t, stype, bkt, lms):
+    """ Place LMS suffixes at the ends of their buckets in the given order,
+        then induce the order of the L-type and S-type suffixes. """
+    n = len(t)
+    sa = [-1] * n
+    tail = _bucketBounds(bkt, True)
+    for i in reversed(lms):
+        c = t[i]
+        tail[c] -= 1
+        sa[tail[c]] = i
+    head = _bucketBounds(bkt, False)
+    for i in xrange(0, n):
+        j = sa[i] - 1
+        if j >= 0 and not stype[j]:
+            c = t[j]
+            sa[head[c]] = j
+            head[c] += 1
+    tail = _bucketBounds(bkt, True)
+    for i in xrange(n-1, -1, -1):
+        j = sa[i] - 1
+        if j >= 0 and stype[j]:
+            c = t[j]
+            tail[c] -= 1
+            sa[tail[c]] = j
+    return sa
+
+def sais(t, k):
+    """ Linear-time suffix array construction by induced sorting (SA-IS).
+        t is a list of integers in [0, k) whose last element is a 0 that
+        occurs nowhere else.  Returns suffix array of t as a list. """
+    n = len(t)
+    if n == 1:
+        return [0]
+    # Classify each suffix as S-type (True) or L-type (False)
+    stype = [False] * n
+    stype[n-1] = True
+    for i in xrange(n-2, -1, -1):
+        stype[i] = t[i] < t[i+1] or (t[i] == t[i+1] and stype[i+1])
+    bkt = [0] * k
+    for c in t:
+        bkt[c] += 1
+    # Leftmost-S (LMS) positions, in text order
+    lms = [ i for i in xrange(1, n) if stype[i] and not stype[i-1] ]
+    isLms = [False] * n
+    for i in lms:
+        isLms[i] = True
+    # Sort LMS substrings with one round of induced sorting
+    sa = _induceSort(t, stype, bkt, lms)
+    # Name LMS substrings; equal substrings get equal names
+    names = [-1] * n
+    name, prev = -1, -1
+    for i in sa:
+        if not isLms[i]:
+            continue
+        if prev < 0 or t[prev] != t[i]:
+            name += 1
+        else:
+            j = 1
+            while True:
+                if t[prev+j] != t[i+j] or stype[prev+j] != stype[i+j]:
+                    name += 1
+                    break
+                if isLms[prev+j] or isLms[i+j]:
+                    if not (isLms[prev+j] and isLms[i+j]):
+                        name += 1
+                    break
+                j += 1
+        names[i] = name
+        prev = i
+    # Sort LMS suffixes, recursing if names aren't yet unique
+    t1 = [ names[i] for i in lms ]
+    if name + 1 < len(lms):
+        sa1 = sais(t1, name + 1)
+    else:
+        sa1 = [0] * len(t1)
+        for i, nm in enumerate(t1):
+            sa1[nm] = i
+    return _induceSort(t, stype, bkt, [ lms[i] for i in sa1 ])
+
+def suffixArray(s):
+    """ Given T return suffix array SA(T) using SA-IS over an integer
+        encoding of T.  O(n) time. """
+    t, k = encodeText(s)
+    return sais(t, k)[1:] # drop the sentinel suffix
+
+def differenceCover(v):
+    """ Return sorted list D of residues mod v, where v is a power of 4,
+        such that every residue mod v is a difference of two members of D.
+        Uses {0, ..., r-1} and the multiples of r, r = sqrt(v), so
+        |D| = 2r - 1. """
+    r = 1
+    while r * r < v:
+        r *= 2
+    if r * r != v:
+        raise RuntimeError("Difference cover modulus must be a power of 4, not %d" % v)
+    return sorted(set(range(0, r)) | set(range(0, v, r)))
+
+class DifferenceCoverSample(object):
+    """ Ranks of the suffixes of s (which ends in $) starting at offsets
+        whose residues mod v are in a difference cover D.  Two suffixes
+        sharing their first v characters are ordered like the sampled
+        suffixes k < v characters further along, for a k where both are
+        sampled, so any comparison takes O(v) time however long the
+        suffixes' common prefix (Karkkainen, Sanders and Burkhardt's
+        difference cover sampling).  Holds about |D| n / v ranks. """
+    
+    def __init__(self, s, v):
+        self.s, self.v = s, v
+        n = len(s)
+        self.cover = differenceCover(v)
+        self.coverIdx = [-1] * v
+        for k, d in enumerate(self.cover):
+            self.coverIdx[d] = k
+        # For each difference dl, a member a of D such that a + dl is too
+        self.via = [None] * v
+        for a in self.cover:
+            for b in self.cover:
+                if self.via[(b - a) % v] is None:
+                    self.via[(b - a) % v] = a
+        # Sampled offsets; the sample index of offset p is given by _index
+        samples = [ q * v + d for q in xrange(0, (n + v - 1) // v) for d in self.cover if q * v + d < n ]
+        # Name each sampled suffix by its first v characters
+        byWindow = sorted(xrange(0, len(samples)), cmp=lambda a, b: self.windowCmp(samples[a], samples[b]))
+        names, name = [0] * len(samples), 0
+        for k, a in enumerate(byWindow):
+            if k == 0 or self.windowCmp(samples[byWindow[k-1]], samples[a]) != 0:
+                name += 1
+            names[a] = name
+        # Sampled suffixes sort like the suffixes of the concatenated name
+        # sequences of each residue.  Each sequence's last window covers
+        # the $, so its name is unique and no comparison runs past it.
+        nd = len(self.cover)
+        order = [ a for k in xrange(0, nd) for a in xrange(k, len(samples), nd) ]
+        sa1 = sais([ names[a] for a in order ] + [0], name + 1)
+        self.ranks = intArray(len(samples), [0]) * len(samples)
+        for r in xrange(1, len(sa1)):
+            self.ranks[order[sa1[r]]] = r - 1
+    
+    def _index(self, p):
+        return (p // self.v) * len(self.cover) + self.coverIdx[p % self.v]
+    
+    def windowCmp(self, i, j, step=1024):
+        """ Compare the first v characters of suffixes i and j """
+        s, end = self.s, i + self.v
+        while i < end:
+            w = step if end - i >= step else end - i
+            a, b = s[i:i+w], s[j:j+w]
+            if a != b:
+                return cmp(a, b)
+            if len(a) < w:
+                return 0
+            i += w
+            j += w
+        return 0
+    
+    def cmp(self, i, j):
+        """ Compare suffixes i and j """
+        c = self.windowCmp(i, j)
+        if c != 0 or i == j:
+            return c
+        # Equal windows can't reach the $, so both offsets + k are < n
+        v = self.v
+        k = (self.via[(j - i) % v] - i) % v
+        return cmp(self.ranks[self._index(i + k)], self.ranks[self._index(j + k)])
+
+def blockwiseSuffixArray(s, budget=1 << 20, seed=0, fanOut=256):
+    """ Generate the suffix array of s (which ends in $) in order while
+        holding at most about budget suffix offsets at a time, a la
+        Karkkainen's blockwise suffix sorting.  Randomly chosen splitter
+        suffixes cut the suffixes into up to fanOut buckets, and a single
+        scan over the text writes each suffix offset to its bucket's
+        temporary file.  Buckets are then read back one at a time, sorted
+        and emitted.  A bucket bigger than budget is split the same way,
+        with splitters drawn from its members.  Suffixes are compared
+        with a DifferenceCoverSample whose modulus v is the smallest power
+        of 4 (from 16) with at most budget samples, so each comparison
+        takes O(v) time even on repetitive text.  Takes O(n log n)
+        comparisons and O(log(n/budget) / log(fanOut)) passes over n
+        offsets on temporary disk. """
+    import random
+    import tempfile
+    if fanOut < 3:
+        raise RuntimeError("fanOut must be at least 3, not %d" % fanOut)
+    rnd = random.Random(seed)
+    n = len(s)
+    isz = intArray(n).itemsize
+    v = 16
+    while v < n and len(differenceCover(v)) * ((n + v - 1) // v) > budget:
+        v *= 4
+    dcs = DifferenceCoverSample(s, v)
+    def sortOffsets(offs):
+        # Sort by fixed-length prefixes, then runs of ties with dcs.cmp
+        offs = sorted(offs, key=lambda i: s[i:i+32])
+        lo = 0
+        for hi in xrange(1, len(offs) + 1):
+            if hi == len(offs) or s[offs[hi]:offs[hi]+32] != s[offs[lo]:offs[lo]+32]:
+                if hi - lo > 1:
+                    offs[lo:hi] = sorted(offs[lo:hi], cmp=dcs.cmp)
+                lo = hi
+        return offs
+    def readOffsets(fh, count):
+        """ Generate count offsets from fh, reading budget at a time """
+        while count > 0:
+            offs = intArray(n)
+            offs.fromfile(fh, min(count, budget))
+            count -= len(offs)
+            for i in offs:
+                yield i
+    def distribute(offs, splitters):
+        """ Write offsets from iterable offs to one temporary file per
+            bucket, bucket b holding suffixes from splitters[b-1] up to but
+            not including splitters[b]; return (file, count) per bucket """
+        # Compare fixed-length prefixes first; only ties need dcs.cmp
+        keys = [ s[i:i+32] for i in splitters ]
+        nb = len(splitters) + 1
+        chunk = max(1, budget // nb)
+        fhs = [ tempfile.TemporaryFile() for _ in xrange(0, nb) ]
+        bufs = [ intArray(n) for _ in xrange(0, nb) ]
+        counts = [0] * nb
+        for i in offs:
+            key = s[i:i+32]
+            b = bisect_right(keys, key)
+            while b > 0 and keys[b-1] == key and dcs.cmp(i, splitters[b-1]) < 0:
+                b -= 1
+            bufs[b].append(i)
+            counts[b] += 1
+            if len(bufs[b]) >= chunk:
+                bufs[b].tofile(fhs[b])
+                bufs[b] = intArray(n)
+        for b in xrange(0, nb):
+            bufs[b].tofile(fhs[b])
+            fhs[b].seek(0)
+        return zip(fhs, counts)
+    def emit(fh, count):
+        """ Generate the offsets in fh in suffix order """
+        if count <= budget:
+            offs = intArray(n)
+            offs.fromfile(fh, count)
+            fh.close()
+            for i in sortOffsets(offs):
+                yield i
+            return
+        # Too big: cut it again, with splitters from among its members
+        sample = intArray(n)
+        for pos in sorted(rnd.sample(xrange(0, count), min(count, fanOut - 1, max(2, 2 * count // budget)))):
+            fh.seek(pos * isz)
+            sample.fromfile(fh, 1)
+        fh.seek(0)
+        buckets = distribute(readOffsets(fh, count), sortOffsets(sample))
+        fh.close()
+        for sub, subCount in buckets:
+            for i in emit(sub, subCount):
+                yield i
+    nsplit = min(n, fanOut - 1, 2 * (n // budget))
+    if nsplit == 0:
+        for i in sortOffsets(xrange(0, n)):
+            yield i
+        return
+    splitters = sortOffsets(rnd.sample(xrange(0, n), nsplit))
+    for fh, count in distribute(xrange(0, n), splitters):
+        for i in emit(fh, count):
+            yield i
+
+def kasaiLcp(s, sa, isa):
+    """ Kasai et al's O(n) algorithm: given text, its suffix array and
+        inverse suffix array, return LCP array where lcp[i] is the LCP of
+        the suffixes at rows i-1 and i, and lcp[0] = 0. """
+    n = len(s)
+    lcp = intArray(n, [0]) * n
+    h = 0
+    for i in xrange(0, n):
+        row = isa[i]
+        if row == 0:
+            h = 0
+            continue
+        j = sa[row-1]
+        # suffix i+1's LCP with its predecessor is at least h-1
+        while i + h < n and j + h < n and s[i+h] == s[j+h]:
+            h += 1
+        lcp[row] = h
+        if h > 0:
+            h -= 1
+    return lcp
+
+def lcpSearchArrays(lcp):
+    """ Given LCP array (lcp[i] = LCP of suffixes at rows i-1 and i),
+        return LLcp and RLcp arrays for LCP-accelerated binary search.
+        For each midpoint M = (L+R)/2 visited by a bisection starting from
+        L=0, R=n-1, LLcp[M] is the LCP of rows L and M and RLcp[M] is the
+        LCP of rows M and R. """
+    n = len(lcp)
+    llcp, rlcp = intArray(n, [0]) * n, intArray(n, [0]) * n
+    def fill(L, R):
+        """ Fill in entries for midpoints within (L, R); return LCP of
+            rows L and R, i.e. min of lcp[L+1..R] """
+        if R - L == 1:
+            return lcp[R]
+        M = (L + R) / 2
+        llcp[M], rlcp[M] = fill(L, M), fill(M, R)
+        return min(llcp[M], rlcp[M])
+    if n > 1:
+        fill(0, n-1)
+    return llcp, rlcp
+
+def bwtRuns(s, sa):
+    """ Given text s (ending in $) and its suffix array (any iterable,
+        e.g. blockwiseSuffixArray), generate the runs of its BWT as (char,
+        first row, SA at first row, SA at last row) tuples, without
+        materializing the BWT """
+    run = None
+    for row, off in enumerate(sa):
+        c = s[off-1] if off > 0 else '$'
+        if run is not None and c == run[0]:
+            run[3] = off
+            continue
+        if run is not None:
+            yield tuple(run)
+        run = [c, row, off, off]
+    if run is not None:
+        yield tuple(run)
+
+class LcpIntervals(object):
+    """ LCP array plus minima over blocks of ival entries, over blocks of
+        ival of those, and so on.  Finds the nearest LCP entry left or right
+        of a row that is less than a given value in O(ival * levels) time,
+        and hence the lcp-interval enclosing any SA interval, i.e. its parent
+        node in the (implicit) suffix tree. """
+    
+    def __init__(self, lcp, ival=32):
+        self.ival = ival
+        self.levels = [lcp]
+        while len(self.levels[-1]) > ival:
+            a = self.levels[-1]
+            self.levels.append(intArray(len(lcp), [ min(a[i:i+ival]) for i in xrange(0, len(a), ival) ]))
+    
+    def __len__(self):
+        return len(self.levels[0])
+    
+    def __getitem__(self, i):
+        return self.levels[0][i]
+    
+    def prevLess(self, i, v):
+        """ Return largest x <= i with lcp[x] < v, or -1 if there is none """
+        levels, B = self.levels, self.ival
+        lev, x = 0, i
+        while True:
+            a = levels[lev]
+            stop = 0 if lev == len(levels) - 1 else x - x % B
+            while x >= stop and a[x] >= v:
+                x -= 1
+            if x >= stop:
+                break
+            if stop == 0:
+                return -1
+            x, lev = stop // B - 1, lev + 1
+        # Descend to rightmost entry < v within block x at each level
+        while lev > 0:
+            lev -= 1
+            a = levels[lev]
+            x = min(x * B + B, len(a)) - 1
+            while a[x] >= v:
+                x -= 1
+        return x
+    
+    def nextLess(self, i, v):
+        """ Return smallest x >= i with lcp[x] < v, or len(lcp) if there is
+            none """
+        levels, B, n = self.levels, self.ival, len(self.levels[0])
+        if i >= n:
+            return n
+        lev, x = 0, i
+        while True:
+            a = levels[lev]
+            stop = len(a) if lev == len(levels) - 1 else min(x - x % B + B, len(a))
+            while x < stop and a[x] >= v:
+                x += 1
+            if x < stop:
+                break
+            if stop == len(a):
+                return n
+            x, lev = stop // B, lev + 1
+        # Descend to leftmost entry < v within block x at each level
+        while lev > 0:
+            lev -= 1
+            a = levels[lev]
+            x *= B
+            while a[x] >= v:
+                x += 1
+        return x
+    
+    def parent(self, l, r):
+        """ Given right-open SA interval [l, r) of all suffixes having some
+            string as a prefix, return (d, l', r'): the length of that
+            string's longest prefix with a wider interval, and the interval.
+            Returns (0, 0, n) if that prefix is empty. """
+        n = len(self.levels[0])
+        d = max(self[l] if l > 0 else 0, self[r] if r < n else 0)
+        if d == 0:
+            return 0, 0, n
+        return int(d), self.prevLess(l, d), self.nextLess(r, d)
+    
+    def meta(self):
+        return { 'ival': self.ival, 'levels': len(self.levels) }
+    
+    def sections(self, prefix):
+        """ Return (name, array) pairs for saving to an index file """
+        return [ (prefix + str(i), a) for i, a in enumerate(self.levels) ]
+    
+    @classmethod
+    def fromSections(cls, meta, secs, prefix):
+        """ Rebuild from metadata and sections loaded from an index file """
+        iv = cls.__new__(cls)
+        iv.ival = meta['ival']
+        iv.levels = [ secs[prefix + str(i)] for i in xrange(0, meta['levels']) ]
+        return iv
+
+class QueryStats(object):
+    """ Opt-in counters for profiling queries.  Instrumented methods check
+        whether their object has a QueryStats and, if so, call add to bump
+        a plain counter or record to add one call's value (e.g. LF steps
+        taken by one resolve) to that counter's histogram.  toDict exports
+        everything since the last reset, so a histogram can be taken for
+        each batch of queries. """
+    
+    def __init__(self):
+        self.reset()
+    
+    def reset(self):
+        self.counts = {} # name -> total
+        self.hists = {}  # name -> {value: # times recorded}
+    
+    def add(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+    
+    def record(self, name, value):
+        hist = self.hists.get(name)
+        if hist is None:
+            hist = self.hists[name] = {}
+        hist[value] = hist.get(value, 0) + 1
+    
+    def toDict(self, reset=False):
+        """ Return dict holding plain counters under 'counts' and, under
+            'hists', each histogram along with the number, total, mean and
+            max of the values recorded.  If reset is True, start a new
+            batch. """
+        d = { 'counts': dict(self.counts), 'hists': {} }
+        for name, hist in self.hists.iteritems():
+            n = sum(hist.itervalues())
+            tot = sum([ v * k for v, k in hist.iteritems() ])
+            d['hists'][name] = { 'n': n, 'total': tot, 'mean': tot / float(n),
+                                 'max': max(hist), 'hist': dict(hist) }
+        if reset:
+            self.reset()
+        return d
+
+class KmerTable(object):
+    """ Maps every length-k string over the alphabet of a text (all its
+        characters except $) to the right-open interval of suffix array
+        (equivalently BWM) rows having that k-mer as a prefix.  k-mers that
+        don't occur get an empty interval at the row where they would be.
+        Table has alphabet size ** k entries. """
+    
+    def __init__(self, s, sa, k):
+        """ Build from text s, which ends in $, and its suffix array """
+        self.k = k
+        self.alph = ''.join(sorted(set(s) - set('$')))
+        sigma, n = len(self.alph), len(s)
+        size = sigma ** k
+        if size >= (1 << 31):
+            raise RuntimeError("k-mer table would have %d entries" % size)
+        digit = dict((c, i) for i, c in enumerate(self.alph))
+        # key[i] is the code of the k-mer at offset i, reading characters
+        # past the end as the smallest digit; exact iff it didn't run off
+        key = [0] * n
+        hi = sigma ** (k-1) if k > 0 else 0
+        code = 0
+        for i in xrange(n-2, -1, -1):
+            code = digit[s[i]] * hi + code // sigma
+            key[i] = code
+        self.l, self.r = intArray(n, [0]) * size, intArray(n, [0]) * size
+        nxt = 0 # lowest code whose interval hasn't started yet
+        for row in xrange(0, n):
+            off = sa[row]
+            kk = key[off]
+            while nxt < kk:
+                self.l[nxt] = self.r[nxt] = row
+                nxt += 1
+            if off + k <= n - 1:
+                if nxt == kk:
+                    self.l[kk] = row
+                    nxt += 1
+                self.r[kk] = row + 1
+        while nxt < size:
+            self.l[nxt] = self.r[nxt] = n
+            nxt += 1
+        self.digit = digit
+    
+    def interval(self, kmer):
+        """ Return interval for kmer, or None if kmer has a character not in
+            the alphabet """
+        code, digit = 0, self.digit
+        for c in kmer:
+            d = digit.get(c)
+            if d is None:
+                return None
+            code = code * len(self.alph) + d
+        return int(self.l[code]), int(self.r[code])
+    
+    def meta(self):
+        return { 'k': self.k, 'alph': map(ord, self.alph) }
+    
+    def sections(self, prefix):
+        """ Return (name, array) pairs for saving to an index file """
+        return [ (prefix + 'l', self.l), (prefix + 'r', self.r) ]
+    
+    @classmethod
+    def fromSections(cls, meta, secs, prefix):
+        """ Rebuild from metadata and sections loaded from an index file """
+        tab = cls.__new__(cls)
+        tab.k, tab.alph = meta['k'], ''.join(map(chr, meta['alph']))
+        tab.digit = dict((c, i) for i, c in enumerate(tab.alph))
+        tab.l, tab.r = secs[prefix + 'l'], secs[prefix + 'r']
+        return tab
 
 class SuffixArray(object):
     """ Encapsulates suffix array of a string. """
     
-    def __init__(self, s, sa=None, sanityChecks=False):
+    def __init__(self, s, sa=None, lcp=None, sanityChecks=False):
         self.s = s # Store string
         self.slen = len(self.s)
-        if sa is not None:
-            self.sa = sa
-        else:
-            satups = sorted([(s[i:], i) for i in xrange(0, len(s))])
-            self.sa = map(lambda x: x[1], satups)
+        if sa is None:
+            sa = suffixArray(s)
+        # SA and (optional) LCP are stored as compact typed arrays
+        self.sa = intArray(self.slen, sa)
+        self.lcp = self.llcp = self.rlcp = None
+        if lcp is not None:
+            self.setLcp(intArray(self.slen, lcp))
+        self.kmers = None
+        self.stats = None
+        if sanityChecks:
+            assert list(self.sa) == naiveSuffixArray(s)
     
     @classmethod
     def fromString(cls, s, sanityChecks=False):
@@ -28,36 +596,206 @@ class SuffixArray(object):
     
     @classmethod
     def fromSuffixTree(cls, stree, sanityChecks=False):
-        return cls(stree.s, sa=[ sa for sa in stree.sa() ], sanityChecks=sanityChecks)
+        sa, lcp = stree.saAndLcpArrays()
+        s = stree.s if isinstance(stree.s, str) else stree.s.tostring() # CompactSuffixTree's is an array
+        return cls(s, sa=sa, lcp=lcp, sanityChecks=sanityChecks)
+    
+    def setLcp(self, lcp):
+        """ Set LCP array and derive LLcp/RLcp arrays from it, so that
+            searches use LCP-accelerated binary search """
+        self.lcp = lcp
+        self.llcp, self.rlcp = lcpSearchArrays(lcp)
+    
+    def buildKmerTable(self, k):
+        """ Build a KmerTable for k-mers of the text, used by range to
+            narrow binary searches """
+        self.kmers = KmerTable(self.s, self.sa, k)
+    
+    def save(self, fn):
+        """ Write text, suffix array, LCP and k-mer table (if present) to
+            file fn """
+        sections = [ ('s', self.s), ('sa', self.sa) ]
+        meta = { 'slen': self.slen }
+        if self.lcp is not None:
+            sections += [ ('lcp', self.lcp), ('llcp', self.llcp), ('rlcp', self.rlcp) ]
+        if self.kmers is not None:
+            meta['kmers'] = self.kmers.meta()
+            sections += self.kmers.sections('kmer.')
+        writeIndexFile(fn, 'SuffixArray', meta, sections)
+    
+    @classmethod
+    def load(cls, fn, mmap=True):
+        """ Load suffix array saved with save.  With mmap=True the text and
+            arrays are memory-mapped rather than read into memory. """
+        meta, secs = readIndexFile(fn, 'SuffixArray', useMmap=mmap)
+        sa = cls.__new__(cls)
+        sa.s, sa.slen = secs['s'], meta['slen']
+        sa.sa, sa.lcp = secs['sa'], secs.get('lcp')
+        sa.llcp, sa.rlcp = secs.get('llcp'), secs.get('rlcp')
+        sa.kmers = None
+        if 'kmers' in meta:
+            sa.kmers = KmerTable.fromSections(meta['kmers'], secs, 'kmer.')
+        sa.stats = None
+        return sa
+    
+    def enableStats(self, stats=None):
+        """ Start counting character comparisons made by first and range
+            in stats (a new QueryStats if None), which is returned.  Set
+            self.stats to None to stop. """
+        self.stats = stats if stats is not None else QueryStats()
+        return self.stats
+    
+    def lcpBound(self, p, upper=False):
+        """ LCP-accelerated binary search (Manber & Myers).  Return the
+            first row whose suffix is >= p or, if upper is True, the first
+            row whose suffix is > p and doesn't have p as a prefix.  Keeps
+            the LCP of p with the suffixes at both ends of the current
+            interval and uses LLcp/RLcp to skip characters already
+            compared, so takes O(|p| + log n) character comparisons. """
+        return self._lcpBound(p, upper)[0]
+    
+    def _lcpBound(self, p, upper=False):
+        """ lcpBound, also returning # character comparisons made """
+        s, sa, llcp, rlcp, plen = self.s, self.sa, self.llcp, self.rlcp, len(p)
+        slen = len(s)
+        ncmp = [0]
+        def match(row, j):
+            """ Extend match between p and suffix at row from j; return
+                new match length and whether suffix counts as less """
+            off, j0 = sa[row], j
+            while j < plen and off + j < slen and s[off + j] == p[j]:
+                j += 1
+            if j == plen:
+                ncmp[0] += j - j0
+                return j, upper
+            if off + j == slen:
+                # suffix is a proper prefix of p, so it's less
+                ncmp[0] += j - j0
+                return j, True
+            ncmp[0] += j - j0 + 1
+            return j, s[off + j] < p[j]
+        L, R = 0, self.slen - 1
+        l, less = match(L, 0)
+        if not less:
+            return 0, ncmp[0]
+        r, less = match(R, 0)
+        if less:
+            return self.slen, ncmp[0] # fell off right-hand side
+        while R - L > 1:
+            M = (L + R) / 2
+            if l >= r:
+                # suffix at M shares llcp[M] chars with suffix at L, which
+                # shares l chars with p
+                if llcp[M] > l:
+                    L = M
+                    continue
+                elif llcp[M] < l:
+                    R, r = M, llcp[M]
+                    continue
+                m, less = match(M, l)
+            else:
+                if rlcp[M] > r:
+                    R = M
+                    continue
+                elif rlcp[M] < r:
+                    L, l = M, rlcp[M]
+                    continue
+                m, less = match(M, r)
+            if less:
+                L, l = M, m
+            else:
+                R, r = M, m
+        return R, ncmp[0]
     
     def first(self, p):
         """ Return 1st SA element with p as a prefix if such element
             exists, or the offset where it would be otherwise. """
+        row, ncmp = self._first(p)
+        if self.stats is not None:
+            self.stats.record('firstCmp', ncmp)
+        return row
+    
+    def _first(self, p):
+        """ first, also returning # character comparisons made """
+        if self.llcp is not None and len(p) > 0:
+            return self._lcpBound(p)
         L, R = 0, self.slen - 1
+        ncmp, i = 0, -1
+        if len(p) > 0 and p[0] <= self.s[self.sa[0]]:
+            # the search below never probes row 0, so check it here
+            ncmp += 1
+            if p <= self.s[self.sa[0]:self.sa[0] + len(p)]:
+                return 0, ncmp
         while R - L > 1:
             M = (L + R) / 2
             bisectLeft = True
             for i in xrange(0, len(p)):
+                if self.sa[M] + i == self.slen:
+                    # suffix is a proper prefix of p, so it's less
+                    bisectLeft = False
+                    break
                 if p[i] < self.s[self.sa[M] + i]:
                     break
                 elif p[i] > self.s[self.sa[M] + i]:
                     bisectLeft = False
                     break
+            ncmp += i + 1
             if bisectLeft: R = M
             else:          L = M
         if R == self.slen-1 and p > self.s[self.sa[R]:]:
-            return self.slen # special case: fell off right-hand side
-        return R
+            return self.slen, ncmp # special case: fell off right-hand side
+        return R, ncmp
     
     def range(self, p):
         """ Return the range of suffix array rows having p as a prefix,
             or empty range if no elements have p as a prefix.
             Right-hand extreme is exclusive. """
-        pp = p[:-1]
-        pp += chr(ord(p[-1])+1) # pp = string just a bit greater than p
-        l, r = self.first(p), self.first(pp)
+        if self.llcp is not None and len(p) > 0:
+            (l, lcmp), (r, rcmp) = self._lcpBound(p), self._lcpBound(p, upper=True)
+        else:
+            bounds = None
+            if self.kmers is not None and len(p) >= self.kmers.k:
+                bounds = self.kmers.interval(p[:self.kmers.k])
+            if bounds is not None:
+                # Probes compare slices; count each as len(p) comparisons
+                l, r, nprobes = self._rangeWithin(p, bounds[0], bounds[1])
+                lcmp, rcmp = nprobes * len(p), 0
+            else:
+                pp = p[:-1]
+                pp += chr(ord(p[-1])+1) # pp = string just a bit greater than p
+                (l, lcmp), (r, rcmp) = self._first(p), self._first(pp)
+        if self.stats is not None:
+            self.stats.record('rangeCmp', lcmp + rcmp)
         return l, r
     
+    def rangeWithin(self, p, lo, hi):
+        """ Return the range of suffix array rows having p as a prefix,
+            given that all such rows are within [lo, hi) """
+        return self._rangeWithin(p, lo, hi)[:2]
+    
+    def _rangeWithin(self, p, lo, hi):
+        """ rangeWithin, also returning # of suffixes compared with p """
+        l, r, plen = lo, hi, len(p)
+        nprobes = 0
+        while l < r:
+            nprobes += 1
+            mid = (l+r) // 2
+            midsa = self.sa[mid]
+            if self.s[midsa:midsa+plen] < p:
+                l = mid + 1
+            else:
+                r = mid
+        start, r = l, hi
+        while l < r:
+            nprobes += 1
+            mid = (l+r) // 2
+            midsa = self.sa[mid]
+            if self.s[midsa:midsa+plen] == p:
+                l = mid + 1
+            else:
+                r = mid
+        return start, l, nprobes
+    
     def range2(self, p):
         """ Find range of suffix array elements that have p as a prefix """
         l = 0
@@ -85,15 +823,14 @@ class SuffixArray(object):
         return (s, r)
     
     def rangeCount(self, p):
-        """ Find range of suffix array elements that have p as a prefix """
+        """ Find range of suffix array elements that have p as a prefix.
+            Returns (start, end, # character comparisons made). """
         l = 0
-        r = len(self.s)+1
+        r = self.slen
         ncmp = 0
         # bisect until l points at first element with p as prefix
         while l < r:
             mid = (l+r) / 2
-            assert mid != r
-            print (m, l, r)
             midsa = self.sa[mid]
             gt = False
             for i in xrange(0, len(p)):
@@ -108,26 +845,22 @@ class SuffixArray(object):
             else:
                 r = mid
         s = l # save l, which is the final l
-        # bisect until r points just below final element with p as prefix
-        r = len(self.s) + 1
+        # bisect until l points just past final element with p as prefix
+        r = self.slen
         while l < r:
             mid = (l+r) / 2
-            assert mid != r
-            print (m, l, r)
             midsa = self.sa[mid]
             equ = True
             for i in xrange(0, len(p)):
                 ncmp += 1
-                if p[i] != self.s[midsa + i]:
+                if midsa + i >= self.slen or p[i] != self.s[midsa + i]:
                     equ = False
                     break # bisect!
             if equ:
-                if l == mid:
-                    break # bisect!
-                l = mid
+                l = mid + 1
             else:
                 r = mid
-        return (s, r, ncmp)
+        return (s, l, ncmp)
     
     def hasSubstring(self, p):
         """ Return true if and only if p is substring of indexed text """
@@ -153,9 +886,28 @@ class SuffixArray(object):
         assert dollarRow is not None
         return (''.join(bw), dollarRow) # return string-ized version of list bw
     
+    def toBwtRuns(self):
+        """ Generate runs of the BWT as (char, first row, SA at first row,
+            SA at last row) tuples; see bwtRuns """
+        return bwtRuns(self.s, self.sa)
+    
     def toIsa(self, upto=None):
-        """ Convert suffix array to inverse suffix array """
-        pass
+        """ Convert suffix array to inverse suffix array: isa[i] is the row
+            of the suffix at offset i.  If upto is given, return only the
+            entries for offsets less than upto. """
+        n = self.slen if upto is None else min(upto, self.slen)
+        isa = intArray(self.slen, [0]) * n
+        for row in xrange(0, self.slen):
+            off = self.sa[row]
+            if off < n:
+                isa[off] = row
+        return isa
+    
+    def computeLcp(self):
+        """ Compute LCP array with Kasai's algorithm in O(n) time, install
+            it with setLcp and return it """
+        self.setLcp(kasaiLcp(self.s, self.sa, self.toIsa()))
+        return self.lcp
     
     def sampleByRank(self, e):
         """ Generate a sample of the suffix array where we take suffixes with
@@ -210,6 +962,180 @@ if __name__ == "__main__":
                 self.assertFalse(sa.hasSubstring("aa"))
                 self.assertFalse(sa.hasSubstring("zz"))
                 self.assertTrue(sa.hasSuffix("acgt"))
+
+        def test_compact_1(self):
+            sa = SuffixArray.fromString("abaaba")
+            self.assertEqual('I', sa.sa.typecode)
+            self.assertEqual([6, 5, 2, 3, 0, 4, 1], list(sa.sa))
+            self.assertEqual(None, sa.lcp)
+            sa = SuffixArray.fromSuffixTree(SuffixTree("abaaba"))
+            self.assertEqual([6, 5, 2, 3, 0, 4, 1], list(sa.sa))
+            self.assertEqual([0, 0, 1, 1, 3, 0, 2], list(sa.lcp))
+            self.assertEqual('I', sa.lcp.typecode)
+
+        def test_save_load_1(self):
+            import os
+            import tempfile
+            fd, fn = tempfile.mkstemp(suffix='.sa')
+            os.close(fd)
+            try:
+                SuffixArray.fromSuffixTree(SuffixTree("abaaba")).save(fn)
+                for mmap in (True, False):
+                    sa = SuffixArray.load(fn, mmap=mmap)
+                    self.assertEqual([6, 5, 2, 3, 0, 4, 1], list(sa.sa))
+                    self.assertEqual([0, 0, 1, 1, 3, 0, 2], list(sa.lcp))
+                    self.assertEqual((5, 7), sa.range("ba"))
+                    self.assertTrue(sa.hasSuffix("aba"))
+                    self.assertFalse(sa.hasSubstring("abb"))
+            finally:
+                os.remove(fn)
+
+        def test_kmer_table_1(self):
+            import random
+            random.seed(3)
+            for t in ("abaaba", "acgtacgtacgtacgt", "AAAAAAAAAAA",
+                      ''.join([random.choice("ACGT") for _ in xrange(0, 500)])):
+                sa = SuffixArray.fromString(t)
+                ranges = {}
+                for k in (1, 2, 3):
+                    sa.buildKmerTable(k)
+                    for i in xrange(0, len(sa.kmers.alph) ** k):
+                        # every k-mer's interval matches a binary search
+                        kmer, j = '', i
+                        for _ in xrange(0, k):
+                            kmer = sa.kmers.alph[j % len(sa.kmers.alph)] + kmer
+                            j //= len(sa.kmers.alph)
+                        self.assertEqual(sa.rangeWithin(kmer, 0, sa.slen), sa.kmers.interval(kmer))
+                    for p in [ t[i:i+random.randint(1, 8)] for i in xrange(0, len(t)) ] + [ "acgtt", "z", "ACGTZ" ]:
+                        if p not in ranges:
+                            sa.kmers = None
+                            ranges[p] = sa.range(p)
+                            sa.buildKmerTable(k)
+                        l, r = sa.range(p)
+                        self.assertEqual(ranges[p][1] - ranges[p][0], r - l)
+                        if r > l:
+                            self.assertEqual(ranges[p], (l, r))
+
+        def test_lcp_search_1(self):
+            import random
+            random.seed(29)
+            for t in ("abaaba", "acgtacgtacgtacgt", "AAAAAAAAAAA",
+                      ''.join([random.choice("AC") for _ in xrange(0, 300)]),
+                      ''.join([random.choice("ACGT") for _ in xrange(0, 300)])):
+                plain = SuffixArray.fromString(t)
+                withLcp = SuffixArray.fromSuffixTree(SuffixTree(t))
+                self.assertTrue(withLcp.llcp is not None)
+                ps = [ t[i:i+random.randint(1, 12)] for i in xrange(0, len(t)) ]
+                ps += [ t[i:i+5] + 'A' for i in xrange(0, len(t)) ] + [ "z", "0", t + "A", t ]
+                # patterns running off the end of the text ($ sorts high
+                # against "!" and low against "A")
+                ps += [ "$A", "!", "$", t[-3:] + "$A" ]
+                for p in ps:
+                    l, r = plain.range(p)
+                    self.assertEqual(max(r - l, 0), max(0, withLcp.range(p)[1] - withLcp.range(p)[0]))
+                    if r > l:
+                        self.assertEqual((l, r), withLcp.range(p))
+                    self.assertEqual(plain.first(p), withLcp.first(p))
+                    self.assertEqual(plain.hasSubstring(p), withLcp.hasSubstring(p))
+                    self.assertEqual(plain.hasSuffix(p), withLcp.hasSuffix(p))
+
+        def test_stats_1(self):
+            import random
+            random.seed(97)
+            t = ''.join([random.choice("ACGT") for _ in xrange(0, 300)])
+            plain, withLcp, withKmers = SuffixArray.fromString(t), SuffixArray.fromString(t), SuffixArray.fromString(t)
+            withLcp.computeLcp()
+            withKmers.buildKmerTable(3)
+            ps = [ t[i:i+random.randint(1, 8)] for i in xrange(0, len(t), 7) ] + [ "z", "0", "ACGTN" ]
+            for p in ps:
+                l, r = plain.range(p)
+                cl, cr, ncmp = plain.rangeCount(p)
+                self.assertEqual(max(r - l, 0), cr - cl)
+                self.assertTrue(ncmp > 0)
+            for sa in (plain, withLcp, withKmers):
+                self.assertEqual(None, sa.stats)
+                stats = sa.enableStats()
+                for p in ps:
+                    sa.range(p)
+                    sa.first(p)
+                d = stats.toDict(reset=True)
+                self.assertEqual(len(ps), d['hists']['rangeCmp']['n'])
+                self.assertEqual(len(ps), d['hists']['firstCmp']['n'])
+                self.assertTrue(0 < d['hists']['firstCmp']['total'] <= d['hists']['rangeCmp']['total'])
+                self.assertEqual(d['hists']['rangeCmp']['total'], sum([ k * v for k, v in d['hists']['rangeCmp']['hist'].iteritems() ]))
+                self.assertEqual({ 'counts': {}, 'hists': {} }, stats.toDict())
+
+        def test_isa_lcp_1(self):
+            import random
+            random.seed(31)
+            for t in ("abaaba", "acgtacgtacgtacgt", "AAAAAAAAAAA",
+                      ''.join([random.choice("ACGT") for _ in xrange(0, 300)])):
+                sa = SuffixArray.fromString(t)
+                isa = sa.toIsa()
+                self.assertEqual(sa.sa.typecode, isa.typecode)
+                for row in xrange(0, sa.slen):
+                    self.assertEqual(row, isa[sa.sa[row]])
+                self.assertEqual(list(isa[:5]), list(sa.toIsa(5)))
+                self.assertEqual(None, sa.lcp)
+                lcp = sa.computeLcp()
+                self.assertEqual(list(SuffixTree(t).saAndLcpArrays()[1]), list(lcp))
+                self.assertTrue(sa.llcp is not None)
+                self.assertTrue(sa.hasSubstring(t[3:9]))
+
+        def test_lcp_intervals_1(self):
+            import random
+            random.seed(37)
+            t = ''.join([random.choice("AC") for _ in xrange(0, 500)])
+            lcp = SuffixArray.fromString(t).computeLcp()
+            for ival in (2, 3, 32):
+                iv = LcpIntervals(lcp, ival)
+                for _ in xrange(0, 300):
+                    i, v = random.randint(0, len(lcp) - 1), random.randint(0, 12)
+                    less = [ x for x in xrange(0, len(lcp)) if lcp[x] < v ]
+                    self.assertEqual(max([-1] + [ x for x in less if x <= i ]), iv.prevLess(i, v))
+                    self.assertEqual(min([len(lcp)] + [ x for x in less if x >= i ]), iv.nextLess(i, v))
+
+        def test_blockwise_1(self):
+            import random
+            random.seed(53)
+            texts = [ "$", "A$", "abaaba$", "A" * 100 + "$", "ACGT" * 30 + "$" ]
+            texts += [ ''.join([random.choice("ACGT") for _ in xrange(0, 500)]) + "$" ]
+            for t in texts:
+                for budget in (1, 7, 64, 1000):
+                    self.assertEqual(list(suffixArray(t)), list(blockwiseSuffixArray(t, budget)))
+                # few buckets per pass, so big buckets are split repeatedly
+                self.assertEqual(list(suffixArray(t)), list(blockwiseSuffixArray(t, 5, fanOut=3)))
+            self.assertRaises(RuntimeError, list, blockwiseSuffixArray(texts[-1], 5, fanOut=2))
+        
+        def test_difference_cover_1(self):
+            import random
+            random.seed(59)
+            for v in (16, 64, 256):
+                cover = differenceCover(v)
+                self.assertEqual(set(xrange(0, v)), set((b - a) % v for a in cover for b in cover))
+            self.assertRaises(RuntimeError, differenceCover, 32)
+            unit = ''.join([random.choice("ACGT") for _ in xrange(0, 40)])
+            for t in ("A" * 300 + "$", unit * 8 + "$", "ACGT" * 50 + "$"):
+                sa = suffixArray(t)
+                for v in (16, 64):
+                    dcs = DifferenceCoverSample(t, v)
+                    for k in xrange(1, len(sa)):
+                        self.assertEqual(-1, dcs.cmp(sa[k-1], sa[k]))
+                        self.assertEqual(1, dcs.cmp(sa[k], sa[k-1]))
+                for budget in (20, 1000):
+                    self.assertEqual(sa, list(blockwiseSuffixArray(t, budget)))
+
+        def test_sais_1(self):
+            for s in ("", "a", "abaaba$", "mississippi$", "AAAAAAAA", "ACGTACGTACGT$"):
+                self.assertEqual(naiveSuffixArray(s), suffixArray(s))
+
+        def test_sais_random(self):
+            import random
+            random.seed(47)
+            for ln in xrange(1, 200, 7):
+                for alph in ("AC", "ACGT", "ACGTN"):
+                    s = ''.join([random.choice(alph) for _ in xrange(0, ln)]) + '$'
+                    self.assertEqual(naiveSuffixArray(s), suffixArray(s))
     
     import sys
     unittest.main(argv=[sys.argv[0]])
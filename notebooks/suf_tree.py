@@ -6,6 +6,7 @@ Suffix tree implementation using Ukkonen's algorithm.
 
 import sys
 import os
+from array import array
 
 class SuffixTree(object):
     
@@ -14,13 +15,21 @@ class SuffixTree(object):
             labeling the incoming edge.  Also contains outgoing edges, and some
             (hopefully O(1) space) extra annotations. """
         
+        __slots__ = ('off', 'ln', 'slink', 'id', 'out', 'extra')
+        
         def __init__(self, off, ln, id=None):
             self.off = off    # offset into T of substring on edge leading into this node
             self.ln = ln      # length of substring on edge leading into this node
             self.slink = None # suffix link from this node
             self.id = id      # id; for leaf nodes, this is the suffix
             self.out = {}     # outgoing edges; characters x nodes
-            self.extra = {}   # extra per-node info
+            self.extra = None # extra per-node info; dict made on first annotate
+        
+        def annotate(self, key, val):
+            """ Set extra annotation key to val """
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = val
         
         def isLeaf(self):
             return len(self.out) == 0
@@ -54,7 +63,7 @@ class SuffixTree(object):
     
     def stripAnnotations(self):
         """ Strip away any extra information associated with nodes """
-        for n in self.nodes: n.extra = {}
+        for n in self.nodes: n.extra = None
     
     def __splitEdge(self, node, outc, depth):
         """ Create a new node in the middle of the edge given by node, outc """
@@ -64,8 +73,8 @@ class SuffixTree(object):
         assert depth < child.ln
         mid = self.Node(child.off, depth)
         self.nodes.append(mid)
-        mid.extra['parent'] = node
-        child.extra['parent'] = mid
+        mid.annotate('parent', node)
+        child.annotate('parent', mid)
         node.out[outc] = mid
         child.off += depth
         child.ln -= depth
@@ -139,8 +148,82 @@ class SuffixTree(object):
                     return cur, c, d
             assert False
     
+    def __skipCountFast(self, v, d, off, parent):
+        """ Same as __skipCount but without asserts or slicing.  parent is
+            v's parent, used only if v does not have a suffix link yet. """
+        if v.slink is None and v is not self.root:
+            off = v.off
+            d += v.ln
+            v = parent
+        if v is self.root:
+            cur = v
+            d -= 1
+            off += 1
+        else:
+            cur = v.slink
+        s = self.s
+        while d > 0:
+            nxt = cur.out[s[off]]
+            ln = nxt.ln
+            if ln < d:
+                d -= ln
+                off += ln
+                cur = nxt
+            elif ln == d:
+                return nxt, None, 0
+            else:
+                return cur, s[off], d
+        return cur, None, 0
+    
+    def __ukkonenFast(self, root, bottom):
+        """ Perform all phases and extensions of Ukkonen's algorithm without
+            sanity checks.  Nodes carry no parent annotations: the only
+            parent skip/count ever needs is that of the internal node made by
+            the latest split, whose suffix link is not set yet, so it is
+            tracked alongside that node. """
+        s, n, Node, nodes = self.s, len(self.s), self.Node, self.nodes
+        skipCount = self.__skipCountFast
+        skipext = 1
+        lastleaf = bottom
+        lastn, lastp = root, None # parent of last new leaf, and its parent
+        for i in xrange(0, n-1): # Phases
+            lastInternal = None
+            c = s[i+1] # new character
+            v, vp, d, off = lastn, lastp, i + 1 - lastleaf.off, lastleaf.off
+            for j in xrange(skipext, i+2): # Extensions
+                node, outc, depth = skipCount(v, d, off, vp)
+                if depth == 0: # skip-count ended in node
+                    if lastInternal is not None:
+                        lastInternal.slink = node
+                        lastInternal = None
+                    if c in node.out:
+                        break # Rule 3: Already there
+                    # Rule 2: not already there; create a new leaf
+                    v, vp = node, None
+                else: # skip-count ended in edge
+                    child = node.out[outc]
+                    if s[child.off + depth] == c:
+                        break # Rule 3: Already there
+                    # Rule 2: Not already there; split edge
+                    mid = Node(child.off, depth)
+                    nodes.append(mid)
+                    node.out[outc] = mid
+                    child.off += depth
+                    child.ln -= depth
+                    mid.out[s[child.off]] = child
+                    if lastInternal is not None:
+                        lastInternal.slink = mid
+                    lastInternal = mid
+                    v, vp = mid, node
+                v.out[c] = lastleaf = Node(i+1, n-i-1, id=j)
+                nodes.append(lastleaf)
+                lastn, lastp = v, vp
+                d, off = 0, i+1
+                skipext = j+1
+    
     def __ukkonen(self, root, bottom, toDot=None, sanity=False):
-        """ Perform all phases and extensions of Ukkonen's algorithm """
+        """ Perform all phases and extensions of Ukkonen's algorithm,
+            checking invariants along the way """
         s = self.s
         # Some extension positions are "rooted", i.e. all subsequent
         # extensions of that suffix will fall into "Case 1" whereby the root
@@ -164,7 +247,7 @@ class SuffixTree(object):
                         lastn, lastdepth, lastoff = node, 0, i+1
                         node.out[c] = lastleaf = self.Node(i+1, len(s)-i-1, id=j)
                         self.nodes.append(lastleaf)
-                        node.out[c].extra['parent'] = node
+                        node.out[c].annotate('parent', node)
                     else: break # Rule 3: Already there
                 else: # skip-count ended in edge
                     assert outc is not None
@@ -176,7 +259,7 @@ class SuffixTree(object):
                         # mid is a new internal node, in need of a suffix link 
                         mid.out[c] = lastleaf = self.Node(i+1, len(s)-i-1, id=j)
                         self.nodes.append(lastleaf)
-                        mid.out[c].extra['parent'] = mid
+                        mid.out[c].annotate('parent', mid)
                         if lastInternal is not None:
                             assert lastInternal.slink is None
                             lastInternal.slink = mid
@@ -197,17 +280,21 @@ class SuffixTree(object):
         if sanity:
             assert self.repOk()
     
-    def __init__(self, s, toDot=None, sanity=False):
-        """ Ukkonen's algorithm to build suffix tree """
+    def __init__(self, s, toDot=None, sanity=False, fast=True):
+        """ Ukkonen's algorithm to build suffix tree.  Unless sanity or
+            toDot is set (or fast is False), uses the fast build that skips
+            the assertions and parent annotations. """
         s += '$'
         self.s = s
         self.root = root = self.Node(0, 0)
-        root.extra['parent'] = None
         root.out[s[0]] = bottom = self.Node(0, len(s), id=0)
-        bottom.extra['parent'] = root
-        assert bottom.isLeaf()
         self.nodes = [root, bottom]
-        self.__ukkonen(root, bottom, toDot=toDot, sanity=sanity)
+        if fast and not sanity and toDot is None:
+            self.__ukkonenFast(root, bottom)
+        else:
+            root.annotate('parent', None)
+            bottom.annotate('parent', root)
+            self.__ukkonen(root, bottom, toDot=toDot, sanity=sanity)
     
     def suffixesBelow(self, l):
         """ Given a suffix tree locus, return a list of the suffixes below this
@@ -218,11 +305,13 @@ class SuffixTree(object):
         if l.below > 0:
             # ...descend to the next node below
             l = self.Locus(l.nb, None, None, 0)
-        def __suffixesBelowHelper(n, sufs):
+        # Depth-first traversal with an explicit stack, so deep trees don't
+        # hit the recursion limit
+        stack = [l.na]
+        while len(stack) > 0:
+            n = stack.pop()
             if n.isLeaf(): sufs.append(n.id)
-            for child in n.out.itervalues():
-                __suffixesBelowHelper(child, sufs)
-        __suffixesBelowHelper(l.na, sufs)
+            stack.extend(reversed(n.out.values()))
         return sufs
     
     def mems(self, p, l=4):
@@ -344,36 +433,46 @@ class SuffixTree(object):
         """ Generate suffix array and an LCP array corresponding to this
             suffix tree.  For a given SA elt, the LCP returned is the LCP
             between the elt and the next-smallest.  For the first suffix, LCP
-            of 0 is reported. """
-        self.minSinceLeaf = 0
-        def __visit(n, depth):
+            of 0 is reported.  Traverses with an explicit stack, so takes
+            O(n) time overall and works on arbitrarily deep trees. """
+        minSinceLeaf = 0
+        stack = [(self.root, 0)] # (node, string depth of its parent)
+        while len(stack) > 0:
+            n, pdepth = stack.pop()
+            # LCP between consecutive leaves is the depth of their lowest
+            # common ancestor, the shallowest parent entered in between
+            minSinceLeaf = min(minSinceLeaf, pdepth)
+            depth = pdepth + n.ln
             if len(n.out) == 0:
                 # leaf node, yield offset and LCP with previous
-                yield (len(self.s) - depth, self.minSinceLeaf)
+                yield (len(self.s) - depth, minSinceLeaf)
                 # reset LCP to depth of most recently reported leaf
-                self.minSinceLeaf = depth
-            # visit children in lexicographical order
-            for c, child in sorted(n.out.iteritems()):
-                for x in __visit(child, depth + child.ln):
-                    yield x
-                # after each child visit, perhaps decrease
-                # minimum-depth-since-last-leaf value
-                self.minSinceLeaf = min(self.minSinceLeaf, depth)
-        for x in __visit(self.root, 0):
-            yield x
+                minSinceLeaf = depth
+                continue
+            # push children so they're visited in lexicographical order
+            for c, child in sorted(n.out.iteritems(), reverse=True):
+                stack.append((child, depth))
+    
+    def saAndLcpArrays(self, sa=None, lcp=None):
+        """ Return suffix array and LCP array (as defined for saAndLcp) as a
+            pair of compact typed arrays.  If preallocated arrays (of length
+            len(self.s)) are given, they are filled in place. """
+        from sa import intArray
+        n = len(self.s)
+        if sa is None:
+            sa = intArray(n, [0]) * n
+        if lcp is None:
+            lcp = intArray(n, [0]) * n
+        i = 0
+        for off, ln in self.saAndLcp():
+            sa[i], lcp[i] = off, ln
+            i += 1
+        return sa, lcp
     
     def sa(self):
         """ Generate suffix array corresponding to this. """
-        def __visit(n, depth):
-            if len(n.out) == 0:
-                # leaf node, yield offset and LCP with previous
-                yield len(self.s) - depth
-            # visit children in lexicographical order
-            for c, child in sorted(n.out.iteritems()):
-                for x in __visit(child, depth + child.ln):
-                    yield x
-        for x in __visit(self.root, 0):
-            yield x
+        for off, _ in self.saAndLcp():
+            yield off
     
     def toDot(self, ost, strs=False, suflinks=True, labelNonLeaves=False):
         """ Write dot version of suffix tree to given output stream """
@@ -400,6 +499,543 @@ class SuffixTree(object):
                 ost.write("  n%d -> n%d [constraint=false style=dotted] ;\n" % (n2id[n], svId))
         ost.write("}\n")
 
+class CompactSuffixTree(object):
+    """ Suffix tree with nodes stored in parallel typed arrays rather than
+        as Node objects.  Node v has incoming edge labeled s[off[v]:end[v]]
+        (end is -1 for leaves, whose edges run to the end of the text),
+        suffix link slink[v], first child child[v] and next sibling sib[v]
+        (-1 for none), and leaf id leaf[v] (-1 for internal nodes).  Sibling
+        lists are kept sorted by first character.  Built with Ukkonen's
+        algorithm.  Nodes are ints; node 0 is the root.  Offers the same
+        queries as SuffixTree with the same results.
+
+        Because Ukkonen's algorithm is online, the tree can also be built
+        from a stream of text with extend(); in between calls it is the
+        implicit suffix tree of the text so far and answers substring
+        queries.  finalize() appends '$', after which suffix, SA and MEM
+        queries are available.  The text s is kept as an array('c'). """
+    
+    def __init__(self, s=None, maxLen=None):
+        """ Build suffix tree of s + '$'.  If s is None, start with an empty
+            tree that is grown with extend() and completed with finalize();
+            maxLen, if given, bounds the length of the text to be added. """
+        from sa import intArray
+        if s is not None:
+            maxLen = len(s)
+        # Signed, so -1 can mean "none"; text is at most maxLen + 1 long
+        maxVal = sys.maxint if maxLen is None else maxLen + 1
+        self.off, self.end, self.slink = [ intArray(maxVal, signed=True) for _ in xrange(0, 3) ]
+        self.child, self.sib, self.leaf = [ intArray(maxVal, signed=True) for _ in xrange(0, 3) ]
+        self.s = array('c')
+        self.finalized = False
+        self.root = self.__newNode(0, 0, -1)
+        # Active point (node, edge, length) and number of suffixes still to
+        # be inserted, carried over from one call to extend() to the next
+        self.__active = (self.root, 0, 0, 0)
+        if s is not None:
+            self.extend(s)
+            self.finalize()
+    
+    @classmethod
+    def fromChunks(cls, chunks, maxLen=None):
+        """ Build suffix tree from an iterable of text chunks, e.g. a
+            generator or lines of a file """
+        st = cls(maxLen=maxLen)
+        for chunk in chunks:
+            st.extend(chunk)
+        st.finalize()
+        return st
+    
+    @classmethod
+    def fromFile(cls, fh, chunkSize=1 << 20):
+        """ Build suffix tree from the contents of file object fh, read
+            chunkSize characters at a time """
+        return cls.fromChunks(iter(lambda: fh.read(chunkSize), ''))
+    
+    def extend(self, chunk):
+        """ Append chunk to the text, updating the implicit suffix tree so
+            that substring queries see the text so far """
+        if self.finalized:
+            raise RuntimeError("Cannot extend a finalized suffix tree")
+        if '$' in chunk:
+            raise RuntimeError("Text may not contain '$'")
+        start = len(self.s)
+        self.s.fromstring(chunk)
+        self.__ukkonen(start)
+    
+    def finalize(self):
+        """ Append the '$' terminator, making every suffix end at a leaf """
+        if self.finalized:
+            return
+        start = len(self.s)
+        self.s.append('$')
+        self.__ukkonen(start)
+        # s stays an array('c') rather than being copied into a str, which
+        # would briefly hold the text twice
+        self.finalized = True
+    
+    def __checkFinalized(self):
+        if not self.finalized:
+            raise RuntimeError("Suffix tree must be finalized first")
+    
+    def __newNode(self, off, end, leaf):
+        self.off.append(off)
+        self.end.append(end)
+        self.slink.append(-1)
+        self.child.append(-1)
+        self.sib.append(-1)
+        self.leaf.append(leaf)
+        return len(self.off) - 1
+    
+    def numNodes(self):
+        return len(self.off)
+    
+    def isLeaf(self, v):
+        return self.child[v] == -1
+    
+    def edgeLen(self, v):
+        """ Length of label on edge into v """
+        end = self.end[v]
+        return (len(self.s) if end < 0 else end) - self.off[v]
+    
+    def children(self, v):
+        """ Generate children of v in lexicographical order """
+        u = self.child[v]
+        while u != -1:
+            yield u
+            u = self.sib[u]
+    
+    def findChild(self, v, c):
+        """ Return child of v whose edge starts with c, or -1 """
+        s, off, sib = self.s, self.off, self.sib
+        u = self.child[v]
+        while u != -1:
+            fc = s[off[u]]
+            if fc == c:
+                return u
+            if fc > c:
+                return -1
+            u = sib[u]
+        return -1
+    
+    def __addChild(self, v, u):
+        """ Insert u into v's child list, keeping it sorted """
+        s, off, sib = self.s, self.off, self.sib
+        c = s[off[u]]
+        prev, w = -1, self.child[v]
+        while w != -1 and s[off[w]] < c:
+            prev, w = w, sib[w]
+        sib[u] = w
+        if prev == -1:
+            self.child[v] = u
+        else:
+            sib[prev] = u
+    
+    def __replaceChild(self, v, old, new):
+        """ Put new in old's place in v's child list """
+        sib = self.sib
+        sib[new] = sib[old]
+        sib[old] = -1
+        if self.child[v] == old:
+            self.child[v] = new
+        else:
+            w = self.child[v]
+            while sib[w] != old:
+                w = sib[w]
+            sib[w] = new
+    
+    def __ukkonen(self, start):
+        """ Ukkonen's algorithm, tracking the active point (node, edge,
+            length) and the number of suffixes still to be inserted.
+            Runs the phases for characters s[start:]. """
+        s, off, slink, root = self.s, self.off, self.slink, self.root
+        node, edge, ln, remainder = self.__active
+        for pos in xrange(start, len(s)):
+            c = s[pos]
+            remainder += 1
+            lastNew = -1 # internal node awaiting a suffix link
+            while remainder > 0:
+                if ln == 0:
+                    edge = pos
+                nxt = self.findChild(node, s[edge])
+                if nxt == -1:
+                    # Rule 2: new leaf below node
+                    self.__addChild(node, self.__newNode(pos, -1, pos - remainder + 1))
+                    if lastNew != -1:
+                        slink[lastNew] = node
+                        lastNew = -1
+                else:
+                    elen = self.edgeLen(nxt)
+                    if ln >= elen:
+                        # Skip/count down to next node
+                        edge += elen
+                        ln -= elen
+                        node = nxt
+                        continue
+                    if s[off[nxt] + ln] == c:
+                        # Rule 3: already there; end phase
+                        if lastNew != -1:
+                            slink[lastNew] = node
+                            lastNew = -1
+                        ln += 1
+                        break
+                    # Rule 2: split edge and add new leaf
+                    mid = self.__newNode(off[nxt], off[nxt] + ln, -1)
+                    self.__replaceChild(node, nxt, mid)
+                    off[nxt] += ln
+                    self.__addChild(mid, nxt)
+                    self.__addChild(mid, self.__newNode(pos, -1, pos - remainder + 1))
+                    if lastNew != -1:
+                        slink[lastNew] = mid
+                    lastNew = mid
+                remainder -= 1
+                if node == root and ln > 0:
+                    ln -= 1
+                    edge = pos - remainder + 1
+                elif node != root:
+                    node = slink[node]
+            if lastNew != -1:
+                slink[lastNew] = root
+        self.__active = (node, edge, ln, remainder)
+    
+    def fromRoot(self, q):
+        """ Walk down from the root, following a path corresponding to string
+            q.  Return coordinates of where walk ended, as SuffixTree's
+            fromRoot does, but with nodes given as ints. """
+        s, off = self.s, self.off
+        cur, i = self.root, 0
+        while i < len(q):
+            c = q[i]
+            child = self.findChild(cur, c)
+            if child == -1:
+                return None, None, None
+            elen, o = self.edgeLen(child), off[child]
+            j = 1
+            i += 1
+            while j < elen and i < len(q):
+                if q[i] != s[o + j]:
+                    return None, None, None
+                j += 1
+                i += 1
+            if j == elen:
+                cur = child
+            else:
+                return (cur, c, j)
+        return (cur, None, 0)
+    
+    def hasSubstring(self, s):
+        """ Return true iff s appears as a substring """
+        node, c, off = self.fromRoot(s)
+        return node is not None
+    
+    def hasSuffix(self, s):
+        """ Return true iff s is a suffix """
+        self.__checkFinalized()
+        node, c, depth = self.fromRoot(s)
+        if node is None:
+            return False
+        if depth == 0:
+            return self.findChild(node, '$') != -1
+        return self.s[self.off[self.findChild(node, c)] + depth] == '$'
+    
+    def leavesBelow(self, v):
+        """ Generate ids of leaves in subtree rooted at v, in lexicographical
+            order of their suffixes """
+        child, sib, leaf = self.child, self.sib, self.leaf
+        stack = [v]
+        while len(stack) > 0:
+            u = stack.pop()
+            if child[u] == -1:
+                yield leaf[u]
+                continue
+            kids = []
+            w = child[u]
+            while w != -1:
+                kids.append(w)
+                w = sib[w]
+            stack.extend(reversed(kids))
+    
+    def saAndLcp(self):
+        """ Generate (suffix array element, LCP with previous) pairs as
+            SuffixTree's saAndLcp does, traversing with an explicit stack """
+        self.__checkFinalized()
+        child, sib, leaf = self.child, self.sib, self.leaf
+        minSinceLeaf = 0
+        stack = [(self.root, 0)] # (node, string depth of its parent)
+        while len(stack) > 0:
+            u, pdepth = stack.pop()
+            # LCP of consecutive leaves is depth of their lowest common
+            # ancestor: the shallowest parent entered in between
+            minSinceLeaf = min(minSinceLeaf, pdepth)
+            if child[u] == -1:
+                yield (leaf[u], minSinceLeaf)
+                minSinceLeaf = len(self.s) - leaf[u]
+                continue
+            depth = pdepth + self.edgeLen(u)
+            kids = []
+            w = child[u]
+            while w != -1:
+                kids.append((w, depth))
+                w = sib[w]
+            stack.extend(reversed(kids))
+    
+    def sa(self):
+        """ Generate suffix array corresponding to this. """
+        for off, _ in self.saAndLcp():
+            yield off
+    
+    def saAndLcpArrays(self, sa=None, lcp=None):
+        """ Return suffix array and LCP array as compact typed arrays,
+            filling preallocated ones in place if given """
+        self.__checkFinalized()
+        from sa import intArray
+        n = len(self.s)
+        if sa is None:
+            sa = intArray(n, [0]) * n
+        if lcp is None:
+            lcp = intArray(n, [0]) * n
+        i = 0
+        for off, ln in self.saAndLcp():
+            sa[i], lcp[i] = off, ln
+            i += 1
+        return sa, lcp
+    
+    def matchingStatistics(self, p):
+        """ For each i, return length of the longest suffix of p[:i+1] that
+            occurs in the text.  Walks the tree, following suffix links and
+            skip/counting with the pattern characters just matched. """
+        s, off, slink, root = self.s, self.off, self.slink, self.root
+        node, nodeDepth, child, below = root, 0, -1, 0
+        depths = []
+        for i in xrange(0, len(p)):
+            c = p[i]
+            while True:
+                if below == 0:
+                    nxt = self.findChild(node, c)
+                    if nxt != -1:
+                        child, below = nxt, 1
+                        break
+                elif s[off[child] + below] == c:
+                    below += 1
+                    break
+                if nodeDepth + below == 0:
+                    break # no match at all; stay at root
+                # Drop first char of current match: p[i-depth:i]
+                depth = nodeDepth + below
+                if node == root:
+                    below, i0 = depth - 1, i - depth + 1
+                else:
+                    node, nodeDepth = slink[node], nodeDepth - 1
+                    i0 = i - below
+                # Skip/count down 'below' chars of p starting at i0
+                while below > 0:
+                    child = self.findChild(node, p[i0])
+                    elen = self.edgeLen(child)
+                    if elen > below:
+                        break
+                    node, nodeDepth = child, nodeDepth + elen
+                    below -= elen
+                    i0 += elen
+            if below > 0 and below == self.edgeLen(child):
+                node, nodeDepth, below = child, nodeDepth + below, 0
+            depths.append(nodeDepth + below)
+        return depths
+    
+    def mems(self, p, l=4):
+        """ Find maximal exact matches (MEMs) between t and the given pattern
+            p.  Only report MEMs that are at least l characters long.
+            Returns sorted list of (text offset, pattern offset, length)
+            tuples and the matching statistics of p (see
+            matchingStatistics). """
+        self.__checkFinalized()
+        s, off = self.s, self.off
+        mems = []
+        def report(v, ln, j):
+            # Leaves below v match p[j:j+ln]; keep left-maximal ones
+            for y in self.leavesBelow(v):
+                if j == 0 or y == 0 or s[y-1] != p[j-1]:
+                    mems.append((y, j, ln))
+        for j in xrange(0, len(p)):
+            # Walk p[j:] down from the root.  At each node, leaves below
+            # children we don't follow match exactly as far as the node.
+            node, depth = self.root, 0
+            while True:
+                if j + depth == len(p):
+                    if depth >= l:
+                        report(node, depth, j)
+                    break
+                nxt = self.findChild(node, p[j + depth])
+                if depth >= l:
+                    for u in self.children(node):
+                        if u != nxt:
+                            report(u, depth, j)
+                if nxt == -1:
+                    break
+                elen, o = self.edgeLen(nxt), off[nxt]
+                k = 1
+                while k < elen and j + depth + k < len(p) and s[o + k] == p[j + depth + k]:
+                    k += 1
+                if k < elen:
+                    if depth + k >= l:
+                        report(nxt, depth + k, j)
+                    break
+                node, depth = nxt, depth + elen
+        return sorted(mems), self.matchingStatistics(p)
+
+class MemFinder(object):
+    """ Finds MEMs and SMEMs between a text and query patterns using a
+        CompactSuffixTree over the text.  For each node, caches its string
+        depth and the range [lo, hi) of suffix array ranks of the leaves
+        below it, so the occurrences of any node are the contiguous slice
+        sa[lo:hi] and never need a subtree walk. """
+    
+    def __init__(self, stree):
+        self.stree = stree
+        from sa import intArray
+        nnodes, n = stree.numNodes(), len(stree.s)
+        self.sa = intArray(n, [0]) * n
+        self.lo = intArray(n, [0]) * nnodes
+        self.hi = intArray(n, [0]) * nnodes
+        self.depth = intArray(n, [0]) * nnodes
+        self.__cacheRanges()
+    
+    def __cacheRanges(self):
+        """ Fill in sa, lo, hi and depth with one depth-first traversal;
+            a node is pushed twice so its range closes after its subtree """
+        st = self.stree
+        child, sib, leaf = st.child, st.sib, st.leaf
+        sa, lo, hi, depth = self.sa, self.lo, self.hi, self.depth
+        rank = 0
+        stack = [(st.root, False)]
+        while len(stack) > 0:
+            u, done = stack.pop()
+            if done:
+                hi[u] = rank
+                continue
+            lo[u] = rank
+            if child[u] == -1:
+                sa[rank] = leaf[u]
+                rank += 1
+                hi[u] = rank
+                depth[u] = len(st.s) - leaf[u]
+                continue
+            stack.append((u, True))
+            kids = []
+            w = child[u]
+            while w != -1:
+                depth[w] = depth[u] + st.edgeLen(w)
+                kids.append((w, False))
+                w = sib[w]
+            stack.extend(reversed(kids))
+    
+    def matchLengths(self, p):
+        """ For each i, return length of the longest prefix of p[i:] that
+            occurs in the text, derived in linear time from the tree's
+            matching statistics (longest match ending at each i) """
+        ms = self.stree.matchingStatistics(p)
+        lens = []
+        i = -1 # last end offset whose match starts at or before j
+        for j in xrange(0, len(p)):
+            while i + 1 < len(p) and i + 1 - ms[i + 1] + 1 <= j:
+                i += 1
+            lens.append(max(0, i + 1 - j))
+        return lens
+    
+    def memSlices(self, p, l=4, lens=None):
+        """ Generate (pattern offset, length, lo, hi) tuples such that each
+            text offset in sa[lo:hi] matches p at that pattern offset for
+            exactly that length.  These are the right-maximal matches of
+            length at least l; they are MEMs if also left-maximal. """
+        st, lo, hi, depth = self.stree, self.lo, self.hi, self.depth
+        if lens is None:
+            lens = self.matchLengths(p)
+        for j in xrange(0, len(p)):
+            ln = lens[j]
+            if ln < l:
+                continue
+            # Skip/count down the path of p[j:j+ln], which is known to occur
+            v, d = st.root, 0
+            while d < ln:
+                u = st.findChild(v, p[j + d])
+                if depth[u] > ln:
+                    break
+                # Leaves below v but not u match exactly d characters
+                if d >= l:
+                    if lo[v] < lo[u]:
+                        yield (j, d, lo[v], lo[u])
+                    if hi[u] < hi[v]:
+                        yield (j, d, hi[u], hi[v])
+                v, d = u, depth[u]
+            if d >= l and d < ln:
+                # Match ends inside edge into u; all leaves below v except
+                # those below u stop at v
+                if lo[v] < lo[u]:
+                    yield (j, d, lo[v], lo[u])
+                if hi[u] < hi[v]:
+                    yield (j, d, hi[u], hi[v])
+            if d == ln:
+                yield (j, ln, lo[v], hi[v])
+            else:
+                yield (j, ln, lo[u], hi[u])
+    
+    def mems(self, p, l=4):
+        """ Generate (text offset, pattern offset, length) for all MEMs of
+            length at least l between the text and p, in no particular
+            order """
+        s, sa = self.stree.s, self.sa
+        lens = self.matchLengths(p)
+        for j, ln, a, b in self.memSlices(p, l, lens):
+            if j == 0 or lens[j-1] <= ln:
+                # p[j-1:j+ln] occurs nowhere, so every match is left-maximal
+                for r in xrange(a, b):
+                    yield (sa[r], j, ln)
+            else:
+                c = p[j-1]
+                for r in xrange(a, b):
+                    y = sa[r]
+                    if y == 0 or s[y-1] != c:
+                        yield (y, j, ln)
+    
+    def memsMany(self, patterns, l=4):
+        """ Generate (pattern index, text offset, pattern offset, length)
+            for the MEMs of each pattern in turn """
+        for i, p in enumerate(patterns):
+            for off, j, ln in self.mems(p, l):
+                yield (i, off, j, ln)
+    
+    def smemSlices(self, p, l=4):
+        """ Generate (pattern offset, length, lo, hi) for each super-maximal
+            exact match (SMEM) of p of length at least l: a match that can't
+            be extended either way and isn't contained in a longer one.
+            sa[lo:hi] holds all its occurrences. """
+        st, lo, hi, depth = self.stree, self.lo, self.hi, self.depth
+        lens = self.matchLengths(p)
+        for j in xrange(0, len(p)):
+            ln = lens[j]
+            # Contained in previous match unless it ends further right
+            if ln < l or (j > 0 and j + ln <= j - 1 + lens[j-1]):
+                continue
+            v, d = st.root, 0
+            while d < ln:
+                v = st.findChild(v, p[j + d])
+                d = depth[v]
+            yield (j, ln, lo[v], hi[v])
+    
+    def smems(self, p, l=4):
+        """ Generate (text offset, pattern offset, length) for every
+            occurrence of every SMEM of p of length at least l """
+        sa = self.sa
+        for j, ln, a, b in self.smemSlices(p, l):
+            for r in xrange(a, b):
+                yield (sa[r], j, ln)
+    
+    def smemsMany(self, patterns, l=4):
+        """ Generate (pattern index, text offset, pattern offset, length)
+            for the SMEM occurrences of each pattern in turn """
+        for i, p in enumerate(patterns):
+            for off, j, ln in self.smems(p, l):
+                yield (i, off, j, ln)
+
 def naiveMEMs(p, t, l=4):
     mems = []
     # slide p along t
@@ -421,6 +1057,58 @@ def naiveMEMs(p, t, l=4):
             j += 1
     return sorted(mems)
 
+def measureBuild(build, t):
+    """ Call build(t) in a forked child process.  Return seconds taken and
+        the growth in the child's peak resident set size, in bytes. """
+    import resource
+    import time
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        st = time.time()
+        build(t)
+        secs = time.time() - st
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(wfd, "%f %d" % (secs, (peak - base) * 1024))
+        os._exit(0)
+    os.close(wfd)
+    res = os.read(rfd, 100)
+    os.close(rfd)
+    _, status = os.waitpid(pid, 0)
+    if len(res) == 0:
+        if os.WIFSIGNALED(status):
+            why = "killed by signal %d, e.g. out of memory" % os.WTERMSIG(status)
+        else:
+            why = "exit status %d" % os.WEXITSTATUS(status)
+        raise RuntimeError("Build of %d-character text failed: %s" % (len(t), why))
+    secs, rss = res.split()
+    return float(secs), int(rss)
+
+def benchmarkBuild(sizes, seed=0, ost=sys.stdout):
+    """ Print build time and peak memory of the checked SuffixTree build,
+        the fast SuffixTree build and CompactSuffixTree on random DNA texts
+        of the given sizes """
+    import random
+    builds = [ ('SuffixTree(fast=False)', lambda t: SuffixTree(t, fast=False)),
+               ('SuffixTree', SuffixTree),
+               ('CompactSuffixTree', CompactSuffixTree) ]
+    print >>ost, '\t'.join(['impl', 'length', 'seconds', 'peak_mb'])
+    for n in sizes:
+        random.seed(seed)
+        t = ''.join([random.choice('ACGT') for _ in xrange(0, n)])
+        for name, build in builds:
+            try:
+                secs, rss = measureBuild(build, t)
+            except RuntimeError as e:
+                # e.g. the pointer-based trees need ~1 KB per base
+                print >>sys.stderr, e
+                print >>ost, '%s\t%d\tNA\tNA' % (name, n)
+            else:
+                print >>ost, '%s\t%d\t%0.2f\t%0.1f' % (name, n, secs, rss / float(1 << 20))
+            ost.flush()
+
 if __name__ == "__main__":
     import argparse
     
@@ -442,6 +1130,11 @@ if __name__ == "__main__":
         '--text-uppercase', action='store_const', const=True, default=False, help='Make text all-uppercase')
     parser.add_argument(\
         '--test', action='store_const', const=True, default=False, help='Do unit tests')
+    parser.add_argument(\
+        '--benchmark', action='store_const', const=True, default=False, help='Benchmark suffix tree builds')
+    parser.add_argument(\
+        '--benchmark-sizes', metavar='int,int,...', type=str, default='10000,100000,1000000',
+        help='Text lengths to benchmark; SuffixTree builds take ~1 KB per base')
     parser.add_argument(\
         '--sanity', action='store_const', const=True, default=False, help='Do sanity checks')
     parser.add_argument(\
@@ -526,6 +1219,26 @@ if __name__ == "__main__":
                 self.assertEqual(0, esa[5][1])
                 self.assertEqual(2, esa[6][1])
             
+            def test_salcp_arrays_1(self):
+                st = SuffixTree("abaaba")
+                sa, lcp = st.saAndLcpArrays()
+                self.assertEqual('I', sa.typecode)
+                self.assertEqual([6, 5, 2, 3, 0, 4, 1], list(sa))
+                self.assertEqual([0, 0, 1, 1, 3, 0, 2], list(lcp))
+            
+            def test_deep_1(self):
+                # Deeper than the default recursion limit
+                t = "A" * 3000
+                st = SuffixTree(t)
+                self.assertEqual(range(3000, -1, -1), list(st.sa()))
+                esa = list(st.saAndLcp())
+                self.assertEqual([0] + range(0, 3000), [ x[1] for x in esa ])
+                sa, lcp = array('I', [7]) * 3001, array('I', [7]) * 3001
+                st.saAndLcpArrays(sa, lcp)
+                self.assertEqual([ x[0] for x in esa ], list(sa))
+                self.assertEqual([ x[1] for x in esa ], list(lcp))
+                self.assertEqual(3001, len(st.suffixesBelow(SuffixTree.Locus(st.root, None, None, 0))))
+            
             def test_mems_1(self):
                 t, p = "abaaba", "aba"
                 st = SuffixTree(t)
@@ -548,6 +1261,99 @@ if __name__ == "__main__":
                 self.assertEqual([(0, 0, 3), (3, 0, 3), (0, 2, 3), (3, 2, 3), (0, 4, 3), (3, 4, 3)], mems)
                 self.assertEqual(sorted(mems), naiveMEMs(p, t, 3))
             
+            def test_compact_1(self):
+                import random
+                random.seed(41)
+                texts = [ "abaaba", "ACGT", "AAAAAAAA", "XABZABQABC" ]
+                texts += [ ''.join([random.choice(alph) for _ in xrange(0, ln)])
+                           for ln in (1, 2, 5, 30, 200) for alph in ("AC", "ACGT") ]
+                for t in texts:
+                    st, cst = SuffixTree(t), CompactSuffixTree(t)
+                    self.assertEqual(list(st.saAndLcp()), list(cst.saAndLcp()))
+                    self.assertEqual(list(st.sa()), list(cst.sa()))
+                    self.assertEqual(list(st.saAndLcpArrays()[1]), list(cst.saAndLcpArrays()[1]))
+                    self.assertEqual(len(st.nodes), cst.numNodes())
+                    for v in xrange(1, cst.numNodes()):
+                        self.assertTrue(cst.isLeaf(v) or cst.slink[v] != -1)
+                    subs = [ t[i:i+random.randint(0, 6)] for i in xrange(0, len(t)) ]
+                    subs += [ t[i:] for i in xrange(0, len(t)+1) ] + [ "ACGTT", "Z", t + "A" ]
+                    for q in subs:
+                        self.assertEqual(st.hasSubstring(q), cst.hasSubstring(q))
+                        self.assertEqual(st.hasSuffix(q), cst.hasSuffix(q))
+                        node, c, depth = st.fromRoot(q)
+                        cnode, cc, cdepth = cst.fromRoot(q)
+                        self.assertEqual((node is None, c, depth), (cnode is None, cc, cdepth))
+                    for trial in xrange(0, 5):
+                        p = ''.join([random.choice("ABCGTXQZ") for _ in xrange(0, 12)])
+                        if trial % 2 == 0 and len(t) > 8:
+                            i = random.randint(0, len(t) - 8)
+                            p = p[:3] + t[i:i+8] + p[3:]
+                        for l in (1, 2, 3, 5):
+                            mems, depths = cst.mems(p, l)
+                            self.assertEqual(naiveMEMs(p, t, l), mems)
+                            for i in xrange(0, len(p)):
+                                d = depths[i]
+                                self.assertTrue(t.find(p[i+1-d:i+1]) >= 0)
+                                self.assertFalse(d <= i and t.find(p[i-d:i+1]) >= 0)
+            
+            def test_compact_stream_1(self):
+                import random
+                from StringIO import StringIO
+                random.seed(47)
+                for t in [ "abaaba", "AAAAAAAA", "XABZABQABC" ] + \
+                         [ ''.join([random.choice("ACGT") for _ in xrange(0, 300)]) ]:
+                    st = CompactSuffixTree()
+                    i = 0
+                    while i < len(t):
+                        j = min(len(t), i + random.randint(1, 40))
+                        st.extend(t[i:j])
+                        i = j
+                        for q in [ t[k:k+random.randint(1, 8)] for k in xrange(0, len(t), 7) ]:
+                            self.assertEqual(t[:i].find(q) >= 0, st.hasSubstring(q))
+                    self.assertRaises(RuntimeError, st.hasSuffix, t[-2:])
+                    st.finalize()
+                    self.assertRaises(RuntimeError, st.extend, "A")
+                    cst = CompactSuffixTree(t)
+                    self.assertEqual(list(cst.saAndLcp()), list(st.saAndLcp()))
+                    self.assertEqual(cst.s, st.s)
+                    self.assertEqual(list(cst.slink), list(st.slink))
+                    fst = CompactSuffixTree.fromFile(StringIO(t), chunkSize=5)
+                    self.assertEqual(list(cst.sa()), list(fst.sa()))
+                    self.assertTrue(fst.hasSuffix(t[-3:]))
+            
+            def test_mem_finder_1(self):
+                import random
+                random.seed(59)
+                texts = [ "abaaba", "XABZABQABC", "ACGT" * 20 ]
+                texts += [ ''.join([random.choice("ACGT") for _ in xrange(0, 150)]) ]
+                unit = ''.join([random.choice("ACGT") for _ in xrange(0, 12)])
+                texts += [ ''.join([unit[:random.randint(8, 12)] for _ in xrange(0, 15)]) ]
+                for t in texts:
+                    mf = MemFinder(CompactSuffixTree(t))
+                    self.assertEqual(list(CompactSuffixTree(t).sa()), list(mf.sa))
+                    patterns = [ "abababa", "XABC" ]
+                    for _ in xrange(0, 6):
+                        i = random.randint(0, len(t) - 1)
+                        p = t[i:i+random.randint(1, 25)]
+                        p = ''.join([c if random.random() < 0.9 else random.choice("ACGT") for c in p])
+                        patterns.append(p)
+                    for l in (1, 3, 5):
+                        got = sorted(mf.memsMany(patterns, l))
+                        expect = sorted([ (i,) + mem for i, p in enumerate(patterns)
+                                          for mem in naiveMEMs(p, t, l) ])
+                        self.assertEqual(expect, got)
+                        for p in patterns:
+                            lens = mf.matchLengths(p)
+                            expect = []
+                            for j in xrange(0, len(p)):
+                                ln = lens[j]
+                                self.assertTrue(t.find(p[j:j+ln]) >= 0)
+                                self.assertFalse(j + ln < len(p) and t.find(p[j:j+ln+1]) >= 0)
+                                if ln >= l and (j == 0 or j + ln > j - 1 + lens[j-1]):
+                                    expect += [ (y, j, ln) for y in xrange(0, len(t))
+                                                if t[y:y+ln] == p[j:j+ln] ]
+                            self.assertEqual(sorted(expect), sorted(mf.smems(p, l)))
+            
             def test_mems_random1(self):
                 import random
                 random.seed(773)
@@ -560,6 +1366,9 @@ if __name__ == "__main__":
         
         unittest.main(argv=[sys.argv[0]])
     
+    elif args.benchmark:
+        benchmarkBuild(map(int, args.benchmark_sizes.split(',')))
+    
     else:
         t = args.text
         if t is None: